@@ -0,0 +1,431 @@
+"""
+Convert every page of a wiki dump to HTML, in parallel.
+
+    python batch_convert.py                                # wiki_pages.json -> html/<id>.html
+    python batch_convert.py --shard-size 1000 --workers 8  # html/pages-00000.jsonl, ...
+
+Pages are streamed out of the dump (see wiki_dump.py) and handed in chunks to a pool of worker
+processes that parse and render them. Results are written in dump order whatever order the
+chunks finish in, and only a few chunks per worker are in flight, so memory doesn't grow with
+the dump. A page that fails to convert is reported and skipped; the run goes on.
+
+Per-page files are full HTML documents sharing one styles.css; shards are JSON Lines of
+{"id", "title", "html"} with the HTML fragment only.
+
+Per-page builds are incremental: manifest.json in the output directory records a hash of each
+converted page's body, plus a version stamp of the converter code. With a wiki index it also
+records the wiki titles each page links to and the page id each one resolved to (null if the
+index didn't have it). The next run skips the pages whose hash is unchanged and whose links
+resolve the same in the current index, converts new and edited ones and deletes the files of
+pages gone from the dump. So refreshing the index only rebuilds the pages linking to titles that
+were added, removed or moved to another id. A changed stamp rebuilds everything, as does --force.
+"""
+
+import hashlib
+import heapq
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from html_template import CSS_CONTENT, generate_full_html
+from main import link_cache_info, parse_dtext_to_ast, record_wiki_links, use_wiki_index
+from to_html import ast_to_html
+from wiki_dump import WIKI_PAGES_PATH, iter_wiki_pages
+from wiki_index import WikiIndex
+
+OUTPUT_DIR = "html"
+CHUNK_SIZE = 32  # pages per task sent to a worker
+CSS_FILENAME = "styles.css"
+MANIFEST_FILENAME = "manifest.json"
+ERRORS_FILENAME = "errors.jsonl"
+
+# Whatever can change the HTML of a page with the same body; part of the manifest's version stamp.
+CONVERTER_SOURCES = ("main.py", "nodes.py", "id_link_map.py", "to_html.py", "html_template.py", "batch_convert.py")
+
+# Set in each worker by init_worker.
+FULL_PAGE = True
+
+
+def init_worker(full_page, wiki_index_path=None):
+    global FULL_PAGE
+    FULL_PAGE = full_page
+    if wiki_index_path:
+        use_wiki_index(WikiIndex(wiki_index_path))
+
+
+def link_cache_counts():
+    return {kind: (info.hits, info.misses) for kind, info in link_cache_info().items()}
+
+
+def convert_chunk(chunk):
+    """
+    Convert a list of (page id, title, body). Returns a list of (page id, title, html or None,
+    error or None, seconds, wiki titles the page links to), and {link kind: (hits, misses)} of the
+    link caches over the chunk.
+    """
+    before = link_cache_counts()
+    results = []
+    for page_id, title, body in chunk:
+        start = time.perf_counter()
+        wiki_links = set()
+        record_wiki_links(wiki_links)
+        try:
+            html = ast_to_html(parse_dtext_to_ast(body))
+            if FULL_PAGE:
+                html = generate_full_html(html, embed_css=False, css_filename=CSS_FILENAME)
+            error = None
+        except Exception as e:  # one bad page must not stop the batch
+            html = None
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            record_wiki_links(None)
+        results.append((page_id, title, html, error, time.perf_counter() - start, sorted(wiki_links)))
+    # The caches live in the worker, so their counts go back with the results to be added up.
+    after = link_cache_counts()
+    return results, {kind: (hits - before[kind][0], misses - before[kind][1]) for kind, (hits, misses) in after.items()}
+
+
+def converter_version(wiki_index_path=None):
+    """
+    A stamp that changes with the converter's code, or with whether links go to a wiki index.
+    The index's content isn't part of it: the manifest tracks which pages its entries affect.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in CONVERTER_SOURCES:
+        with open(os.path.join(script_dir, name), "rb") as f:
+            digest.update(f.read())
+    digest.update(b"wiki index" if wiki_index_path else b"")
+    return digest.hexdigest()
+
+
+def is_page_id(page_id):
+    """Pages are written to <id>.html, so only integer ids are accepted (not bools, which are ints too)."""
+    return isinstance(page_id, int) and not isinstance(page_id, bool)
+
+
+def is_page_key(key):
+    """Whether a manifest key is a page id as written by str(), and so names one of our <id>.html files."""
+    try:
+        return str(int(key)) == key
+    except (TypeError, ValueError):
+        return False
+
+
+def page_hash(page):
+    # Only the body: per-page files don't contain the title.
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update((page.get("body") or "").encode("utf-8", "surrogatepass"))
+    return digest.hexdigest()
+
+
+def load_manifest(out_dir, version):
+    """
+    ({page id (as a string): page hash}, {page id: {wiki title: page id or None}}) from the last
+    build, or two empty dicts if it was made by another converter version.
+    """
+    try:
+        with open(os.path.join(out_dir, MANIFEST_FILENAME), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}, {}
+    if not isinstance(manifest, dict) or manifest.get("version") != version:
+        return {}, {}
+    pages = manifest.get("pages")
+    links = manifest.get("links")
+    return pages if isinstance(pages, dict) else {}, links if isinstance(links, dict) else {}
+
+
+def save_manifest(out_dir, version, pages, links):
+    path = os.path.join(out_dir, MANIFEST_FILENAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"version": version, "pages": pages, "links": links}, f)
+    os.replace(path + ".tmp", path)
+
+
+def links_resolve_the_same(links, index):
+    """Whether every {wiki title: page id or None} of a page's links still resolves the same in `index`."""
+    if not isinstance(links, dict):
+        return False
+    return all(index.get(title) == page_id for title, page_id in links.items())
+
+
+def iter_chunks(pages, chunk_size):
+    chunk = []
+    for page in pages:
+        chunk.append((page.get("id"), page.get("title"), page.get("body") or ""))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class PageWriter:
+    """One file per page, named like main.LOCAL_WIKI_HREF so local wiki links resolve."""
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        with open(os.path.join(out_dir, CSS_FILENAME), "w", encoding="utf-8") as f:
+            f.write(CSS_CONTENT)
+
+    def write(self, page_id, title, html):
+        with open(os.path.join(self.out_dir, f"{page_id}.html"), "w", encoding="utf-8") as f:
+            f.write(html)
+
+    def close(self):
+        pass
+
+
+class ShardWriter:
+    """JSON Lines shards of `shard_size` pages each: pages-00000.jsonl, pages-00001.jsonl, ..."""
+
+    def __init__(self, out_dir, shard_size):
+        self.out_dir = out_dir
+        self.shard_size = shard_size
+        # Shards are rewritten whole: ones left from a run with more pages or smaller shards would go stale.
+        for name in os.listdir(out_dir):
+            if name.startswith("pages-") and name.endswith(".jsonl"):
+                os.remove(os.path.join(out_dir, name))
+        self.shard = -1
+        self.written = 0
+        self.file = None
+
+    def write(self, page_id, title, html):
+        if self.written % self.shard_size == 0:
+            self.close()
+            self.shard += 1
+            path = os.path.join(self.out_dir, f"pages-{self.shard:05d}.jsonl")
+            self.file = open(path, "w", encoding="utf-8")
+        self.file.write(json.dumps({"id": page_id, "title": title, "html": html}, ensure_ascii=False) + "\n")
+        self.written += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def convert_dump(
+    json_path=WIKI_PAGES_PATH,
+    out_dir=OUTPUT_DIR,
+    workers=None,
+    chunk_size=CHUNK_SIZE,
+    shard_size=None,
+    wiki_index_path=None,
+    slowest=10,
+    force=False,
+):
+    """
+    Convert every page of the dump at `json_path` into `out_dir`: one file per page, or JSON Lines
+    shards of `shard_size` pages. `workers` defaults to the number of CPUs; with 1, pages are
+    converted in this process. One file per page is an incremental build (see the module docstring)
+    unless `force` is set. Returns a dict of counts, timings, the `slowest` pages, the errors and
+    the hits and misses of the link caches (see main.link_cache_info) summed over the workers.
+    """
+    return convert_pages(
+        iter_wiki_pages(json_path), out_dir, workers, chunk_size, shard_size, wiki_index_path, slowest, force
+    )
+
+
+def convert_pages(
+    pages,
+    out_dir=OUTPUT_DIR,
+    workers=None,
+    chunk_size=CHUNK_SIZE,
+    shard_size=None,
+    wiki_index_path=None,
+    slowest=10,
+    force=False,
+    complete=True,
+):
+    """
+    convert_dump for any iterable of page dicts, e.g. records fetched with danbooru_fetch.py.
+    With complete=False, `pages` is only part of the set (say, the rest of a resumed fetch):
+    files of pages that aren't in it are kept instead of deleted as gone.
+    """
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(out_dir, exist_ok=True)
+    # Errors are only written when there are some, so a clean run must not leave the last run's behind.
+    try:
+        os.remove(os.path.join(out_dir, ERRORS_FILENAME))
+    except FileNotFoundError:
+        pass
+    writer = PageWriter(out_dir) if shard_size is None else ShardWriter(out_dir, shard_size)
+    full_page = shard_size is None
+
+    # Shards are rewritten whole, so only per-page builds keep a manifest.
+    incremental = shard_size is None
+    index = None
+    if incremental:
+        version = converter_version(wiki_index_path)
+        previous, previous_links = ({}, {}) if force else load_manifest(out_dir, version)
+        if wiki_index_path:
+            # The workers open their own; this one checks and records what the links resolve to.
+            index = WikiIndex(wiki_index_path)
+    manifest = {}  # page id (as a string) -> hash, of the pages whose output is up to date
+    manifest_links = {}  # page id (as a string) -> {wiki title: page id or None}, for those with wiki links
+    changed = deque()  # hashes of the pages sent to convert, in dump order like the results
+
+    converted = 0
+    skipped = 0
+    errors = []
+    link_cache = {}  # link kind -> [hits, misses], over every worker
+    times = []  # min-heap of the `slowest` (seconds, position in the dump, page id)
+
+    def iter_changed(pages):
+        nonlocal skipped
+        for page in pages:
+            page_id = page.get("id")
+            key = str(page_id)
+            digest = page_hash(page)
+            if (
+                is_page_id(page_id)
+                and previous.get(key) == digest
+                and key not in manifest
+                and (key not in previous_links or links_resolve_the_same(previous_links[key], index))
+                and os.path.exists(os.path.join(out_dir, f"{page_id}.html"))
+            ):
+                manifest[key] = digest
+                if key in previous_links:
+                    manifest_links[key] = previous_links[key]
+                skipped += 1
+                continue
+            changed.append(digest)
+            yield page
+
+    def handle(chunk_result):
+        nonlocal converted
+        results, lookups = chunk_result
+        for kind, counts in lookups.items():
+            total = link_cache.setdefault(kind, [0, 0])
+            total[0] += counts[0]
+            total[1] += counts[1]
+        for page_id, title, html, error, seconds, wiki_links in results:
+            digest = changed.popleft() if incremental else None
+            if error is None and page_id is None:
+                error = "page has no id"
+            elif error is None and not is_page_id(page_id):
+                error = f"page id is not an integer: {page_id!r}"
+            if error is None:
+                writer.write(page_id, title, html)
+                converted += 1
+                if incremental:
+                    manifest[str(page_id)] = digest
+                    manifest_links.pop(str(page_id), None)
+                    if index is not None and wiki_links:
+                        manifest_links[str(page_id)] = {title: index.get(title) for title in wiki_links}
+            else:
+                errors.append((page_id, error))
+                # Left out of the manifest, so the page is tried again next time.
+                manifest.pop(str(page_id), None)
+                manifest_links.pop(str(page_id), None)
+            entry = (seconds, converted + len(errors), page_id)
+            if len(times) < slowest:
+                heapq.heappush(times, entry)
+            elif slowest:
+                heapq.heappushpop(times, entry)
+
+    start = time.perf_counter()
+    chunks = iter_chunks(iter_changed(pages) if incremental else pages, chunk_size)
+    try:
+        if workers == 1:
+            init_worker(full_page, wiki_index_path)
+            for chunk in chunks:
+                handle(convert_chunk(chunk))
+        else:
+            with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(full_page, wiki_index_path)) as pool:
+                # Start the workers before taking any page: the pages may come from threads (see
+                # danbooru_fetch.py), and forking while other threads run can deadlock the workers.
+                pool.submit(int).result()
+                # Results are taken in submission order, which keeps the output in dump order.
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.submit(convert_chunk, chunk))
+                    if len(pending) >= 2 * workers:
+                        handle(pending.popleft().result())
+                while pending:
+                    handle(pending.popleft().result())
+    finally:
+        writer.close()
+        if index is not None:
+            index.close()
+
+    deleted = 0
+    if incremental:
+        seen = set(manifest) | {str(page_id) for page_id, _ in errors}
+        for key in previous.keys() - seen:
+            if not complete:
+                manifest[key] = previous[key]
+                if key in previous_links:
+                    manifest_links[key] = previous_links[key]
+                continue
+            if not is_page_key(key):
+                continue  # not a file of ours to delete
+            try:
+                os.remove(os.path.join(out_dir, f"{key}.html"))
+            except FileNotFoundError:
+                pass
+            deleted += 1
+        save_manifest(out_dir, version, manifest, manifest_links)
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        with open(os.path.join(out_dir, ERRORS_FILENAME), "w", encoding="utf-8") as f:
+            for page_id, error in errors:
+                f.write(json.dumps({"id": page_id, "error": error}, ensure_ascii=False) + "\n")
+
+    pages = converted + len(errors)
+    return {
+        "pages": pages,
+        "converted": converted,
+        "skipped": skipped,
+        "deleted": deleted,
+        "errors": errors,
+        "seconds": elapsed,
+        "pages_per_second": pages / elapsed if elapsed else 0.0,
+        "slowest": [(page_id, seconds) for seconds, _, page_id in sorted(times, reverse=True)],
+        "link_cache": {kind: {"hits": hits, "misses": misses} for kind, (hits, misses) in link_cache.items()},
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert every page of a wiki dump to HTML.")
+    parser.add_argument(
+        "--json", default=WIKI_PAGES_PATH, help="wiki page dump, JSON or JSON Lines (default: %(default)s)"
+    )
+    parser.add_argument("--out", default=OUTPUT_DIR, help="output directory (default: %(default)s)")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="pages per task (default: %(default)s)")
+    parser.add_argument("--shard-size", type=int, help="write JSON Lines shards of this many pages instead of files")
+    parser.add_argument("--wiki-index", help="wiki_index.bin to link wiki pages to the local <id>.html files")
+    parser.add_argument("--slowest", type=int, default=10, help="slowest pages to report (default: %(default)s)")
+    parser.add_argument("--force", action="store_true", help="convert every page, even those unchanged since last time")
+    args = parser.parse_args()
+
+    stats = convert_dump(
+        args.json, args.out, args.workers, args.chunk_size, args.shard_size, args.wiki_index, args.slowest, args.force
+    )
+    print(f"Converted {stats['converted']}/{stats['pages']} pages into '{args.out}'", end=" ")
+    print(f"in {stats['seconds']:.1f} s ({stats['pages_per_second']:.0f} pages/s)")
+    if stats["skipped"] or stats["deleted"]:
+        print(f"{stats['skipped']} pages unchanged since the last build, {stats['deleted']} deleted")
+    hit_rates = [
+        f"{kind} {counts['hits'] / (counts['hits'] + counts['misses']):.0%} of {counts['hits'] + counts['misses']}"
+        for kind, counts in stats["link_cache"].items()
+        if counts["hits"] + counts["misses"]
+    ]
+    if hit_rates:
+        print(f"Link cache hit rates: {', '.join(hit_rates)} lookups")
+    if stats["slowest"]:
+        print("Slowest pages:")
+        for page_id, seconds in stats["slowest"]:
+            print(f"  {page_id}: {seconds * 1000:.1f} ms")
+    if stats["errors"]:
+        print(f"{len(stats['errors'])} pages failed (see '{os.path.join(args.out, ERRORS_FILENAME)}'):")
+        for page_id, error in stats["errors"][:10]:
+            print(f"  {page_id}: {error}")
@@ -0,0 +1,1084 @@
+"""
+Rough timings for the converter.
+
+Pages are read from wiki_pages.json when it exists, otherwise a synthetic page
+built from SAMPLE_DTEXT is used so the numbers can still be compared.
+
+    python bench.py tokenize --ids 43047 5655 46211
+    python bench.py differential --repeat 200
+    python bench.py normalize
+    python bench.py links
+    python bench.py idlinks
+    python bench.py parse
+    python bench.py reparse
+    python bench.py import
+    python bench.py wikiindex
+    python bench.py nodes
+    python bench.py flat
+    python bench.py spans
+    python bench.py render
+    python bench.py stream
+    python bench.py pipeline
+    python bench.py fragments
+    python bench.py dump
+    python bench.py dumpindex
+    python bench.py batch
+    python bench.py astformat
+    python bench.py incremental
+    python bench.py server
+    python bench.py fetch
+"""
+
+import asyncio
+import html
+import http.client
+import io
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from id_link_map import ID_LINK_MAP, register_id_links
+from main import (
+    HTML_TAG_MAP,
+    LINK_PATTERNS,
+    IdLinkPattern,
+    clear_link_caches,
+    iter_node_tree,
+    iter_parse_dtext,
+    iter_wrap_list_items,
+    link_cache_info,
+    load_dtext_input,
+    normalize_dtext,
+    parse_dtext_to_ast,
+    text_node,
+    tokenize_dtext,
+    transform_text_links,
+)
+from batch_convert import convert_dump
+from binary_ast import load_binary, save_binary
+from danbooru_fetch import DanbooruClient, iter_fetch
+from dtext_convert import convert, convert_to
+from dump_index import WikiDump
+from flat_ast import FlatAst, parse_flat
+from nodes import parse_nodes
+from render_server import RenderServer
+from reparse import BLOCK_CUTS, reparse
+from html_template import CSS_CONTENT, generate_full_html
+from to_html import FragmentCache, ast_to_html, render_to
+from wiki_dump import find_wiki_page
+from wiki_index import WikiIndex, normalize_wiki_title, write_wiki_index
+
+# Roughly shaped like a tag group page: a TOC expand, headers, list runs and a table.
+SAMPLE_DTEXT = (
+    '[See [[Tag Groups]].]\r\n\r\n[expand=Table of Contents]\r\n* 1. "About":#dtext-about\r\n'
+    '* 2. "Colors":#dtext-colors\r\n[/expand]\r\n\r\n'
+    "h4#about. About\r\n\r\nTags which describe the [b]background[/b] of posts, see post #1234 or @evazion.\r\n\r\n"
+    + "* [[aqua background]] ([[aqua]])\r\n** [i][[light blue background]][/i]\r\n" * 20
+    + '[table]\r\n[thead][tr][th]Tag[/th][th]Notes[/th][/tr][/thead]\r\n[tbody]\r\n'
+    + '<tr><td align="center">{{blue_background}}</td><td>https://danbooru.donmai.us [br] [tn]note[/tn]</td></tr>\r\n'
+    * 10
+    + "[/tbody]\r\n[/table]\r\n[hr]\r\n"
+) * 25
+
+# Tags whose attribute runs over many other tags, each about 128 KB. Scanning them must stay
+# linear, like the separate sweeps are.
+ADVERSARIAL_DTEXT = (
+    ("td-run", "[td " * 32000 + "]"),
+    ("b=-run", "[b=" * 42666 + "]"),
+    ("mixed-run", "[b=x [br] [td [hr]\nh4. x " * 5000 + "]"),
+)
+
+
+def legacy_tokens(dtext):
+    """
+    The previous tokenizer: five separate sweeps merged by sorting on offset, then filtered the way
+    the old parser loop skipped tokens (rest of a header line, body of a code block).
+    """
+    patterns = (
+        ("header", re.compile(r"^(h[123456])(#[\w-]+)?\.\s*(.*?)(?=\s*$|\n|$)", re.MULTILINE)),
+        ("tag", re.compile(r"\[(/?)(b|i|u|s|tn|spoilers|code|nodtext|expand|quote)(?:=([^\]]+))?\]")),
+        ("table_tag", re.compile(r"\[(/?)(table|thead|tbody|tr|td|th|col|colgroup)(\s+[^\]]+)?\]")),
+        ("br", re.compile(r"\[br\]")),
+        ("hr", re.compile(r"\[hr\]")),
+    )
+    tokens = [(kind, match) for kind, pattern in patterns for match in pattern.finditer(dtext)]
+    tokens.sort(key=lambda x: x[1].start())
+
+    kept = []
+    skip_until = 0
+    for kind, match in tokens:
+        start, end = match.span()
+        if start < skip_until:
+            continue
+        kept.append((kind, match))
+        if kind == "header":
+            line_end = dtext.find("\n", end)
+            skip_until = len(dtext) if line_end == -1 else line_end + 1
+        elif kind == "tag" and match.group(2) in ("code", "nodtext") and not match.group(1):
+            close_pos = dtext.find(f"[/{match.group(2)}]", end)
+            skip_until = len(dtext) if close_pos == -1 else close_pos + len(match.group(2)) + 3
+    return kept
+
+
+def legacy_normalize(dtext):
+    """
+    The previous normalization: swap [code]/[nodtext] blocks for placeholders, run two uncompiled
+    re.sub calls per entry in HTML_TAG_MAP, then put each block back with str.replace.
+    """
+    placeholder_map = {}
+
+    def placeholder_replacer(match):
+        key = f"__PLACEHOLDER_{len(placeholder_map)}__"
+        placeholder_map[key] = match.group(0)
+        return key
+
+    dtext = re.sub(r"(\[(code|nodtext)(?:=[^\]]+)?\].*?\[/\2\])", placeholder_replacer, dtext, flags=re.DOTALL)
+    for html, dtext_equiv in HTML_TAG_MAP.items():
+        dtext = re.sub(rf"<{html}(\s[^>]*)?>", f"[{dtext_equiv}]", dtext, flags=re.IGNORECASE)
+        dtext = re.sub(rf"</{html}>", f"[/{dtext_equiv}]", dtext, flags=re.IGNORECASE)
+    for key, original in placeholder_map.items():
+        dtext = dtext.replace(key, original)
+    return dtext
+
+
+def legacy_transform_text_links(text):
+    """
+    The previous link pass: the pattern table rebuilt on every call (including the ID_LINK_MAP
+    alternation), then one full pass over the node list per pattern.
+    """
+    patterns = [(re.compile(pattern.pattern, pattern.flags), transform) for _, pattern, transform in LINK_PATTERNS[:-1]]
+    patterns.append(
+        (
+            re.compile(r"\b(" + "|".join(map(re.escape, ID_LINK_MAP.keys())) + r")\s*#(\d+)(/p(\d+))?\b"),
+            LINK_PATTERNS[-1][2],
+        )
+    )
+    nodes = [text_node(text)]
+    for pattern, transform in patterns:
+        new_nodes = []
+        for node in nodes:
+            if node["type"] != "text":
+                new_nodes.append(node)
+                continue
+            t = node["content"]
+            pos = 0
+            for match in pattern.finditer(t):
+                start, end = match.span()
+                if start > pos:
+                    new_nodes.append(text_node(t[pos:start]))
+                new_nodes.append(transform(match))
+                pos = end
+            if pos < len(t):
+                new_nodes.append(text_node(t[pos:]))
+        nodes = new_nodes
+    return nodes
+
+
+def legacy_render_with_attrs(tag, node):
+    attrs = node.get("attrs", {})
+    attr_html = " ".join(f'{k}="{html.escape(v)}"' for k, v in attrs.items())
+    inner_html = legacy_ast_to_html(node.get("children", []))
+    if attr_html:
+        return f"<{tag} {attr_html}>{inner_html}</{tag}>"
+    else:
+        return f"<{tag}>{inner_html}</{tag}>"
+
+
+def legacy_ast_to_html(ast):
+    """The previous renderer: recursive, with tag_map rebuilt and the children joined into a string at every level."""
+    html_parts = []
+
+    tag_map = {
+        "b": "strong",
+        "i": "em",
+        "u": "u",
+        "s": "s",
+        "tn": "small",
+        "spoilers": "span class='spoiler'",
+        "h1": "h1",
+        "h2": "h2",
+        "h3": "h3",
+        "h4": "h4",
+        "h5": "h5",
+        "h6": "h6",
+        # "code" and "nodtext" are handled separately below.
+    }
+
+    for node in ast:
+        node_type = node.get("type")
+        if node_type == "text":
+            # Split by newlines and insert <br>
+            # html_parts.append(node["content"])
+            # todo: not done
+            lines = node["content"].split("\n")
+            for i, line in enumerate(lines):
+                if i > 0:
+                    html_parts.append("<br>")
+                html_parts.append(line)
+
+        elif node_type == "code":
+            inner = node.get("content") or legacy_ast_to_html(node.get("children", []))
+            cleaned = inner.strip()  # stripping leading/trailing whitespace/newlines, could be done in dtext2ast but eh
+
+            if "\n" in cleaned:  # Make codeblock if node_type code content has newlines
+                html_parts.append(f"<pre>{html.escape(cleaned)}</pre>")
+            else:
+                html_parts.append(f"<code>{html.escape(cleaned)}</code>")
+
+        elif node_type == "linebreak":
+            html_parts.append("<br>")
+        elif node_type == "horizon":
+            html_parts.append("<hr>")
+
+        elif node_type in tag_map:
+            tag = tag_map[node_type]
+            inner_html = legacy_ast_to_html(node.get("children", []))
+
+            if node_type.startswith("h") and node_type[1:].isdigit():  # h1–h6
+                # Extract heading text to use as ID
+                text_content = "".join(
+                    child["content"] for child in node.get("children", []) if child["type"] == "text"
+                )
+                header_id = "dtext-" + text_content.strip().replace(" ", "-").lower()
+                html_parts.append(f'<{tag} id="{html.escape(header_id)}">{inner_html}</{tag}>')
+
+            elif " " in tag:
+                tag_name, attrs = tag.split(" ", 1)
+                html_parts.append(f"<{tag_name} {attrs}>{inner_html}</{tag_name}>")
+
+            else:
+                html_parts.append(f"<{tag}>{inner_html}</{tag}>")
+
+        elif node_type == "nodtext":
+            inner = node.get("content") or legacy_ast_to_html(node.get("children", []))
+            html_parts.append(f"<span>{html.escape(inner)}</span>")
+
+        elif node_type == "a":
+            # For a link node, we expect an "attrs" dictionary with a "href" attribute and text children.
+            attrs = node.get("attrs", {})
+            href = attrs.get("href", "#")
+            inner_html = legacy_ast_to_html(node.get("children", []))
+            if node.get("missing"):
+                # Wiki link to a page the local mirror doesn't have (see main.use_wiki_index)
+                html_parts.append(f'<a class="dtext-wiki-does-not-exist" href="{href}">{inner_html}</a>')
+            else:
+                html_parts.append(f'<a href="{href}">{inner_html}</a>')
+        elif node_type == "expand":
+            title = html.escape(node.get("title", "Show"))
+            inner_html = legacy_ast_to_html(node.get("children", []))
+            html_parts.append(
+                f'<details><summary>{title}</summary><div class="expander-content">{inner_html}</div></details>'
+            )
+        elif node_type == "ul":
+            inner_html = legacy_ast_to_html(node.get("children", []))
+            html_parts.append(f"<ul>{inner_html}</ul>")
+        elif node_type == "li":
+            inner_html = legacy_ast_to_html(node.get("children", []))
+            html_parts.append(f"<li>{inner_html}</li>")
+        elif node_type == "quote":
+            inner_html = legacy_ast_to_html(node.get("children", []))
+            html_parts.append(f"<blockquote>{inner_html}</blockquote>")
+
+        elif node_type in {"table", "thead", "tbody", "tr", "colgroup", "td", "th", "col"}:
+            html_parts.append(legacy_render_with_attrs(node_type, node))
+
+        else:
+            # Unknown node type; fallback to rendering its children
+            inner_html = legacy_ast_to_html(node.get("children", []))
+            html_parts.append(inner_html)
+
+    return "".join(html_parts)
+
+
+# What random_dtext strings together: tags in DText and HTML form, attributes holding "[" or running
+# over lines, headers, list markers, code blocks, link syntaxes and stray brackets.
+DTEXT_FRAGMENTS = (
+    *("[b]", "[/b]", "<b>", "</b>", '<STRONG class="x">', "</strong>", "[i]", "[/i]", "<em>", "</em>"),
+    *("[u]", "[/u]", "[s]", "[/s]", "[tn]", "[/tn]", "<spoiler>", "</spoiler>", "[spoilers]", "[/spoilers]"),
+    *("[code]", "[/code]", "<code>", "</code>", "[code=ruby]"),
+    *("[nodtext]", "[/nodtext]", "<nodtext>", "</nodtext>"),
+    *("h4. ", "h2#sec-a. ", "h1.", "h7. ", "\n", "\r\n", "\n\n", "* ", "** ", "*** ", "*x", " * "),
+    *("[[wiki page]]", "[[Foo (bar)|Baz]]", "[[page#Sect]]", "[[a|]]", "{{tag_a tag_b}}", "{{x|Y}}", "{{x| }}"),
+    *("@user", "<@other>", "post #12", "topic #3/p2", "mod action #5", "BUR #1", "pixiv #99", "issue#4"),
+    *("https://x.com/a", "<https://y.org/b>", '"t":[/x]', '"h":[#dtext-a]', '"ext":https://w.org/z'),
+    *('"id":#dtext-id', "[M](https://m.io)", "[https://r.io](R)", "[url]https://u.io[/url]"),
+    "[url=https://v.io]V[/url]",
+    *("[expand=T]", "[expand]", "[/expand]", "<expand>", "</expand>", "[quote]", "[/quote]", "<quote>", "</quote>"),
+    *("[table]", "[/table]", '<table class="striped">', "</table>", "[thead]", "[/thead]", "[tbody]", "[/tbody]"),
+    *("[tr]", "[/tr]", '<tr align="center">', "[td]", "[/td]", '<td align="right" colspan="2">', "</td>"),
+    *("[th]", "[/th]", "[col]", "[colgroup]", "[/colgroup]", "<col>", "[br]", "<br>", "<br/>", "[hr]", "<hr>"),
+    *("text ", "more words ", " ", "  ", "\t", "[b=[i]]", "[expand=See [hr]]", "[td=[br]", "[b=", "[td ", "[expand="),
+    *("<", ">", "[", "]", '"', "#", "/p3", "<unknown>", "</tr>", "[quote=x]", "h3#a. [b]x[/b]", "* h4. hi"),
+)
+
+
+def random_dtext(rng, pieces):
+    """A document of `pieces` random DTEXT_FRAGMENTS; with a seeded `rng`, the same one every run."""
+    return "".join(rng.choice(DTEXT_FRAGMENTS) for _ in range(pieces))
+
+
+def text_runs(dtext):
+    """The text node contents process_ast_links is handed for a page."""
+    runs = []
+
+    def walk(nodes):
+        for node in nodes:
+            if node["type"] == "text":
+                runs.append(node["content"])
+            elif "children" in node:
+                walk(node["children"])
+
+    walk(iter_wrap_list_items(iter_node_tree(normalize_dtext(dtext))))
+    return runs
+
+
+def best_of(func, *args, repeat=20):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def load_pages(ids):
+    pages = []
+    for page_id in ids:
+        try:
+            pages.append((str(page_id), load_dtext_input(source="json", target_id=page_id)))
+        except (FileNotFoundError, ValueError):
+            pass
+    return pages or [("synthetic", SAMPLE_DTEXT)]
+
+
+def bench_tokenize(pages, repeat):
+    print(f"{'page':>10} {'bytes':>9} {'5 sweeps MB/s':>14} {'1 pass MB/s':>12} {'speedup':>8}")
+    for name, dtext in list(pages) + list(ADVERSARIAL_DTEXT):
+        legacy = [(kind, match.span()) for kind, match in legacy_tokens(dtext)]
+        single = [(kind, (start, end)) for kind, start, end, _ in tokenize_dtext(dtext)]
+        assert legacy == single, f"token streams differ on {name}"
+
+        size = len(dtext.encode("utf-8"))
+        old = best_of(lambda d: [match.span() for _, match in legacy_tokens(d)], dtext, repeat=repeat)
+        new = best_of(lambda d: [(start, end) for _, start, end, _ in tokenize_dtext(d)], dtext, repeat=repeat)
+        print(f"{name:>10} {size:>9} {size / old / 1e6:>14.2f} {size / new / 1e6:>12.2f} {old / new:>7.2f}x")
+
+
+def bench_differential(pages, repeat):
+    """
+    Check the current code against the legacy_* implementations above, on the pages and on
+    250 * `repeat` random documents (seeded, so a failure comes back on the next run): tokens, before
+    and after normalization, normalized text, link nodes and HTML, plus the HTML of the streamed
+    and TextSpan parses against the plain one.
+    """
+    rng = random.Random(0)
+    documents = [dtext for _, dtext in pages] + [random_dtext(rng, rng.randint(1, 60)) for _ in range(250 * repeat)]
+    start = time.perf_counter()
+    for number, dtext in enumerate(documents):
+        where = f"document {number}: {dtext[:200]!r}"
+        normalized = normalize_dtext(dtext)
+        assert legacy_normalize(dtext) == normalized, f"normalized text differs on {where}"
+        for text in (dtext, normalized):
+            legacy = [(kind, match.span()) for kind, match in legacy_tokens(text)]
+            tokens = [(kind, (start, end)) for kind, start, end, _ in tokenize_dtext(text)]
+            assert legacy == tokens, f"tokens differ on {where}"
+        assert legacy_transform_text_links(dtext) == transform_text_links(dtext), f"link nodes differ on {where}"
+
+        ast = parse_dtext_to_ast(dtext)
+        expected = ast_to_html(ast)
+        assert legacy_ast_to_html(ast) == expected, f"HTML differs on {where}"
+        stream = io.StringIO()
+        render_to(stream, iter_parse_dtext(dtext), full_page=False)
+        assert stream.getvalue() == expected, f"streamed HTML differs on {where}"
+        assert ast_to_html(parse_dtext_to_ast(dtext, spans=True)) == expected, f"TextSpan HTML differs on {where}"
+    print(f"{len(documents)} documents match the legacy code in {time.perf_counter() - start:.1f} s")
+
+
+def bench_normalize(pages, repeat):
+    print(f"{'page':>10} {'bytes':>9} {'44 subs MB/s':>13} {'1 pass MB/s':>12} {'speedup':>8}")
+    for name, dtext in pages:
+        assert legacy_normalize(dtext) == normalize_dtext(dtext), f"normalized text differs on {name}"
+
+        size = len(dtext.encode("utf-8"))
+        old = best_of(legacy_normalize, dtext, repeat=repeat)
+        new = best_of(normalize_dtext, dtext, repeat=repeat)
+        print(f"{name:>10} {size:>9} {size / old / 1e6:>13.2f} {size / new / 1e6:>12.2f} {old / new:>7.2f}x")
+
+
+def bench_links(pages, repeat):
+    print(f"{'page':>10} {'runs':>7} {'13 passes ms':>13} {'1 scan ms':>10} {'speedup':>8}")
+    for name, dtext in pages:
+        runs = text_runs(dtext)
+        for run in runs:
+            assert legacy_transform_text_links(run) == transform_text_links(run), f"link nodes differ on {name}"
+
+        old = best_of(lambda texts: [legacy_transform_text_links(t) for t in texts], runs, repeat=repeat)
+        new = best_of(lambda texts: [transform_text_links(t) for t in texts], runs, repeat=repeat)
+        print(f"{name:>10} {len(runs):>7} {old * 1000:>13.2f} {new * 1000:>10.2f} {old / new:>7.2f}x")
+
+
+def bench_idlinks(pages, repeat):
+    """Time ID shorthand links ("post #1234") as ID_LINK_MAP grows, against the old regex alternation."""
+    text = "\n".join(text_runs(pages[0][1]))
+    print(f"{'keys':>6} {'matches':>8} {'alternation ms':>15} {'index ms':>9} {'speedup':>8}")
+    builtin = len(ID_LINK_MAP)
+    for size in (builtin, 300, 3000):
+        register_id_links({f"site{number}": f"https://example.com/{number}/" for number in range(size - builtin)})
+        alternation = re.compile(r"\b(" + "|".join(map(re.escape, ID_LINK_MAP.keys())) + r")\s*#(\d+)(/p(\d+))?\b")
+        index = IdLinkPattern()
+        expected = [(match.span(), *match.group(1, 2, 4)) for match in alternation.finditer(text)]
+        found = [(match.span(), match.group(1), match.group(2), match.group(4)) for match in index.finditer(text)]
+        assert expected == found, f"ID links differ with {size} keys"
+
+        old = best_of(lambda t: list(alternation.finditer(t)), text, repeat=repeat)
+        new = best_of(lambda t: list(index.finditer(t)), text, repeat=repeat)
+        print(f"{len(ID_LINK_MAP):>6} {len(found):>8} {old * 1000:>15.2f} {new * 1000:>9.2f} {old / new:>7.2f}x")
+
+
+def bench_parse(pages, repeat):
+    clear_link_caches()
+    print(f"{'page':>10} {'bytes':>9} {'ms':>8} {'MB/s':>7}")
+    for name, dtext in pages:
+        size = len(dtext.encode("utf-8"))
+        elapsed = best_of(parse_dtext_to_ast, dtext, repeat=repeat)
+        print(f"{name:>10} {size:>9} {elapsed * 1000:>8.2f} {size / elapsed / 1e6:>7.2f}")
+
+    # Every repeat after the first is all hits, so count a single pass over the pages.
+    clear_link_caches()
+    for _, dtext in pages:
+        parse_dtext_to_ast(dtext)
+    for kind, info in link_cache_info().items():
+        lookups = info.hits + info.misses
+        hit_rate = info.hits / lookups if lookups else 0
+        print(f"{kind} links: {info.hits} hits, {info.misses} misses ({hit_rate:.0%}), {info.currsize} cached")
+
+
+def bench_reparse(pages, repeat):
+    """
+    Type one character in the middle of each page and compare a full parse with reparse: the first
+    reparse of a page, which scans the old text for its cuts, and the ones after it in a run of edits.
+    """
+    header = f"{'page':>10} {'bytes':>9} {'blocks':>7} {'parsed':>7} {'full ms':>8} {'first ms':>9} {'next ms':>8}"
+    print(f"{header} {'speedup':>8}")
+    # Without top-level headers a page is one block, so reparse should cost about a full parse.
+    no_headers = re.sub(r"(?m)^h([123456])", r"H\1", pages[0][1])
+    for name, dtext in [*pages, ("no-headers", no_headers)]:
+        old_ast = parse_dtext_to_ast(dtext)
+        middle = len(dtext) // 2
+        edited = dtext[:middle] + "x" + dtext[middle:]
+        stats = {}
+        assert reparse(dtext, old_ast, edited, stats) == parse_dtext_to_ast(edited), f"reparse differs on {name}"
+
+        size = len(dtext.encode("utf-8"))
+        full = best_of(parse_dtext_to_ast, edited, repeat=repeat)
+        first = best_of(lambda text: BLOCK_CUTS.clear() or reparse(text, old_ast, edited), dtext, repeat=repeat)
+        incremental = best_of(reparse, dtext, old_ast, edited, repeat=repeat)
+        blocks = stats["reused"] + stats["parsed"]
+        timings = f"{full * 1000:>8.2f} {first * 1000:>9.2f} {incremental * 1000:>8.2f} {full / incremental:>7.2f}x"
+        print(f"{name:>10} {size:>9} {blocks:>7} {stats['parsed']:>7} {timings}")
+
+
+# Modules `import dtext_convert` must not load.
+IMPORTED_ON_DEMAND = ("argparse", "binary_ast", "dump_index", "wiki_dump", "wiki_index", "mmap")
+
+
+def bench_import(pages, repeat):
+    """Time `import dtext_convert` in fresh interpreters and fail if it is over IMPORT_BUDGET_MS."""
+    from dtext_convert import IMPORT_BUDGET_MS
+
+    # argparse alone costs about 15 ms, so the tools only import it under `if __name__ == "__main__"`;
+    # the dump, index and binary AST code is imported by the functions that read and write those files.
+    script = (
+        "import sys, time; start = time.perf_counter(); import dtext_convert; "
+        "print((time.perf_counter() - start) * 1000); "
+        f"loaded = sorted(set({IMPORTED_ON_DEMAND!r}) & set(sys.modules)); "
+        "assert not loaded, f'imported by dtext_convert: {loaded}'"
+    )
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    timings = sorted(
+        float(subprocess.run([sys.executable, "-c", script], cwd=script_dir, capture_output=True, check=True).stdout)
+        for _ in range(repeat)
+    )
+    median = timings[len(timings) // 2]
+    print(f"import dtext_convert: best {timings[0]:.2f} ms, median {median:.2f} ms (budget {IMPORT_BUDGET_MS} ms)")
+    if median > IMPORT_BUDGET_MS:
+        raise SystemExit(f"import time over budget: {median:.2f} ms > {IMPORT_BUDGET_MS} ms")
+
+
+def bench_wikiindex(pages, repeat):
+    """Build, open and query a wiki title index with as many titles as the real site has."""
+    titles = [f"synthetic page {number}" for number in range(200_000)]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_path = os.path.join(temp_dir, "wiki_index.bin")
+        start = time.perf_counter()
+        write_wiki_index(({"id": number, "title": title} for number, title in enumerate(titles)), index_path)
+        built = time.perf_counter() - start
+
+        opened = best_of(lambda path: WikiIndex(path).close(), index_path, repeat=repeat)
+        index = WikiIndex(index_path)
+        probes = [normalize_wiki_title(title) for title in titles[::20]] + [f"missing_{n}" for n in range(10_000)]
+        looked_up = best_of(lambda keys: [index.get(key) for key in keys], probes, repeat=repeat)
+        index.close()
+
+        size = os.path.getsize(index_path)
+        print(f"{len(titles)} titles: built in {built * 1000:.0f} ms, {size / 1e6:.1f} MB on disk")
+        print(f"open: {opened * 1000:.3f} ms, lookup: {looked_up / len(probes) * 1e6:.2f} us (half of them misses)")
+
+
+def count_nodes(ast):
+    return sum(1 + count_nodes(node.get("children", [])) for node in ast)
+
+
+def traced_size(build, *args):
+    """Bytes still allocated by build(*args) once it returns, i.e. the size of what it built."""
+    tracemalloc.start()
+    result = build(*args)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, result
+
+
+def bench_nodes(pages, repeat):
+    """Dict nodes against the __slots__ nodes in nodes.py: memory held by the tree, parse and render times."""
+    print(f"{'page':>10} {'nodes':>7} {'dict B/node':>12} {'slots B/node':>13} {'parse ms':>17} {'render ms':>17}")
+    for name, dtext in pages:
+        dict_size, ast = traced_size(parse_dtext_to_ast, dtext)
+        slots_size, tree = traced_size(parse_nodes, dtext)
+        assert ast_to_html(ast) == ast_to_html(tree), f"rendered HTML differs on {name}"
+        count = count_nodes(ast)
+
+        parse_dict = best_of(parse_dtext_to_ast, dtext, repeat=repeat)
+        parse_slots = best_of(parse_nodes, dtext, repeat=repeat)
+        render_dict = best_of(ast_to_html, ast, repeat=repeat)
+        render_slots = best_of(ast_to_html, tree, repeat=repeat)
+        parse_ms = f"{parse_dict * 1000:.2f}/{parse_slots * 1000:.2f}"
+        render_ms = f"{render_dict * 1000:.2f}/{render_slots * 1000:.2f}"
+        per_node = f"{dict_size / count:>12.0f} {slots_size / count:>13.0f}"
+        print(f"{name:>10} {count:>7} {per_node} {parse_ms:>17} {render_ms:>17}")
+    print("parse and render columns are dict/slots")
+
+
+def bench_flat(pages, repeat):
+    """Memory for keeping every page's AST around: dict nodes, __slots__ nodes and one FlatAst."""
+    dict_size, asts = traced_size(lambda: [parse_dtext_to_ast(dtext) for _, dtext in pages])
+    slots_size, _ = traced_size(lambda: [parse_nodes(dtext) for _, dtext in pages])
+    flat_size, (flat, documents) = traced_size(
+        lambda: (lambda flat: (flat, [parse_flat(dtext, flat)[1] for _, dtext in pages]))(FlatAst())
+    )
+    for (name, _), ast, document in zip(pages, asts, documents):
+        assert flat.to_dict(document) == ast, f"flat AST differs on {name}"
+        assert ast_to_html(flat.nodes(document)) == ast_to_html(ast), f"rendered HTML differs on {name}"
+    # Empty content, first in a fresh FlatAst and at the end of the pool.
+    for dtext in ("[code][/code]", "[code][/code]\r\n\r\ntext [code][/code]"):
+        ast = parse_dtext_to_ast(dtext)
+        for empty in (FlatAst(), flat):
+            document = empty.add(ast)
+            assert empty.to_dict(document) == ast and ast_to_html(empty.nodes(document)) == ast_to_html(ast), dtext
+    # The link pass run as blocks are added, and every row's parent.
+    linked = FlatAst()
+    for (name, dtext), ast in zip(pages, asts):
+        document = linked.add(iter_wrap_list_items(iter_node_tree(normalize_dtext(dtext))), links=True)
+        assert linked.to_dict(document) == ast, f"flat AST with links=True differs on {name}"
+    for index in range(len(flat)):
+        assert all(flat.parent(child) == index for child in flat.children(index))
+    assert all(flat.parent(document) == -1 for document in documents)
+
+    count = sum(count_nodes(ast) for ast in asts)
+    print(f"{len(pages)} pages, {count} nodes")
+    print(f"{'form':>6} {'bytes':>10} {'B/node':>7}")
+    for form, size in (("dict", dict_size), ("slots", slots_size), ("flat", flat_size)):
+        print(f"{form:>6} {size:>10} {size / count:>7.0f}")
+
+    render_dict = best_of(lambda: [ast_to_html(ast) for ast in asts], repeat=repeat)
+    render_flat = best_of(lambda: [ast_to_html(flat.nodes(document)) for document in documents], repeat=repeat)
+    print(f"render: {render_dict * 1000:.2f} ms from dicts, {render_flat * 1000:.2f} ms from flat views")
+
+
+def bench_spans(pages, repeat):
+    """Text nodes as copied strings against TextSpan nodes: memory held by the AST, peak memory of parse + render."""
+
+    def convert(dtext, spans):
+        return ast_to_html(parse_dtext_to_ast(dtext, spans=spans))
+
+    print(f"{'page':>10} {'held KB':>15} {'peak KB':>15} {'parse ms':>15} {'convert ms':>15}")
+    for name, dtext in pages:
+        ast = parse_dtext_to_ast(dtext)
+        tree = parse_dtext_to_ast(dtext, spans=True)
+        assert ast_to_html(ast) == ast_to_html(tree), f"rendered HTML differs on {name}"
+
+        held = [traced_size(parse_dtext_to_ast, dtext, spans)[0] for spans in (False, True)]
+        peak = []
+        for spans in (False, True):
+            tracemalloc.start()
+            convert(dtext, spans)
+            peak.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        parse = [best_of(parse_dtext_to_ast, dtext, spans, repeat=repeat) for spans in (False, True)]
+        total = [best_of(convert, dtext, spans, repeat=repeat) for spans in (False, True)]
+
+        held_kb = f"{held[0] / 1024:.0f}/{held[1] / 1024:.0f}"
+        peak_kb = f"{peak[0] / 1024:.0f}/{peak[1] / 1024:.0f}"
+        parse_ms = f"{parse[0] * 1000:.2f}/{parse[1] * 1000:.2f}"
+        total_ms = f"{total[0] * 1000:.2f}/{total[1] * 1000:.2f}"
+        print(f"{name:>10} {held_kb:>15} {peak_kb:>15} {parse_ms:>15} {total_ms:>15}")
+    print("columns are strings/spans; held includes the normalized document the spans point into")
+
+
+def bench_render(pages, repeat):
+    """The recursive renderer against the iterative one in to_html.py, in MB of HTML out per second."""
+    print(f"{'page':>10} {'html bytes':>11} {'recursive MB/s':>15} {'iterative MB/s':>15} {'speedup':>8}")
+    for name, dtext in pages:
+        ast = parse_dtext_to_ast(dtext)
+        output = ast_to_html(ast)
+        assert legacy_ast_to_html(ast) == output, f"rendered HTML differs on {name}"
+
+        size = len(output.encode("utf-8"))
+        old = best_of(legacy_ast_to_html, ast, repeat=repeat)
+        new = best_of(ast_to_html, ast, repeat=repeat)
+        print(f"{name:>10} {size:>11} {size / old / 1e6:>15.2f} {size / new / 1e6:>15.2f} {old / new:>7.2f}x")
+
+
+def bench_stream(pages, repeat):
+    """
+    Writing a full page to a file as one string against render_to: peak memory on top of the AST,
+    and how long after the call the first byte is written (from DText, via convert/convert_to).
+    """
+
+    class FirstWrite:
+        def __init__(self, f):
+            self.f = f
+            self.first = None
+
+        def write(self, text):
+            if self.first is None:
+                self.first = time.perf_counter()
+            return self.f.write(text)
+
+    def write_string(f, ast):
+        f.write(generate_full_html(ast_to_html(ast), embed_css=True, css_content=CSS_CONTENT))
+
+    def first_byte(write, dtext):
+        best = float("inf")
+        with open(os.devnull, "w", encoding="utf-8") as f:
+            for _ in range(repeat):
+                stream = FirstWrite(f)
+                start = time.perf_counter()
+                write(stream, dtext)
+                best = min(best, stream.first - start)
+        return best
+
+    print(f"{'page':>12} {'html KB':>8} {'string peak KB':>15} {'stream peak KB':>15} {'first byte ms':>15}")
+    for name, dtext in pages + [(f"{name}x8", dtext * 8) for name, dtext in pages]:
+        ast = parse_dtext_to_ast(dtext)
+        peaks = []
+        with tempfile.TemporaryFile("w+", encoding="utf-8") as f:
+            for write in (write_string, render_to):
+                f.seek(0)
+                f.truncate()
+                tracemalloc.start()
+                write(f, ast)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            size = f.tell()
+
+        string_first = first_byte(lambda f, d: f.write(convert(d, full_page=True)), dtext)
+        stream_first = first_byte(convert_to, dtext)
+        first_ms = f"{string_first * 1000:.1f}/{stream_first * 1000:.2f}"
+        print(f"{name:>12} {size / 1024:>8.0f} {peaks[0] / 1024:>15.0f} {peaks[1] / 1024:>15.0f} {first_ms:>15}")
+    print("first byte column is string/stream")
+
+
+def bench_pipeline(pages, repeat):
+    """
+    DText to output.html end to end: the old way through ast_output.json (indented dump, load,
+    render, template) against handing the parser's blocks straight to render_to.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ast_path = os.path.join(temp_dir, "ast_output.json")
+        html_path = os.path.join(temp_dir, "output.html")
+
+        def through_json(dtext):
+            with open(ast_path, "w", encoding="utf-8") as f:
+                json.dump(parse_dtext_to_ast(dtext), f, indent=2, ensure_ascii=False)
+            with open(ast_path, "r", encoding="utf-8") as f:
+                ast = json.load(f)
+            with open(html_path, "w", encoding="utf-8") as f:
+                f.write(generate_full_html(ast_to_html(ast), embed_css=True, css_content=CSS_CONTENT))
+
+        def direct(dtext):
+            with open(html_path, "w", encoding="utf-8") as f:
+                render_to(f, iter_parse_dtext(dtext))
+
+        print(f"{'page':>10} {'via json ms':>12} {'direct ms':>10} {'saved ms':>9} {'speedup':>8}")
+        for name, dtext in pages:
+            through_json(dtext)
+            with open(html_path, "r", encoding="utf-8", newline="") as f:
+                expected = f.read()
+            direct(dtext)
+            with open(html_path, "r", encoding="utf-8", newline="") as f:
+                assert f.read() == expected, f"output.html differs on {name}"
+
+            old = best_of(through_json, dtext, repeat=repeat)
+            new = best_of(direct, dtext, repeat=repeat)
+            print(f"{name:>10} {old * 1000:>12.2f} {new * 1000:>10.2f} {(old - new) * 1000:>9.2f} {old / new:>7.2f}x")
+
+
+def bench_fragments(pages, repeat):
+    """
+    Render a batch of pages that share most of their blocks (each page eight times, with a different
+    first line) with and without a FragmentCache, and what hashing costs the parser.
+    """
+    batch = [f"Revision {number}\r\n{dtext}" for _, dtext in pages for number in range(8)]
+    plain = [parse_dtext_to_ast(dtext) for dtext in batch]
+    hashed = [parse_dtext_to_ast(dtext, hashes=True) for dtext in batch]
+
+    parse_plain = best_of(lambda: [parse_dtext_to_ast(dtext) for dtext in batch], repeat=repeat)
+    parse_hashed = best_of(lambda: [parse_dtext_to_ast(dtext, hashes=True) for dtext in batch], repeat=repeat)
+    print(f"{len(batch)} pages: parse {parse_plain * 1000:.2f} ms, {parse_hashed * 1000:.2f} ms with hashes")
+
+    def render_batch(cache):
+        return [ast_to_html(ast, cache) for ast in (plain if cache is None else hashed)]
+
+    expected = render_batch(None)
+    cache = FragmentCache()
+    assert render_batch(cache) == expected, "cached HTML differs"
+    # Subtrees whose hashes collide must not share a fragment.
+    quote, spoilers = parse_dtext_to_ast("[quote]a[/quote][spoilers]b[/spoilers][quote]ab[/quote]", hashes=True)[:2]
+    spoilers["hash"] = quote["hash"]
+    longer = parse_dtext_to_ast("[quote]ab[/quote]", hashes=True)[0]
+    longer["hash"] = quote["hash"]
+    for forged in (spoilers, longer):
+        assert ast_to_html([quote, forged], FragmentCache()) == ast_to_html([quote, forged]), "colliding hashes"
+    info = cache.info()
+    print(f"cache: {info['hits']} hits, {info['misses']} misses ({info['hit_rate']:.0%}), ", end="")
+    print(f"{info['fragments']} fragments, {info['chars']} chars, {info['bytes'] / 1024:.0f} KB")
+
+    # A fresh cache each time, so every run pays for the first render of each fragment.
+    uncached = best_of(render_batch, None, repeat=repeat)
+    cached = best_of(lambda: render_batch(FragmentCache()), repeat=repeat)
+    print(f"render: {uncached * 1000:.2f} ms, {cached * 1000:.2f} ms with a cache ({uncached / cached:.2f}x)")
+
+
+def synthetic_dump(body, count):
+    return [{"id": number, "title": f"page {number}", "body": body} for number in range(count)]
+
+
+def bench_dump(pages, repeat):
+    """
+    Look up pages near the start, middle and end of a synthetic 20k page dump: json.load of the
+    whole file and a scan, against find_wiki_page on the same dump as JSON and as JSON Lines.
+    """
+    body = pages[0][1][:2000]
+    count = 20_000
+    records = synthetic_dump(body, count)
+
+    def load_and_scan(path, page_id):
+        with open(path, "r", encoding="utf-8") as f:
+            return next(page for page in json.load(f) if page["id"] == page_id)
+
+    def peak(func, *args):
+        tracemalloc.start()
+        func(*args)
+        size = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return size
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        json_path = os.path.join(temp_dir, "wiki_pages.json")
+        lines_path = os.path.join(temp_dir, "wiki_pages.jsonl")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(records, f)
+        with open(lines_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+        del records
+        print(f"{count} pages, {os.path.getsize(json_path) / 1e6:.1f} MB")
+
+        ways = (("json.load", load_and_scan, json_path), ("stream", find_wiki_page, json_path))
+        ways += (("stream jsonl", find_wiki_page, lines_path),)
+        print(f"{'':>13} {'first ms':>9} {'middle ms':>10} {'last ms':>9} {'peak KB':>9}")
+        for label, find, path in ways:
+            assert find(path, count - 1)["body"] == body
+            times = [best_of(find, path, page_id, repeat=min(repeat, 3)) for page_id in (0, count // 2, count - 1)]
+            print(f"{label:>13} {times[0] * 1000:>9.2f} {times[1] * 1000:>10.2f} {times[2] * 1000:>9.2f}", end=" ")
+            print(f"{peak(find, path, count - 1) / 1024:>9.0f}")
+
+
+def bench_dumpindex(pages, repeat):
+    """Random page lookups in a synthetic 20k page dump through its sidecar index, against a streaming scan."""
+    body = pages[0][1][:2000]
+    count = 20_000
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dump_path = os.path.join(temp_dir, "wiki_pages.json")
+        with open(dump_path, "w", encoding="utf-8") as f:
+            json.dump(synthetic_dump(body, count), f)
+
+        start = time.perf_counter()
+        WikiDump(dump_path).close()
+        built = time.perf_counter() - start
+        size = os.path.getsize(dump_path + ".idx")
+        print(f"{count} pages, {os.path.getsize(dump_path) / 1e6:.1f} MB dump")
+        print(f"index: built in {built * 1000:.0f} ms, {size / 1e6:.2f} MB")
+
+        opened = best_of(lambda: WikiDump(dump_path).close(), repeat=repeat)
+        dump = WikiDump(dump_path)
+        ids = list(range(0, count, 97))
+        titles = [f"page {number}" for number in ids]
+        assert all(dump.get(number)["body"] == body for number in ids)
+        assert all(dump.get_by_title(title)["id"] == number for title, number in zip(titles, ids))
+        by_id = best_of(lambda: [dump.get(number) for number in ids], repeat=repeat)
+        by_title = best_of(lambda: [dump.get_by_title(title) for title in titles], repeat=repeat)
+        dump.close()
+        scan = best_of(find_wiki_page, dump_path, count // 2, repeat=min(repeat, 3))
+        print(f"open: {opened * 1000:.3f} ms (index up to date)")
+        print(f"lookup: {by_id / len(ids) * 1e6:.1f} us by id, {by_title / len(ids) * 1e6:.1f} us by title")
+        print(f"streaming scan to the middle page: {scan * 1000:.1f} ms")
+
+
+def bench_batch(pages, repeat):
+    """Pages per second converting a synthetic 400 page dump with 1, 2, 4, ... workers, up to the CPU count."""
+    bodies = [dtext for _, dtext in pages]
+    records = [{"id": number, "body": bodies[number % len(bodies)][: 2000 + number * 37]} for number in range(400)]
+    cpus = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] < cpus:
+        counts.append(min(counts[-1] * 2, cpus))
+    if cpus == 1:
+        counts.append(2)  # still exercise the pool
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dump_path = os.path.join(temp_dir, "wiki_pages.json")
+        with open(dump_path, "w", encoding="utf-8") as f:
+            json.dump(records, f)
+
+        print(f"{len(records)} pages, {cpus} CPUs")
+        print(f"{'workers':>8} {'pages/s':>8} {'scaling':>8}")
+        base = None
+        for workers in counts:
+            out_dir = os.path.join(temp_dir, f"shards-{workers}")
+            stats = convert_dump(dump_path, out_dir, workers=workers, shard_size=100)
+            assert stats["converted"] == len(records), stats["errors"][:3]
+            base = base or stats["pages_per_second"]
+            print(f"{workers:>8} {stats['pages_per_second']:>8.0f} {stats['pages_per_second'] / base:>7.2f}x")
+
+
+def bench_astformat(pages, repeat):
+    """Size, save and load time of each page's AST as ast_output.json (indented, as main.py writes it) and in binary."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        json_path = os.path.join(temp_dir, "ast_output.json")
+        bin_path = os.path.join(temp_dir, "ast_output.bin")
+
+        def save_json(ast):
+            with open(json_path, "w", encoding="utf-8") as f:
+                json.dump(ast, f, indent=2, ensure_ascii=False)
+
+        def load_json():
+            with open(json_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+
+        print(f"{'':>10} {'json KB':>9} {'bin KB':>8} {'smaller':>8} {'save ms':>16} {'load ms':>16}")
+        for name, dtext in pages:
+            ast = parse_dtext_to_ast(dtext)
+            save_json(ast)
+            save_binary(ast, bin_path)
+            assert load_binary(bin_path) == load_json() == ast, f"AST differs after a round trip on {name}"
+
+            json_size = os.path.getsize(json_path)
+            bin_size = os.path.getsize(bin_path)
+            saves = [best_of(save_json, ast, repeat=repeat), best_of(save_binary, ast, bin_path, repeat=repeat)]
+            loads = [best_of(load_json, repeat=repeat), best_of(load_binary, bin_path, repeat=repeat)]
+            print(f"{name:>10} {json_size / 1024:>9.1f} {bin_size / 1024:>8.1f} {json_size / bin_size:>7.1f}x", end=" ")
+            print(f"{saves[0] * 1000:>7.2f} /{saves[1] * 1000:>7.2f} {loads[0] * 1000:>7.2f} /{loads[1] * 1000:>7.2f}")
+
+
+def bench_incremental(pages, repeat):
+    """
+    A full batch build of a synthetic 1000 page dump, then rebuilds with none, 1% and 10% of the
+    pages changed, and after adding a page that 10 of them link to to the wiki index.
+    """
+    bodies = [dtext for _, dtext in pages]
+    records = [
+        {"id": number, "title": f"page {number}", "body": bodies[number % len(bodies)][: 2000 + number * 37]}
+        for number in range(1000)
+    ]
+    for record in records[-10:]:
+        record["body"] += "\r\nSee [[page 1000]]."
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dump_path = os.path.join(temp_dir, "wiki_pages.json")
+        index_path = os.path.join(temp_dir, "wiki_index.bin")
+        out_dir = os.path.join(temp_dir, "html")
+        write_wiki_index(records, index_path)
+
+        def build(changed, force=False, converted=None):
+            for record in records[:changed]:
+                record["body"] += "\r\nEdited."
+            with open(dump_path, "w", encoding="utf-8") as f:
+                json.dump(records, f)
+            start = time.perf_counter()
+            stats = convert_dump(dump_path, out_dir, workers=1, wiki_index_path=index_path, force=force)
+            assert stats["converted"] == (changed if converted is None else converted) and not stats["errors"], stats
+            return time.perf_counter() - start
+
+        full = build(len(records), force=True)
+        print(f"{len(records)} pages: full build {full:.2f} s")
+        for changed in (0, len(records) // 100, len(records) // 10):
+            seconds = build(changed)
+            print(f"rebuild with {changed:>4} pages changed: {seconds:.2f} s ({full / seconds:.0f}x faster)")
+        write_wiki_index(records + [{"id": 1000, "title": "page 1000"}], index_path)
+        seconds = build(0, converted=10)
+        print(f"rebuild after a wiki index update: {seconds:.2f} s ({full / seconds:.0f}x faster), 10 pages converted")
+
+
+def bench_server(pages, repeat):
+    """
+    Latency of a preview: a fresh `python` process per render, against POSTing to a running
+    render_server on localhost with text it has not seen (an edit) and text it has (cached).
+    """
+    server = RenderServer(workers=1)
+    loop = asyncio.new_event_loop()
+    listener = loop.run_until_complete(server.start(port=0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    connection = http.client.HTTPConnection("127.0.0.1", listener.sockets[0].getsockname()[1])
+
+    def post(dtext):
+        connection.request("POST", "/render", body=dtext.encode("utf-8"))
+        response = connection.getresponse()
+        assert response.status == 200, response.read()
+        return response.read().decode("utf-8")
+
+    script = "import sys, dtext_convert; sys.stdout.write(dtext_convert.convert(sys.stdin.read()))"
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def spawn(dtext):
+        command = [sys.executable, "-c", script]
+        run = subprocess.run(command, cwd=script_dir, input=dtext.encode("utf-8"), stdout=subprocess.PIPE, check=True)
+        return run.stdout.decode("utf-8")
+
+    try:
+        print(f"{'page':>10} {'process ms':>11} {'edited ms':>10} {'cached ms':>10}")
+        for name, dtext in pages:
+            assert post(dtext) == spawn(dtext) == convert(dtext), f"HTML differs on {name}"
+            edits = iter(range(1_000_000))
+            process = best_of(spawn, dtext, repeat=min(repeat, 5))
+            edited = best_of(lambda: post(f"{dtext}\r\nEdit {next(edits)}."), repeat=repeat)
+            cached = best_of(post, dtext, repeat=repeat)
+            print(f"{name:>10} {process * 1000:>11.2f} {edited * 1000:>10.2f} {cached * 1000:>10.2f}")
+    finally:
+        connection.close()
+
+        async def shut_down():
+            # The connection's task ends on its own once it sees the client has closed it.
+            listener.close()
+            await asyncio.gather(*(task for task in asyncio.all_tasks() if task is not asyncio.current_task()))
+
+        asyncio.run_coroutine_threadsafe(shut_down(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+        server.close()
+
+
+class StandInApi(BaseHTTPRequestHandler):
+    """Enough of the Danbooru API for danbooru_fetch: GET /<resource>.json with limit, page=a<id> and search[id]."""
+
+    protocol_version = "HTTP/1.1"
+    latency = 0.02  # seconds per request, roughly a round trip to the real site
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        records = self.server.records
+        low, high = map(int, query.get("search[id]", f"0..{len(records)}").split(".."))
+        limit = int(query["limit"])
+        after = int(query["page"][1:]) if query["page"].startswith("a") else None
+        if after is None:
+            page = records[max(0, min(high, int(query["page"][1:]) - 1) - limit) : high][::-1]
+        else:
+            page = records[max(low, after + 1) - 1 : high][:limit]
+        body = json.dumps(page).encode("utf-8")
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_fetch(pages, repeat):
+    """
+    Records per second fetching 20k comments from a local stand-in API that takes 20 ms per
+    request, with 1, 2, 4 and 8 keep-alive connections and no rate limit.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInApi)
+    server.daemon_threads = True
+    server.records = [{"id": number, "body": f"Comment {number}"} for number in range(1, 20_001)]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        print(f"{'connections':>11} {'requests':>9} {'records/s':>10} {'speedup':>8}")
+        base = None
+        for connections in (1, 2, 4, 8):
+            client = DanbooruClient(base_url, connections, rate=0)
+            start = time.perf_counter()
+            ids = [record["id"] for record in iter_fetch(client, "comments", limit=200, connections=connections)]
+            rate = len(ids) / (time.perf_counter() - start)
+            client.close()
+            assert sorted(ids) == list(range(1, 20_001)), "records missing or repeated"
+            base = base or rate
+            print(f"{connections:>11} {client.requests:>9} {rate:>10.0f} {rate / base:>7.2f}x")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+BENCHMARKS = {
+    "tokenize": bench_tokenize,
+    "differential": bench_differential,
+    "normalize": bench_normalize,
+    "links": bench_links,
+    "idlinks": bench_idlinks,
+    "parse": bench_parse,
+    "reparse": bench_reparse,
+    "import": bench_import,
+    "wikiindex": bench_wikiindex,
+    "nodes": bench_nodes,
+    "flat": bench_flat,
+    "spans": bench_spans,
+    "render": bench_render,
+    "stream": bench_stream,
+    "pipeline": bench_pipeline,
+    "fragments": bench_fragments,
+    "dump": bench_dump,
+    "dumpindex": bench_dumpindex,
+    "batch": bench_batch,
+    "astformat": bench_astformat,
+    "incremental": bench_incremental,
+    "server": bench_server,
+    "fetch": bench_fetch,
+}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Time parts of the DText converter.")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--ids", type=int, nargs="*", default=[43047, 5655, 46211])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](load_pages(args.ids), args.repeat)
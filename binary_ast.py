@@ -0,0 +1,212 @@
+"""
+Compact binary form of the AST, as an alternative to ast_output.json.
+
+    data = dumps(ast)
+    loads(data) == ast  # same nodes, same key order
+
+Layout (version 1):
+
+    magic b"DTAST", version byte
+    varint: size of the integer stream in bytes, then the stream (unsigned LEB128 varints)
+    the string pool: every distinct string once, as one UTF-8 blob
+
+The integer stream holds the character length of each pooled string, the shape table and the
+nodes. A shape is a node type plus its keys in order, each with how its value is stored: a pool
+index, a list of child nodes, an attrs dict, a zigzag int, or a constant kept in the shape
+itself (the type, and True/False/None values). A node is its shape number followed by its
+values, with children in pre-order, so type names and key layouts are stored once per file.
+"""
+
+MAGIC = b"DTAST"
+VERSION = 1
+
+# How a value is stored.
+CONST = 0  # in the shape
+STRING = 1  # pool index
+NODES = 2  # count, then the nodes
+ATTRS = 3  # count, then key and value pool indexes
+INT = 4  # zigzag varint
+
+CONSTANTS = (None, False, True)  # constants other than strings, by code; strings are code 3 + pool index
+
+
+def encode_varint(value, out):
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varints(data):
+    values = []
+    append = values.append
+    value = shift = 0
+    for byte in data:
+        if byte < 0x80:
+            if shift:
+                append(value | byte << shift)
+                value = shift = 0
+            else:
+                append(byte)
+        else:
+            value |= (byte & 0x7F) << shift
+            shift += 7
+    if shift:
+        raise ValueError("truncated varint in binary AST")
+    return values
+
+
+def value_kind(key, value):
+    if key == "type" or value is None or isinstance(value, bool):
+        return CONST
+    if isinstance(value, str):
+        return STRING
+    if isinstance(value, list):
+        return NODES
+    if isinstance(value, dict):
+        return ATTRS
+    if isinstance(value, int):
+        return INT
+    raise TypeError(f"can't store a {type(value).__name__} in a binary AST")
+
+
+def dumps(ast):
+    """Encode an AST (a list of dict nodes; typed nodes are converted with to_dict()) to bytes."""
+    strings = {}
+    shapes = {}
+    stream = []  # the node part of the integer stream
+
+    def intern(text):
+        index = strings.get(text)
+        if index is None:
+            index = strings[text] = len(strings)
+        return index
+
+    def add_nodes(nodes):
+        stream.append(len(nodes))
+        for node in nodes:
+            if not isinstance(node, dict):
+                node = node.to_dict()
+            shape = []
+            for key, value in node.items():
+                kind = value_kind(key, value)
+                shape.append((key, kind, value) if kind == CONST else (key, kind))
+            shape = tuple(shape)
+            index = shapes.get(shape)
+            if index is None:
+                index = shapes[shape] = len(shapes)
+            stream.append(index)
+            for field in shape:
+                kind = field[1]
+                if kind == STRING:
+                    stream.append(intern(node[field[0]]))
+                elif kind == NODES:
+                    add_nodes(node[field[0]])
+                elif kind == ATTRS:
+                    attrs = node[field[0]]
+                    stream.append(len(attrs))
+                    for attr, attr_value in attrs.items():
+                        stream.append(intern(attr))
+                        stream.append(intern(attr_value))
+                elif kind == INT:
+                    value = node[field[0]]
+                    stream.append(value * 2 if value >= 0 else -value * 2 - 1)
+
+    add_nodes(ast)
+
+    table = [len(shapes)]
+    for shape in shapes:
+        table.append(len(shape))
+        for field in shape:
+            table += intern(field[0]), field[1]
+            if field[1] == CONST:
+                const = field[2]
+                table.append(3 + intern(const) if isinstance(const, str) else CONSTANTS.index(const))
+
+    pool = list(strings)
+    ints = bytearray()
+    encode_varint(len(pool), ints)
+    for text in pool:
+        encode_varint(len(text), ints)
+    for value in table:
+        encode_varint(value, ints)
+    for value in stream:
+        encode_varint(value, ints)
+
+    size = bytearray()
+    encode_varint(len(ints), size)
+    return MAGIC + bytes((VERSION,)) + size + ints + "".join(pool).encode("utf-8")
+
+
+def loads(data):
+    """Decode bytes written by dumps() back to the dict AST."""
+    if data[: len(MAGIC)] != MAGIC:
+        raise ValueError("not a binary AST")
+    if data[len(MAGIC)] != VERSION:
+        raise ValueError(f"unsupported binary AST version {data[len(MAGIC)]}")
+    pos = len(MAGIC) + 1
+    size = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        size |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            break
+    ints = decode_varints(data[pos : pos + size])
+    text = data[pos + size :].decode("utf-8")
+    next_int = iter(ints).__next__
+
+    strings = []
+    start = 0
+    for _ in range(next_int()):
+        end = start + next_int()
+        strings.append(text[start:end])
+        start = end
+
+    # Each shape becomes (the node's constant part, [(key, kind)] for the values that follow it).
+    shapes = []
+    for _ in range(next_int()):
+        template = {}
+        fields = []
+        for _ in range(next_int()):
+            key = strings[next_int()]
+            kind = next_int()
+            if kind == CONST:
+                code = next_int()
+                template[key] = CONSTANTS[code] if code < 3 else strings[code - 3]
+            else:
+                # Keep the key's place in the node; the value is filled in below.
+                template[key] = None
+                fields.append((key, kind))
+        shapes.append((template, fields))
+
+    def read_nodes():
+        nodes = []
+        for _ in range(next_int()):
+            template, fields = shapes[next_int()]
+            node = template.copy()
+            for key, kind in fields:
+                if kind == STRING:
+                    node[key] = strings[next_int()]
+                elif kind == NODES:
+                    node[key] = read_nodes()
+                elif kind == ATTRS:
+                    node[key] = {strings[next_int()]: strings[next_int()] for _ in range(next_int())}
+                else:
+                    value = next_int()
+                    node[key] = value >> 1 if value & 1 == 0 else -(value >> 1) - 1
+            nodes.append(node)
+        return nodes
+
+    return read_nodes()
+
+
+def save_binary(ast, path):
+    with open(path, "wb") as f:
+        f.write(dumps(ast))
+
+
+def load_binary(path):
+    with open(path, "rb") as f:
+        return loads(f.read())
@@ -0,0 +1,316 @@
+"""
+Fetch DText from the Danbooru API: wiki pages, forum posts or comments.
+
+    python danbooru_fetch.py wiki_pages --out wiki_pages.jsonl  # a dump the other tools can read
+    python danbooru_fetch.py wiki_pages --convert html          # straight into batch_convert
+    python danbooru_fetch.py comments --state fetch_state.json  # run again to resume
+    python danbooru_fetch.py forum_posts --base-url http://127.0.0.1:3000 --connections 2 --rate 5
+
+Records are fetched in pages of up to PAGE_LIMIT with id cursors (page=a<id>). The ids are split
+into one range per connection, and the ranges are walked at the same time over keep-alive
+connections, with at most `rate` requests per second in all. Connection errors, 429s and 5xx
+responses are retried with exponential backoff, or after the server's Retry-After.
+
+With --state, each range's cursor is saved once the records before it have been handed on, so
+an interrupted fetch picks up where it stopped. Records of the page in progress at the time may
+be written twice. With --convert, the records are handed to the converter, and the ones it was
+still working on when interrupted are not fetched again: a fetch without --state fills such
+gaps, and only costs requests for the pages already converted (see batch_convert.py).
+"""
+
+import base64
+import http.client
+import json
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+from batch_convert import convert_pages
+
+BASE_URL = "https://danbooru.donmai.us"
+RESOURCES = ("wiki_pages", "forum_posts", "comments")
+PAGE_LIMIT = 1000  # the most the API returns per request
+CONNECTIONS = 4
+REQUESTS_PER_SECOND = 5.0
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 1.0  # before the first retry; doubled for each one after it
+TIMEOUT = 30
+USER_AGENT = "dtext-convert"
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+MAX_ID = 2**31 - 1
+
+
+class FetchError(Exception):
+    pass
+
+
+class RateLimiter:
+    """Spaces out the calls to wait(), from any thread, to at most `rate` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def retry_after(headers):
+    """Seconds asked for by a Retry-After header, or None (dates aren't supported)."""
+    value = headers.get("Retry-After", "")
+    return float(value) if value.strip().isdigit() else None
+
+
+class DanbooruClient:
+    """GET requests to the API over a pool of up to `connections` keep-alive connections."""
+
+    def __init__(
+        self,
+        base_url=BASE_URL,
+        connections=CONNECTIONS,
+        rate=REQUESTS_PER_SECOND,
+        login=None,
+        api_key=None,
+        max_retries=MAX_RETRIES,
+        backoff=BACKOFF_SECONDS,
+    ):
+        url = urlsplit(base_url)
+        if url.scheme not in ("http", "https") or not url.netloc:
+            raise ValueError(f"not an http(s) URL: {base_url!r}")
+        self.base_url = base_url
+        self.connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self.host = url.netloc
+        self.prefix = url.path.rstrip("/")
+        self.headers = {"User-Agent": USER_AGENT, "Accept": "application/json"}
+        if login and api_key:
+            credentials = base64.b64encode(f"{login}:{api_key}".encode("utf-8")).decode("ascii")
+            self.headers["Authorization"] = f"Basic {credentials}"
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limiter = RateLimiter(rate)
+        self.slots = threading.BoundedSemaphore(connections)
+        self.idle = queue.LifoQueue()
+        self.requests = 0
+        self.retries = 0
+        self.counts_lock = threading.Lock()
+
+    def get(self, path, params=None):
+        """The decoded JSON response to GET `path` (like "/wiki_pages.json"), retrying failures."""
+        target = self.prefix + path + (f"?{urlencode(params)}" if params else "")
+        for attempt in range(self.max_retries + 1):
+            self.limiter.wait()
+            with self.counts_lock:
+                self.requests += 1
+            delay = None
+            try:
+                status, headers, body = self.request(target)
+            except (OSError, http.client.HTTPException) as e:
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if status == 200:
+                    return json.loads(body)
+                error = f"HTTP {status}: {body[:200].decode('utf-8', 'replace')}"
+                if status not in RETRY_STATUSES:
+                    raise FetchError(f"GET {target}: {error}")
+                delay = retry_after(headers)
+            if attempt == self.max_retries:
+                raise FetchError(f"GET {target} failed {attempt + 1} times, last with {error}")
+            with self.counts_lock:
+                self.retries += 1
+            if delay is None:
+                # Jittered, so the connections that failed together don't all retry together.
+                delay = self.backoff * 2**attempt * random.uniform(0.5, 1.0)
+            time.sleep(delay)
+
+    def request(self, target):
+        """(status, headers, body) of one GET, on an idle connection if there is one."""
+        with self.slots:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                return self.exchange(self.connection_class(self.host, timeout=TIMEOUT), target)
+            try:
+                return self.exchange(connection, target)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server closed the connection while it was idle: not a failed request.
+                return self.exchange(self.connection_class(self.host, timeout=TIMEOUT), target)
+
+    def exchange(self, connection, target):
+        try:
+            connection.request("GET", target, headers=self.headers)
+            response = connection.getresponse()
+            body = response.read()
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.idle.put(connection)
+        return response.status, response.headers, body
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def newest_id(client, resource):
+    records = client.get(f"/{resource}.json", {"limit": 1, "page": f"b{MAX_ID}"})
+    return records[0]["id"] if records else 0
+
+
+def split_ids(newest, parts):
+    """Up to `parts` ranges [low, high] that cover ids 1 to `newest`."""
+    size = max(1, -(-newest // parts))
+    return [[low, min(low + size - 1, newest)] for low in range(1, newest + 1, size)]
+
+
+class FetchState:
+    """
+    The cursors of a fetch, saved in a JSON file: for each resource, its id ranges as
+    [low, high, last id handed on, done]. Kept per base URL, so a stand-in server's
+    state doesn't resume a fetch from the real site.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            self.data = {}
+
+    def ranges(self, base_url, resource):
+        return self.data.get(base_url, {}).get(resource)
+
+    def set_ranges(self, base_url, resource, ranges):
+        self.data.setdefault(base_url, {})[resource] = ranges
+
+    def save(self):
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.data, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def iter_fetch(client, resource, state=None, limit=PAGE_LIMIT, connections=CONNECTIONS):
+    """
+    Yield every record of `resource` ("wiki_pages", "forum_posts" or "comments"), page by page as
+    they arrive, walking up to `connections` id ranges at a time. If `state` (a FetchState) has
+    ranges for it, the fetch resumes from their cursors; they are updated as records are yielded.
+    """
+    ranges = state.ranges(client.base_url, resource) if state is not None else None
+    if ranges is None:
+        ranges = [[low, high, low - 1, False] for low, high in split_ids(newest_id(client, resource), connections)]
+        if state is not None:
+            state.set_ranges(client.base_url, resource, ranges)
+            state.save()
+
+    results = queue.Queue(maxsize=2 * connections)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def walk(index):
+        low, high, after, _ = ranges[index]
+        try:
+            while not stop.is_set():
+                params = {"limit": limit, "page": f"a{after}", "search[id]": f"{low}..{high}"}
+                records = client.get(f"/{resource}.json", params)
+                records.sort(key=lambda record: record["id"])
+                if records:
+                    after = records[-1]["id"]
+                done = len(records) < limit or after >= high
+                put((index, records, after, done, None))
+                if done:
+                    return
+        except Exception as e:
+            put((index, None, None, True, e))
+
+    pending = [index for index, (_, _, _, done) in enumerate(ranges) if not done]
+    pool = ThreadPoolExecutor(max(1, min(connections, len(pending))))
+    try:
+        for index in pending:
+            pool.submit(walk, index)
+        while pending:
+            index, records, after, done, error = results.get()
+            if error is not None:
+                raise error
+            yield from records
+            ranges[index][2:] = after, done
+            if state is not None:
+                state.save()
+            if done:
+                pending.remove(index)
+    finally:
+        stop.set()
+        pool.shutdown(cancel_futures=True)
+
+
+def write_json_lines(records, path, append=False):
+    """Write `records` to `path` as JSON Lines, the dump format wiki_dump.py reads; returns how many."""
+    count = 0
+    with open(path, "a" if append else "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+            # Flushed per record, so the file is complete up to the cursors in the state file.
+            f.flush()
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fetch wiki pages, forum posts or comments from the Danbooru API.")
+    parser.add_argument("resource", choices=RESOURCES)
+    parser.add_argument("--base-url", default=BASE_URL, help="API to fetch from (default: %(default)s)")
+    parser.add_argument("--login", default=os.environ.get("DANBOORU_LOGIN"), help="default: $DANBOORU_LOGIN")
+    parser.add_argument("--api-key", default=os.environ.get("DANBOORU_API_KEY"), help="default: $DANBOORU_API_KEY")
+    parser.add_argument("--connections", type=int, default=CONNECTIONS, help="default: %(default)s")
+    parser.add_argument(
+        "--rate", type=float, default=REQUESTS_PER_SECOND, help="requests per second (default: %(default)s)"
+    )
+    parser.add_argument("--limit", type=int, default=PAGE_LIMIT, help="records per request (default: %(default)s)")
+    parser.add_argument("--state", help="file to save the cursors in, to resume an interrupted fetch")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--out", help="JSON Lines file to write (default: <resource>.jsonl)")
+    output.add_argument("--convert", metavar="DIR", help="convert the records to HTML in DIR with batch_convert")
+    parser.add_argument("--workers", type=int, help="worker processes for --convert (default: one per CPU)")
+    args = parser.parse_args()
+
+    client = DanbooruClient(args.base_url, args.connections, args.rate, args.login, args.api_key)
+    state = FetchState(args.state) if args.state else None
+    resuming = state is not None and state.ranges(client.base_url, args.resource) is not None
+    start = time.perf_counter()
+    try:
+        records = iter_fetch(client, args.resource, state, args.limit, args.connections)
+        if args.convert:
+            stats = convert_pages(records, args.convert, args.workers, complete=not resuming)
+            print(f"Converted {stats['converted']} records into '{args.convert}'", end=" ")
+            print(f"({stats['skipped']} unchanged, {len(stats['errors'])} failed)")
+        else:
+            out_path = args.out or f"{args.resource}.jsonl"
+            count = write_json_lines(records, out_path, append=resuming)
+            print(f"Wrote {count} records to '{out_path}'")
+    finally:
+        client.close()
+    print(f"{client.requests} requests ({client.retries} retried) in {time.perf_counter() - start:.1f} s")
@@ -0,0 +1,81 @@
+"""
+Library entry points for the DText converter.
+
+    from dtext_convert import convert
+    html = convert("h4. Hello [b]world[/b]")
+
+Importing this module does no work: nothing is read or written, and the parser's regex
+tables are compiled the first time they are used. `python bench.py import` checks the
+import time against IMPORT_BUDGET_MS.
+"""
+
+from html_template import CSS_CONTENT, generate_full_html
+from id_link_map import register_id_links
+from main import clear_link_caches, iter_parse_dtext, link_cache_info, parse_dtext_to_ast, use_wiki_index
+from reparse import reparse
+from to_html import FragmentCache, ast_to_html, render_to
+
+__all__ = [
+    "parse",
+    "iter_parse",
+    "reparse",
+    "render_html",
+    "convert",
+    "iter_convert",
+    "render_to",
+    "convert_to",
+    "FragmentCache",
+    "register_id_links",
+    "link_cache_info",
+    "clear_link_caches",
+    "use_wiki_index",
+]
+
+# Upper bound for `import dtext_convert` in a fresh interpreter, on top of interpreter startup.
+IMPORT_BUDGET_MS = 50
+
+
+def parse(dtext):
+    """Parse a DText string into the AST (a list of node dicts, same as ast_output.json)."""
+    return parse_dtext_to_ast(dtext)
+
+
+def iter_parse(dtext):
+    """Yield the top-level nodes of the AST one at a time, as soon as each block is finished."""
+    return iter_parse_dtext(dtext)
+
+
+def render_html(ast, full_page=False, cache=None):
+    """
+    Render an AST to HTML. By default this is the fragment that goes inside <body>;
+    with full_page=True it is a complete document with the CSS embedded.
+    `cache` (a FragmentCache) is only used for ASTs parsed with hashes=True.
+    """
+    inner_html = ast_to_html(ast, cache)
+    if full_page:
+        return generate_full_html(inner_html, embed_css=True, css_content=CSS_CONTENT)
+    return inner_html
+
+
+def convert(dtext, full_page=False, cache=None):
+    """
+    Parse and render a DText string in one go. Pass the same FragmentCache for a batch of pages
+    to render their shared lists, tables and expands only once.
+    """
+    if cache is None:
+        return render_html(parse(dtext), full_page=full_page)
+    return render_html(parse_dtext_to_ast(dtext, hashes=True), full_page=full_page, cache=cache)
+
+
+def iter_convert(dtext):
+    """Yield the HTML fragment block by block; the pieces joined together equal convert(dtext)."""
+    for block in iter_parse_dtext(dtext):
+        yield ast_to_html([block])
+
+
+def convert_to(stream, dtext, full_page=True, cache=None):
+    """
+    Parse and render a DText string straight into `stream` (see to_html.render_to); blocks are
+    written as they are parsed, so the page is never held as one string.
+    """
+    render_to(stream, iter_parse_dtext(dtext, hashes=cache is not None), full_page=full_page, cache=cache)
@@ -0,0 +1,146 @@
+"""
+Random access to the pages of a wiki dump by id or title.
+
+    python dump_index.py                      # wiki_pages.json -> wiki_pages.json.idx
+
+    dump = WikiDump("wiki_pages.json")  # builds or refreshes the index if needed
+    dump.get(43047)  # -> page dict, or None
+    dump.get_by_title("Help:DText")
+    dump.close()
+
+The index is a sidecar file next to the dump: the byte range of every page's record in the
+dump, sorted by page id, followed by a title table in the wiki_index.py format. The dump is
+mapped with mmap and a lookup decodes only the record it needs. The index stores the dump's
+size and mtime and is rebuilt as soon as either one changes.
+"""
+
+import json
+import mmap
+import os
+import struct
+
+from wiki_dump import WIKI_PAGES_PATH, iter_wiki_pages
+from wiki_index import WikiIndex, normalize_wiki_title, pack_wiki_index, wiki_title_entry
+
+DUMP_INDEX_MAGIC = b"DTDUMP\x00\x01"
+DUMP_HEADER = struct.Struct("<8sqqI")  # magic, dump size, dump mtime (ns), record count
+RECORD = struct.Struct("<qQI")  # page id, byte offset of the record in the dump, byte length
+
+
+def dump_index_path(dump_path):
+    return dump_path + ".idx"
+
+
+def build_dump_index(dump_path=WIKI_PAGES_PATH, index_path=None):
+    """Index every page of the dump by id and title; returns the number of pages indexed."""
+    if index_path is None:
+        index_path = dump_index_path(dump_path)
+    # Taken before reading, so a dump changed while it is indexed gets indexed again next time.
+    stat = os.stat(dump_path)
+
+    ranges = {}
+    titles = {}
+    for page, offset, length in iter_wiki_pages(dump_path, offsets=True):
+        page_id = page.get("id")
+        if not isinstance(page_id, int) or isinstance(page_id, bool):
+            continue
+        # The first record wins, same as a scan with find_wiki_page.
+        ranges.setdefault(page_id, (offset, length))
+        entry = wiki_title_entry(page)
+        if entry is not None:
+            titles[entry[0]] = page_id
+
+    temp_path = index_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(DUMP_HEADER.pack(DUMP_INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, len(ranges)))
+        f.write(b"".join(RECORD.pack(page_id, *ranges[page_id]) for page_id in sorted(ranges)))
+        f.write(pack_wiki_index(titles))
+    os.replace(temp_path, index_path)
+    return len(ranges)
+
+
+def dump_index_is_current(dump_path, index_path):
+    stat = os.stat(dump_path)
+    try:
+        with open(index_path, "rb") as f:
+            header = f.read(DUMP_HEADER.size)
+    except OSError:
+        return False
+    if len(header) < DUMP_HEADER.size:
+        return False
+    magic, size, mtime, _ = DUMP_HEADER.unpack(header)
+    return magic == DUMP_INDEX_MAGIC and size == stat.st_size and mtime == stat.st_mtime_ns
+
+
+class WikiDump:
+    """
+    A wiki dump (JSON array or JSON Lines) opened for lookups by page id or title.
+    The sidecar index is (re)built on opening if it is missing or older than the dump.
+    """
+
+    def __init__(self, dump_path=WIKI_PAGES_PATH, index_path=None):
+        if index_path is None:
+            index_path = dump_index_path(dump_path)
+        if not dump_index_is_current(dump_path, index_path):
+            build_dump_index(dump_path, index_path)
+
+        with open(index_path, "rb") as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _, size, _, self.count = DUMP_HEADER.unpack_from(self.index)
+        self.titles = WikiIndex(index_path, offset=DUMP_HEADER.size + self.count * RECORD.size)
+        # mmap can't map an empty file; an empty dump has no records to slice anyway.
+        self.dump = b""
+        if size:
+            with open(dump_path, "rb") as f:
+                self.dump = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def find(self, page_id):
+        """(byte offset, byte length) of the page's record in the dump, or None."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            entry_id, offset, length = RECORD.unpack_from(self.index, DUMP_HEADER.size + middle * RECORD.size)
+            if entry_id == page_id:
+                return offset, length
+            if entry_id < page_id:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def get(self, page_id, default=None):
+        found = self.find(page_id)
+        if found is None:
+            return default
+        offset, length = found
+        return json.loads(self.dump[offset : offset + length])
+
+    def get_by_title(self, title, default=None):
+        page_id = self.titles.get(normalize_wiki_title(title))
+        if page_id is None:
+            return default
+        return self.get(page_id, default)
+
+    def __contains__(self, page_id):
+        return self.find(page_id) is not None
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.titles.close()
+        self.index.close()
+        if self.dump:
+            self.dump.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the id/title index for random access to a wiki dump.")
+    parser.add_argument("--json", default=WIKI_PAGES_PATH, help="wiki page dump (default: %(default)s)")
+    parser.add_argument("--out", help="index file to write (default: the dump's path + .idx)")
+    args = parser.parse_args()
+
+    count = build_dump_index(args.json, args.out)
+    print(f"Indexed {count} pages in '{args.out or dump_index_path(args.json)}'")
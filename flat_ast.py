@@ -0,0 +1,233 @@
+"""
+Flat, array-backed storage for many ASTs at once, for keeping a whole wiki dump in memory.
+
+    flat = FlatAst()
+    doc = flat.add(parse_dtext_to_ast(dtext))  # or: flat, doc = parse_flat(dtext, flat)
+    html = ast_to_html(flat.nodes(doc))  # the renderer reads the views directly
+    flat.to_dict(doc) == parse_dtext_to_ast(dtext)
+
+Every node is a row in a set of `array` columns: type, key layout, parent, first child,
+next sibling, text span and an index into `extras` for the few nodes with attrs, ids or titles.
+All text (text and code content) goes into one string pool shared by every document,
+and each page hangs off a "document" row. Type names and key layouts are stored once in
+small tables, so the columns take 36 bytes a row; with the pooled text and the extras, the
+bench page comes to about 94 bytes a node (python bench.py flat).
+"""
+
+from array import array
+from bisect import bisect_right
+
+from main import iter_parse_dtext, process_ast_links
+
+DOCUMENT_LAYOUT = ("type", "children")
+# Keys every layout has or that live in columns; anything else goes to `extras`.
+COLUMN_KEYS = frozenset(("type", "children", "content"))
+
+
+class FlatNode:
+    """Read-only view of one row, answering get() and [] like a dict node."""
+
+    __slots__ = ("flat", "index")
+
+    def __init__(self, flat, index):
+        self.flat = flat
+        self.index = index
+
+    def get(self, key, default=None):
+        return self.flat.get(self.index, key, default)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return self.flat.get(self.index, key)
+
+    def __contains__(self, key):
+        return key in self.flat.layouts[self.flat.layout[self.index]]
+
+
+class FlatAst:
+    def __init__(self):
+        self.type_names = []
+        self.type_codes = {}
+        self.layouts = []
+        self.layout_codes = {}
+        self.extra_positions = []  # per layout: {key: position in the row's extras tuple}
+
+        self.types = array("H")
+        self.layout = array("H")
+        self.parents = array("i")
+        self.first_child = array("i")
+        self.next_sibling = array("i")
+        self.text_start = array("q")
+        self.text_end = array("q")
+        self.extra = array("i")
+        self.extras = []
+        self.documents = array("i")
+
+        # The pool is kept in chunks so adding a page never copies the text already there.
+        # Text added since the last read waits in `pending` and becomes one chunk on the next read.
+        self.chunks = []
+        self.chunk_starts = array("q")
+        self.pending = []
+        self.pool_size = 0
+        self.frozen_size = 0
+
+    def __len__(self):
+        return len(self.types)
+
+    def freeze_pending(self):
+        self.chunks.append("".join(self.pending))
+        self.chunk_starts.append(self.frozen_size)
+        self.pending = []
+        self.frozen_size = self.pool_size
+
+    def code_for(self, table, codes, value):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(table)
+            table.append(value)
+            if table is self.layouts:
+                extra_keys = [key for key in value if key not in COLUMN_KEYS]
+                self.extra_positions.append({key: position for position, key in enumerate(extra_keys)})
+        return code
+
+    def new_row(self, node_type, layout, parent, content=None, extra=None):
+        index = len(self.types)
+        self.types.append(self.code_for(self.type_names, self.type_codes, node_type))
+        self.layout.append(self.code_for(self.layouts, self.layout_codes, layout))
+        self.parents.append(parent)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        if content is None:
+            self.text_start.append(0)
+            self.text_end.append(0)
+        else:
+            self.text_start.append(self.pool_size)
+            self.pending.append(content)
+            self.pool_size += len(content)
+            self.text_end.append(self.pool_size)
+        if extra:
+            self.extra.append(len(self.extras))
+            self.extras.append(extra)
+        else:
+            self.extra.append(-1)
+        return index
+
+    def link_children(self, parent, children):
+        previous = -1
+        for child in children:
+            if previous == -1:
+                self.first_child[parent] = child
+            else:
+                self.next_sibling[previous] = child
+            previous = child
+        if previous == -1:
+            self.first_child[parent] = -1
+        else:
+            self.next_sibling[previous] = -1
+
+    def add_node(self, node, parent):
+        """Copy a dict node (and everything under it) into new rows; returns its index."""
+        layout = tuple(node)
+        extra = None
+        if not COLUMN_KEYS.issuperset(layout):
+            # attrs dicts are kept as tuples of items, which take about half the memory.
+            extra = tuple(
+                tuple(value.items()) if key == "attrs" else value
+                for key, value in node.items()
+                if key not in COLUMN_KEYS
+            )
+        index = self.new_row(node["type"], layout, parent, node.get("content"), extra)
+        if "children" in node:
+            self.link_children(index, [self.add_node(child, index) for child in node["children"]])
+        return index
+
+    def add(self, ast, links=False):
+        """
+        Add one document (a dict AST, or any iterable of its top-level nodes); returns the document's index.
+        With links=True the link pass (process_ast_links) runs on each top-level node before it is
+        copied in, for ASTs that come from the tree builder without it. Rows are never rewritten
+        once added, so the pass has to happen here rather than on a stored document.
+        """
+        document = self.new_row("document", DOCUMENT_LAYOUT, -1)
+        self.documents.append(document)
+        if links:
+            ast = (linked for node in ast for linked in process_ast_links([node]))
+        self.link_children(document, [self.add_node(node, document) for node in ast])
+        return document
+
+    def children(self, index):
+        child = self.first_child[index]
+        while child != -1:
+            yield child
+            child = self.next_sibling[child]
+
+    def parent(self, index):
+        """Index of the row's parent: its document for a top-level node, -1 for a document."""
+        return self.parents[index]
+
+    def type(self, index):
+        return self.type_names[self.types[index]]
+
+    def content(self, index):
+        start = self.text_start[index]
+        end = self.text_end[index]
+        if start == end:
+            # Empty content may sit before the first chunk, or at the end of the pool.
+            return ""
+        if end > self.frozen_size:
+            self.freeze_pending()
+        # A text is always inside one chunk.
+        chunk = bisect_right(self.chunk_starts, start) - 1
+        offset = self.chunk_starts[chunk]
+        return self.chunks[chunk][start - offset : end - offset]
+
+    def get(self, index, key, default=None):
+        """Value of a dict-node key for a row: "children" comes back as a list of FlatNode views."""
+        if key == "type":
+            return self.type_names[self.types[index]]
+        if key not in self.layouts[self.layout[index]]:
+            return default
+        if key == "children":
+            return [FlatNode(self, child) for child in self.children(index)]
+        if key == "content":
+            return self.content(index)
+        return self.extra_value(index, key)
+
+    def extra_value(self, index, key):
+        value = self.extras[self.extra[index]][self.extra_positions[self.layout[index]][key]]
+        return dict(value) if key == "attrs" else value
+
+    def node(self, index):
+        return FlatNode(self, index)
+
+    def nodes(self, document):
+        """The top-level nodes of a document, as views the renderer can take in place of the dict AST."""
+        return [FlatNode(self, child) for child in self.children(document)]
+
+    def node_to_dict(self, index):
+        node = {}
+        for key in self.layouts[self.layout[index]]:
+            if key == "type":
+                node["type"] = self.type(index)
+            elif key == "children":
+                node["children"] = [self.node_to_dict(child) for child in self.children(index)]
+            elif key == "content":
+                node["content"] = self.content(index)
+            else:
+                node[key] = self.extra_value(index, key)
+        return node
+
+    def to_dict(self, document):
+        """The dict AST of a document, with the keys in the order the parser wrote them."""
+        return [self.node_to_dict(child) for child in self.children(document)]
+
+
+def parse_flat(dtext, flat=None):
+    """
+    Parse a page into `flat` (a new FlatAst if not given) and return (flat, document index).
+    Blocks are added as the streaming parser finishes them, so the page never exists as a whole dict AST.
+    """
+    if flat is None:
+        flat = FlatAst()
+    return flat, flat.add(iter_parse_dtext(dtext))
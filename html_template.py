@@ -55,6 +55,12 @@ a:hover {
     text-decoration: underline;
 }
 
+/* Wiki links to pages that aren't in the local mirror */
+a.dtext-wiki-does-not-exist {
+    color: #f38ba8;
+    text-decoration: underline dotted;
+}
+
 /* Inline code */
 code {
     background-color: #313244;
@@ -281,17 +287,15 @@ li {
 """
 
 
-def generate_full_html(inner_html, embed_css=True, css_filename="styles.css", css_content=""):
-    """Wrap inner_html with a complete HTML template.
-    If embed_css is True, embeds css_content inside a <style> block.
-    Otherwise, it links an external CSS file with the given css_filename."""
+def generate_html_head(embed_css=True, css_filename="styles.css", css_content=""):
+    """Everything generate_full_html puts before inner_html, for writing a page out in pieces."""
 
     if embed_css:
         head_css = f"<style>\n{css_content.strip()}\n</style>"
     else:
         head_css = f'<link rel="stylesheet" type="text/css" href="{css_filename}">'
 
-    template = f"""<!DOCTYPE html>
+    return f"""<!DOCTYPE html>
 <html lang="en">
   <head>
     <meta charset="UTF-8">
@@ -300,12 +304,23 @@ def generate_full_html(inner_html, embed_css=True, css_filename="styles.css", cs
   </head>
   <body>
     <div class="main-body">
-      {inner_html} 
+      """
+
+
+# Everything generate_full_html puts after inner_html.
+HTML_FOOTER = """ 
         <div class="example-posts">
       </div>
     </div>
   </body>
 </html>
 """
+
+
+def generate_full_html(inner_html, embed_css=True, css_filename="styles.css", css_content=""):
+    """Wrap inner_html with a complete HTML template.
+    If embed_css is True, embeds css_content inside a <style> block.
+    Otherwise, it links an external CSS file with the given css_filename."""
+
     # todo: example posts, implications
-    return template
+    return generate_html_head(embed_css, css_filename, css_content) + inner_html + HTML_FOOTER
@@ -31,3 +31,26 @@ ID_LINK_MAP = {
     "gelbooru": "https://gelbooru.com/index.php?page=post&s=view&id=",
     "yandere": "https://yande.re/post/show/",
 }
+
+
+# Index over ID_LINK_MAP for the ID link recognizer in main.py: a key's text is looked up in the
+# map directly, so only the lengths keys come in and each key's position in the map are needed.
+ID_LINK_KEY_LENGTHS = set()
+ID_LINK_KEY_ORDER = {}
+
+
+def register_id_links(mapping):
+    """
+    Add ID link prefixes (or change their URLs), e.g. register_id_links({"fanbox": "https://www.fanbox.cc/posts/"}).
+    Takes effect for the next text that is parsed; nothing is recompiled.
+    """
+    for key, url in mapping.items():
+        if not key or "#" in key:
+            raise ValueError(f"invalid ID link prefix: {key!r}")
+        ID_LINK_MAP[key] = url
+        # An existing key keeps its place, same as in the dict.
+        ID_LINK_KEY_ORDER.setdefault(key, len(ID_LINK_KEY_ORDER))
+        ID_LINK_KEY_LENGTHS.add(len(key))
+
+
+register_id_links(dict(ID_LINK_MAP))
@@ -1,16 +1,52 @@
+import functools
+import heapq
 import json
 import os
 import re
 
-from id_link_map import ID_LINK_MAP
-from to_html import runa
+from id_link_map import ID_LINK_KEY_LENGTHS, ID_LINK_KEY_ORDER, ID_LINK_MAP
+from nodes import TextSpan, node_to_json
+from to_html import AST_FILES, runa
+
+
+class LazyPattern:
+    """
+    A regex that is compiled the first time it is used, so importing the parser costs nothing.
+    After that the compiled pattern's methods sit on the instance and are looked up directly.
+    """
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __getattr__(self, name):
+        # Only reached for names not on the instance yet, i.e. before the first compile.
+        if name.startswith("__"):
+            raise AttributeError(name)
+        compiled = re.compile(self.pattern, self.flags)
+        for method in ("match", "fullmatch", "search", "finditer", "findall", "sub", "split"):
+            setattr(self, method, getattr(compiled, method))
+        return getattr(compiled, name)
+
+
+LIST_ITEM_PATTERN = LazyPattern(r"^(\*+)\s+(.*)")
+# The same checks for a line given as offsets into a TextSpan's source (match() anchors at pos).
+LIST_ITEM_SPAN_PATTERN = LazyPattern(r"(\*+)\s+(.*)")
+BLANK_SPAN_PATTERN = LazyPattern(r"\s*")
 
 
 def wrap_list_items(ast):
+    return list(iter_wrap_list_items(ast))
+
+
+def iter_wrap_list_items(nodes):
     """
     Converts '* Item', '** Subitem', etc. into nested lists.
     Also handles link transformations within list items properly,
     and preserves all other inline transformations inside list items.
+
+    Yields each top-level node as soon as nothing more can be added to it. A top-level list
+    keeps collecting items (and continuation lines) until a header or the end of the input.
     """
     result = []
     list_stack = []  # Stores tuples of (level, ul_node_reference)
@@ -73,8 +109,41 @@ def wrap_list_items(ast):
         current_li = current_ul["children"][-1]
         current_li.setdefault("children", []).append(node)
 
-    for node in ast:
-        if node["type"] == "text":
+    def inline_span(source, start, end):
+        # Without tags, "<" or "*" in the line, parse_inline_dtext only runs the link pass over it.
+        if not INLINE_MARKUP_PATTERN.search(source, start, end):
+            if not HEADER_PATTERN.match(source, start, end) and not TOKEN_PATTERN.search(source, start, end):
+                return transform_text_links(source[start:end], source, start)
+        return parse_inline_dtext(source[start:end])
+
+    def wrap_span(node):
+        # Same as the loop below for one text node, but lines are offsets into the source; only the lines
+        # that end up as plain text stay spans, list item content goes through parse_inline_dtext as before.
+        source, line_start, end = node.source, node.start, node.end
+        while True:
+            line_end = source.find("\n", line_start, end)
+            if line_end == -1:
+                line_end = end
+            if BLANK_SPAN_PATTERN.fullmatch(source, line_start, line_end):
+                if not list_stack:
+                    result.append(TextSpan(source, line_start, line_end))
+            else:
+                match = LIST_ITEM_SPAN_PATTERN.match(source, line_start, line_end)
+                if match:
+                    push_li_to_stack(len(match.group(1)), inline_span(source, *match.span(2)))
+                elif list_stack:
+                    for pl_node in inline_span(source, line_start, line_end):
+                        append_to_current_li(pl_node)
+                else:
+                    result.append(TextSpan(source, line_start, line_end))
+            if line_end == end:
+                return
+            line_start = line_end + 1
+
+    for node in nodes:
+        if type(node) is TextSpan:
+            wrap_span(node)
+        elif node["type"] == "text":
             lines = node["content"].split("\n")
             for line in lines:
                 stripped = line.strip()
@@ -101,22 +170,19 @@ def wrap_list_items(ast):
                     if stripped == "":  # Re-check stripped for the original continue logic
                         continue
 
-                match = re.match(r"^(\*+)\s+(.*)", line)
+                match = LIST_ITEM_PATTERN.match(line)
                 if match:
                     level = len(match.group(1))
                     raw_content = match.group(2)
-                    # The content of the list item needs to be parsed.
-                    # Calling full parse_dtext_to_ast here can lead to problematic recursion
-                    # if parse_dtext_to_ast itself calls wrap_list_items.
-                    # Assuming parse_dtext_to_ast is designed to handle sub-parsing or
-                    # this is a known part of the existing design.
-                    content_nodes = parse_dtext_to_ast(raw_content)
+                    # The content of the list item needs to be parsed. It is a single line,
+                    # so the lighter inline parser is enough (nested "*" markers still recurse).
+                    content_nodes = parse_inline_dtext(raw_content)
                     push_li_to_stack(level, content_nodes)
                 else:  # Not a list item line
                     if list_stack:
                         # This line is part of the current list item's content
                         # It should be parsed for inline DText.
-                        parsed_line_nodes = parse_dtext_to_ast(line)  # Similar concern as above
+                        parsed_line_nodes = parse_inline_dtext(line)
                         for pl_node in parsed_line_nodes:
                             append_to_current_li(pl_node)
                     else:
@@ -145,10 +211,362 @@ def wrap_list_items(ast):
                 # OR if the current node IS a header,
                 # then append this node to the main result list.
                 result.append(node)
-    return result
+
+        # Everything in result is final except a top-level list that is still open.
+        done = len(result) - 1 if list_stack else len(result)
+        if done > 0:
+            yield from result[:done]
+            del result[:done]
+
+    yield from result
+
+
+def text_node(content):
+    """Wrap plain text into a text node."""
+    return {"type": "text", "content": content}
+
+
+def resolve_url(url):
+    """
+    Return (href, missing) for the URL of a masked link. If it starts with "/", the base URL is
+    prepended; hash links stay relative to the current page. `missing` is set like resolve_wiki_link's.
+    """
+    if url.startswith("/"):
+        # Wiki pages the local mirror has stay local (see use_wiki_index).
+        if WIKI_INDEX is not None and url.startswith("/wiki_pages/"):
+            # Already loaded: it is where the index came from.
+            from wiki_index import normalize_wiki_title
+
+            page, hash_mark, section = url[len("/wiki_pages/") :].partition("#")
+            page = normalize_wiki_title(page)
+            if WIKI_LINKS is not None:
+                WIKI_LINKS.add(page)
+            page_id = WIKI_INDEX.get(page)
+            if page_id is not None:
+                return LOCAL_WIKI_HREF.format(page_id=page_id) + hash_mark + section, False
+            return "https://danbooru.donmai.us" + url, True
+        return "https://danbooru.donmai.us" + url, False
+    return url, False
+
+
+def masked_link_node(m):
+    href, missing = resolve_url(m.group(2))
+    node = {"type": "a", "attrs": {"href": href}, "children": [text_node(m.group(1))]}
+    if missing:
+        node["missing"] = True
+    return node
+
+
+WIKI_QUALIFIER_PATTERN = LazyPattern(r"\s*\([^)]*\)")
+ID_LINK_NUMBER_PATTERN = LazyPattern(r"#(\d+)(/p(\d+))?\b")
+WORD_BOUNDARY_PATTERN = LazyPattern(r"\b")
+
+
+class IdLinkMatch:
+    """Match object for IdLinkPattern, with the groups of the old `\b(post|topic|...)\s*#(\d+)(/p(\d+))?\b` regex."""
+
+    def __init__(self, start, key, number_match):
+        self.start = start
+        self.end = number_match.end()
+        self.groups = (None, key, *number_match.groups())
+
+    def span(self):
+        return self.start, self.end
+
+    def group(self, index):
+        return self.groups[index]
+
+
+class IdLinkPattern:
+    """
+    Finds "post #1234", "topic #1/p2", "mod action #5", ... for every key in ID_LINK_MAP.
+
+    Instead of trying every key at every word boundary, it starts from each "#" followed by a number
+    and looks up the text in front of it in ID_LINK_MAP, once per distinct key length. The work per
+    "#" doesn't grow with the number of keys, and keys added with register_id_links are picked up
+    without rebuilding anything. Matches are the same as the regex alternation would find:
+    the leftmost one, and the earlier key in ID_LINK_MAP when two start at the same place.
+    """
+
+    def finditer(self, text):
+        pos = 0
+        hash_pos = text.find("#")
+        while hash_pos != -1:
+            number_match = ID_LINK_NUMBER_PATTERN.match(text, hash_pos)
+            if number_match:
+                # The key may be followed by whitespace before the "#".
+                key_end = hash_pos
+                while key_end > pos and text[key_end - 1].isspace():
+                    key_end -= 1
+                best = None
+                for end in range(key_end, hash_pos + 1):
+                    for length in ID_LINK_KEY_LENGTHS:
+                        start = end - length
+                        if start < pos or text[start:end] not in ID_LINK_MAP:
+                            continue
+                        candidate = (start, ID_LINK_KEY_ORDER[text[start:end]], text[start:end])
+                        if (best is None or candidate < best) and WORD_BOUNDARY_PATTERN.match(text, start):
+                            best = candidate
+                if best:
+                    yield IdLinkMatch(best[0], best[2], number_match)
+                    pos = number_match.end()
+                    hash_pos = text.find("#", pos)
+                    continue
+            hash_pos = text.find("#", hash_pos + 1)
+
+
+# Link targets repeat a lot (the same tags and wiki pages show up all over tag group pages),
+# so their hrefs are worked out once per process and kept in bounded LRU caches.
+# link_cache_info() reports hits and misses, e.g. at the end of a batch run.
+LINK_CACHE_SIZE = 4096
+
+
+# Set with use_wiki_index() to send wiki links to the local mirror instead of danbooru.donmai.us.
+WIKI_INDEX = None
+LOCAL_WIKI_HREF = "{page_id}.html"
+# Set with record_wiki_links(): the titles wiki links have looked up in WIKI_INDEX.
+WIKI_LINKS = None
+
+
+def use_wiki_index(index, local_href=LOCAL_WIKI_HREF):
+    """
+    Rewrite wiki links to pages in `index` (a wiki_index.WikiIndex) to `local_href`, which is
+    formatted with the page id. Links to pages the index doesn't have are flagged as missing.
+    Pass None to go back to plain danbooru.donmai.us links.
+    """
+    global WIKI_INDEX, LOCAL_WIKI_HREF
+    WIKI_INDEX = index
+    LOCAL_WIKI_HREF = local_href
+    resolve_wiki_link.cache_clear()
+
+
+def record_wiki_links(titles):
+    """
+    Add the title of every page a link looks up in the wiki index from now on to the set `titles`,
+    cached links included, so a caller can tell which index entries its output depends on.
+    Pass None to stop.
+    """
+    global WIKI_LINKS
+    WIKI_LINKS = titles
+
+
+def wiki_link_page(target):
+    """The page of a [[...]] link target as looked up in the wiki index: no section, lowercase, underscores."""
+    return target.strip().split("#")[0].replace(" ", "_").lower()
+
+
+@functools.lru_cache(maxsize=LINK_CACHE_SIZE)
+def resolve_wiki_link(target):
+    """
+    Return (href, page title, missing) for the target of a [[...]] link, e.g. "Kantai Collection (series)#History".
+    The title is what the link shows when it has no custom text: the page name without the section
+    or any "(qualifier)". `missing` is only ever True when a local wiki index is in use.
+    """
+    # Split page#section if exists
+    page_section = target.strip().split("#") + [None]
+    page = wiki_link_page(target)
+    section = ("#dtext-" + page_section[1].lower()) if page_section[1] else ""
+    title = WIKI_QUALIFIER_PATTERN.sub("", target.split("#")[0].strip()).strip()
+
+    if WIKI_INDEX is not None:
+        page_id = WIKI_INDEX.get(page)
+        if page_id is not None:
+            return LOCAL_WIKI_HREF.format(page_id=page_id) + section, title, False
+        return "https://danbooru.donmai.us/wiki_pages/" + page + section, title, True
+    return "https://danbooru.donmai.us/wiki_pages/" + page + section, title, False
+
+
+def wiki_link_node(m):
+    href, page_title, missing = resolve_wiki_link(m.group(1))
+    if WIKI_LINKS is not None and WIKI_INDEX is not None:
+        WIKI_LINKS.add(wiki_link_page(m.group(1)))
+    node = {
+        "type": "a",
+        "attrs": {"href": href},
+        "children": [text_node(m.group(3).strip() if m.group(3) and m.group(3).strip() else page_title)],
+    }
+    if missing:
+        node["missing"] = True
+    return node
+
+
+@functools.lru_cache(maxsize=LINK_CACHE_SIZE)
+def resolve_tag_href(tags):
+    """Search URL for the tags of a {{...}} link."""
+    return "https://danbooru.donmai.us/posts?tags=" + tags.strip().replace(" ", "%20")
+
+
+@functools.lru_cache(maxsize=LINK_CACHE_SIZE)
+def resolve_user_href(name):
+    return "https://danbooru.donmai.us/users?name=" + name
+
+
+def link_cache_info():
+    """Hit/miss counts of the link resolvers, as functools cache_info() tuples."""
+    return {
+        "wiki": resolve_wiki_link.cache_info(),
+        "tag": resolve_tag_href.cache_info(),
+        "user": resolve_user_href.cache_info(),
+    }
 
 
-def transform_text_links(text):
+def clear_link_caches():
+    resolve_wiki_link.cache_clear()
+    resolve_tag_href.cache_clear()
+    resolve_user_href.cache_clear()
+
+
+# (marker, pattern, transform) for every link syntax, ordered from most specific to general.
+# `marker` is a piece of literal text every match contains; text without it can skip the pattern.
+LINK_PATTERNS = [
+    # 1. SPECIAL External link with custom text and indicator (e.g., Wikipedia: Hatsune Miku)
+    # NOTE: SPECIAL because: it's for wiki page #5655 External links section, and likely more.
+    # NOTE:2 its undocumented, but external links can just be set with other masked link methods
+    ### ...which is seen on page 46211 (kancolle)
+    # NOTE: NEEDS TO BE AT THE TOP/RUN FIRST!
+    # clashes with normal/plain link detection otherwise
+    (
+        '":http',
+        LazyPattern(r'"([^"]+)":(https?://[^\s]+)'),  # Match "Text":http(s)://URL
+        lambda m: {
+            "type": "a",
+            "attrs": {
+                "href": m.group(2),
+                "class": "external-link",  # Add a class to indicate it's an external link
+            },
+            # todo: add this icon to other external (non base-URL) links, eg: 46211 (kancolle)
+            "children": [
+                text_node(m.group(1)),
+                {
+                    "type": "span",
+                    "attrs": {"class": "external-link-icon"},
+                    "children": [text_node("🔗")],
+                },  # Add external link icon (can be styled with CSS)
+            ],
+        },
+    ),
+    # 2. Masked link: "Text":[URL] where URL can begin with http://, https://, /, or #
+    (
+        '":[',
+        LazyPattern(r'"([^"]+)":\[((?:https?://|\/|#)[^\]]+)\]'),
+        masked_link_node,
+    ),
+    # 3. ID-based link for header: "Link Text":#dtext-id-links
+    (
+        '":#',
+        LazyPattern(r'"([^"]+)":#([a-zA-Z0-9-_]+)'),
+        lambda m: {
+            "type": "a",
+            "attrs": {"href": f"#{m.group(2)}"},
+            "children": [text_node(m.group(1))],
+        },
+    ),
+    # 4. Markdown style link: [Text](https://danbooru.donmai.us)
+    (
+        "](http",
+        LazyPattern(r"\[([^\]]+)\]\((https?://[^)]+)\)"),
+        lambda m: {
+            "type": "a",
+            "attrs": {"href": m.group(2)},
+            "children": [text_node(m.group(1))],
+        },
+    ),
+    # 5. Reverse Markdown style link: [https://danbooru.donmai.us](Text)
+    (
+        "[http",
+        LazyPattern(r"\[(https?://[^\]]+)\]\(([^)]+)\)"),
+        lambda m: {
+            "type": "a",
+            "attrs": {"href": m.group(1)},
+            "children": [text_node(m.group(2))],
+        },
+    ),
+    # 6. BBCode style without custom text: [url]https?://danbooru.donmai.us[/url]
+    (
+        "[url]",
+        LazyPattern(r"\[url\](https?://[^\[]+?)\[/url\]"),
+        lambda m: {
+            "type": "a",
+            "attrs": {"href": m.group(1).strip()},
+            "children": [text_node(m.group(1).strip())],
+        },
+    ),
+    # 7. BBCode style with custom text: [url=https://danbooru.donmai.us]Text[/url]
+    (
+        "[url=",
+        LazyPattern(r"\[url=(https?://[^\]]+)\](.*?)\[/url\]"),
+        lambda m: {
+            "type": "a",
+            "attrs": {"href": m.group(1)},
+            "children": [text_node(m.group(2))],
+        },
+    ),
+    # 8. Delimited basic link: <https?://danbooru.donmai.us>
+    (
+        "<http",
+        LazyPattern(r"<(https?://[^>]+)>"),
+        lambda m: {
+            "type": "a",
+            "attrs": {"href": m.group(1)},
+            "children": [text_node(m.group(1))],
+        },
+    ),
+    # 9. Basic link: https://danbooru.donmai.us (will be caught if not already transformed)
+    (
+        "http",
+        LazyPattern(r'(?<![">])\b(https?://[^\s<]+)\b'),
+        lambda m: {
+            "type": "a",
+            "attrs": {"href": m.group(1)},
+            "children": [text_node(m.group(1))],
+        },
+    ),
+    # 10. Wiki link: [[Page]] or [[Page|Custom Text]]
+    (
+        "[[",
+        LazyPattern(r"\[\[([^|\]]+)(\|([^\]]*))?\]\]"),
+        wiki_link_node,
+    ),
+    # 11. Tag search link: {{tag}} or {{tag|Custom Text}}
+    (
+        "{{",
+        LazyPattern(r"\{\{([^|\}]+)(\|([^}]*))?\}\}"),
+        lambda m: {
+            "type": "a",
+            "attrs": {"href": resolve_tag_href(m.group(1))},
+            "children": [text_node(m.group(3).strip() if m.group(3) and m.group(3).strip() else m.group(1).strip())],
+        },
+    ),
+    # 12. User link: @username
+    (
+        "@",
+        # < > only there cause the dtext:help wiki api resp has it despite wiki not mentioning it
+        LazyPattern(r"(?:<)?@(\w+)>?"),
+        lambda m: {
+            "type": "a",
+            "attrs": {"href": resolve_user_href(m.group(1))},
+            "children": [text_node("@" + m.group(1))],
+        },
+    ),
+    # 13. ID-based shorthand links like post #1234 or comment #5678/p2
+    (
+        "#",
+        IdLinkPattern(),
+        lambda m: {
+            "type": "a",
+            "attrs": {"href": ID_LINK_MAP[m.group(1)] + m.group(2) + (f"?page={m.group(4)}" if m.group(4) else "")},
+            "children": [text_node(f"{m.group(1)} #{m.group(2)}" + (f"/p{m.group(4)}" if m.group(4) else ""))],
+        },
+    ),
+]
+
+
+# Finds any link marker: text without one comes out of transform_text_links unchanged.
+LINK_MARKER_PATTERN = LazyPattern("|".join(re.escape(marker) for marker, _, _ in LINK_PATTERNS))
+INLINE_MARKUP_PATTERN = LazyPattern("[<*]")
+
+
+def transform_text_links(text, source=None, offset=0):
     """
     Given a string of text, scan it for link syntaxes and return a list of nodes.
     Supported link formats include:
@@ -161,199 +579,43 @@ def transform_text_links(text):
       - Wiki link: [[Kantai Collection]] and [[Kantai Collection|Kancolle]]
       - Tag search: {{kantai_collection comic}} and {{kantai_collection comic|Kancolle Comics}}
       - User link: @evazion
-    """
 
-    # Helper: wrap plain text into a text node.
-    def text_node(content):
-        return {"type": "text", "content": content}
+    Patterns in LINK_PATTERNS take precedence in order: each one only sees the pieces of text
+    the ones before it left as plain text, exactly as if they ran one after another over the
+    whole node list. Each piece is scanned once per pattern that can occur in it.
 
-    # Helper: if a URL starts with "/" or "#", prepend the base URL.
-    def resolve_url(url):
-        if url.startswith("/"):
-            return (
-                "https://danbooru.donmai.us" + url
-            )  # todo: change this to local page for wiki when everything is local
-        elif url.startswith("#"):
-            # Keep hash links relative to the current page
-            return url
-        else:
-            return url
-
-    # List of patterns, ordered from most specific to general.
-    patterns = [
-        # 1. SPECIAL External link with custom text and indicator (e.g., Wikipedia: Hatsune Miku)
-        # NOTE: SPECIAL because: it's for wiki page #5655 External links section, and likely more.
-        # NOTE:2 its undocumented, but external links can just be set with other masked link methods
-        ### ...which is seen on page 46211 (kancolle)
-        # NOTE: NEEDS TO BE AT THE TOP/RUN FIRST!
-        # clashes with normal/plain link detection otherwise
-        (
-            re.compile(r'"([^"]+)":(https?://[^\s]+)'),  # Match "Text":http(s)://URL
-            lambda m: {
-                "type": "a",
-                "attrs": {
-                    "href": m.group(2),
-                    "class": "external-link",  # Add a class to indicate it's an external link
-                },
-                # todo: add this icon to other external (non base-URL) links, eg: 46211 (kancolle)
-                "children": [
-                    text_node(m.group(1)),
-                    {
-                        "type": "span",
-                        "attrs": {"class": "external-link-icon"},
-                        "children": [text_node("🔗")],
-                    },  # Add external link icon (can be styled with CSS)
-                ],
-            },
-        ),
-        # 2. Masked link: "Text":[URL] where URL can begin with http://, https://, /, or #
-        (
-            re.compile(r'"([^"]+)":\[((?:https?://|\/|#)[^\]]+)\]'),
-            lambda m: {
-                "type": "a",
-                "attrs": {"href": resolve_url(m.group(2))},
-                "children": [text_node(m.group(1))],
-            },
-        ),
-        # 3. ID-based link for header: "Link Text":#dtext-id-links
-        (
-            re.compile(r'"([^"]+)":#([a-zA-Z0-9-_]+)'),
-            lambda m: {
-                "type": "a",
-                "attrs": {"href": f"#{m.group(2)}"},
-                "children": [text_node(m.group(1))],
-            },
-        ),
-        # 4. Markdown style link: [Text](https://danbooru.donmai.us)
-        (
-            re.compile(r"\[([^\]]+)\]\((https?://[^)]+)\)"),
-            lambda m: {
-                "type": "a",
-                "attrs": {"href": m.group(2)},
-                "children": [text_node(m.group(1))],
-            },
-        ),
-        # 5. Reverse Markdown style link: [https://danbooru.donmai.us](Text)
-        (
-            re.compile(r"\[(https?://[^\]]+)\]\(([^)]+)\)"),
-            lambda m: {
-                "type": "a",
-                "attrs": {"href": m.group(1)},
-                "children": [text_node(m.group(2))],
-            },
-        ),
-        # 6. BBCode style without custom text: [url]https?://danbooru.donmai.us[/url]
-        (
-            re.compile(r"\[url\](https?://[^\[]+?)\[/url\]"),
-            lambda m: {
-                "type": "a",
-                "attrs": {"href": m.group(1).strip()},
-                "children": [text_node(m.group(1).strip())],
-            },
-        ),
-        # 7. BBCode style with custom text: [url=https://danbooru.donmai.us]Text[/url]
-        (
-            re.compile(r"\[url=(https?://[^\]]+)\](.*?)\[/url\]"),
-            lambda m: {
-                "type": "a",
-                "attrs": {"href": m.group(1)},
-                "children": [text_node(m.group(2))],
-            },
-        ),
-        # 8. Delimited basic link: <https?://danbooru.donmai.us>
-        (
-            re.compile(r"<(https?://[^>]+)>"),
-            lambda m: {
-                "type": "a",
-                "attrs": {"href": m.group(1)},
-                "children": [text_node(m.group(1))],
-            },
-        ),
-        # 9. Basic link: https://danbooru.donmai.us (will be caught if not already transformed)
-        (
-            re.compile(r'(?<![">])\b(https?://[^\s<]+)\b'),
-            lambda m: {
-                "type": "a",
-                "attrs": {"href": m.group(1)},
-                "children": [text_node(m.group(1))],
-            },
-        ),
-        # 10. Wiki link: [[Page]] or [[Page|Custom Text]]
-        (
-            re.compile(r"\[\[([^|\]]+)(\|([^\]]*))?\]\]"),
-            lambda m: (
-                lambda page_section, display_text: {
-                    "type": "a",
-                    "attrs": {
-                        "href": "https://danbooru.donmai.us/wiki_pages/"
-                        + page_section[0].replace(" ", "_").lower()
-                        + (("#dtext-" + page_section[1].lower()) if page_section[1] else "")
-                    },
-                    "children": [text_node(display_text)],
-                }
-            )(
-                # Split page#section if exists
-                m.group(1).strip().split("#") + [None],
-                (
-                    re.sub(r"\s*\([^)]*\)", "", m.group(1).split("#")[0].strip()).strip()
-                    if not (m.group(3) and m.group(3).strip())
-                    else m.group(3).strip()
-                ),
-            ),
-        ),
-        # 11. Tag search link: {{tag}} or {{tag|Custom Text}}
-        (
-            re.compile(r"\{\{([^|\}]+)(\|([^}]*))?\}\}"),
-            lambda m: {
-                "type": "a",
-                "attrs": {"href": "https://danbooru.donmai.us/posts?tags=" + m.group(1).strip().replace(" ", "%20")},
-                "children": [
-                    text_node(m.group(3).strip() if m.group(3) and m.group(3).strip() else m.group(1).strip())
-                ],
-            },
-        ),
-        # 12. User link: @username
-        (
-            # < > only there cause the dtext:help wiki api resp has it despite wiki not mentioning it
-            re.compile(r"(?:<)?@(\w+)>?"),
-            lambda m: {
-                "type": "a",
-                "attrs": {"href": "https://danbooru.donmai.us/users?name=" + m.group(1)},
-                "children": [text_node("@" + m.group(1))],
-            },
-        ),
-        # 13. ID-based shorthand links like post #1234 or comment #5678/p2
-        (
-            re.compile(r"\b(" + "|".join(map(re.escape, ID_LINK_MAP.keys())) + r")\s*#(\d+)(/p(\d+))?\b"),
-            lambda m: {
-                "type": "a",
-                "attrs": {"href": ID_LINK_MAP[m.group(1)] + m.group(2) + (f"?page={m.group(4)}" if m.group(4) else "")},
-                "children": [text_node(f"{m.group(1)} #{m.group(2)}" + (f"/p{m.group(4)}" if m.group(4) else ""))],
-            },
-        ),
-    ]
-
-    # Process the text sequentially through all patterns.
-    nodes = [text_node(text)]
-    for pattern, transform in patterns:
-        new_nodes = []
-        # Process each existing node only if it is plain text.
-        for node in nodes:
-            if node["type"] != "text":
-                new_nodes.append(node)
-                continue
-
-            t = node["content"]
-            pos = 0
-            for match in pattern.finditer(t):
-                start, end = match.span()
-                if start > pos:
-                    new_nodes.append(text_node(t[pos:start]))
-                new_nodes.append(transform(match))
-                pos = end
-            if pos < len(t):
-                new_nodes.append(text_node(t[pos:]))
-        nodes = new_nodes
+    If `text` is source[offset:offset + len(text)], pass `source` and `offset` to get the pieces
+    left as plain text back as TextSpan nodes into `source` instead of copies.
+    """
+    nodes = []
+
+    def scan(segment, index, base):
+        # Patterns whose marker isn't in this piece can't match anywhere in it.
+        while index < len(LINK_PATTERNS) and LINK_PATTERNS[index][0] not in segment:
+            index += 1
+        if index == len(LINK_PATTERNS):
+            if source is None:
+                nodes.append(text_node(segment))
+            else:
+                nodes.append(TextSpan(source, base, base + len(segment)))
+            return
+
+        _, pattern, transform = LINK_PATTERNS[index]
+        pos = 0
+        for match in pattern.finditer(segment):
+            start, end = match.span()
+            # The text before a match is a piece of its own for the later patterns, which can't
+            # see across the link (\b and lookbehinds included), so it is sliced off.
+            if start > pos:
+                scan(segment[pos:start], index + 1, base + pos)
+            nodes.append(transform(match))
+            pos = end
+        if pos < len(segment):
+            scan(segment[pos:], index + 1, base + pos)
+
+    # Empty text comes out as no nodes at all.
+    if text:
+        scan(text, 0, offset)
     return nodes
 
 
@@ -363,8 +625,14 @@ def process_ast_links(ast):
     """
     new_ast = []
     for node in ast:
+        if type(node) is TextSpan:
+            # A span with no link syntax in it stays as it is, without being sliced out.
+            if LINK_MARKER_PATTERN.search(node.source, node.start, node.end):
+                new_ast.extend(transform_text_links(node.content, node.source, node.start))
+            elif node.end > node.start:
+                new_ast.append(node)
         # If it's a text node, transform it.
-        if node["type"] == "text":
+        elif node["type"] == "text":
             new_ast.extend(transform_text_links(node["content"]))
         # Otherwise, if it has children, process them recursively.
         elif "children" in node:
@@ -375,110 +643,265 @@ def process_ast_links(ast):
     return new_ast
 
 
-def parse_dtext_to_ast(dtext):
-    # Pre-scan: temporarily remove [code] and [nodtext] blocks to prevent normalization inside them.
-    placeholder_map = {}
-
-    def placeholder_replacer(match):
-        key = f"__PLACEHOLDER_{len(placeholder_map)}__"
-        placeholder_map[key] = match.group(0)  # Save the entire block unchanged.
-        return key
-
-    # Replace [code]...[/code] and [nodtext]...[/nodtext] with placeholders.
-    dtext = re.sub(r"(\[(code|nodtext)(?:=[^\]]+)?\].*?\[/\2\])", placeholder_replacer, dtext, flags=re.DOTALL)
-
-    html_tag_map = {
-        "strong": "b",
-        "b": "b",
-        "em": "i",
-        "i": "i",
-        "u": "u",
-        "s": "s",
-        "spoiler": "spoilers",
-        "tn": "tn",
-        "nodtext": "nodtext",
-        "code": "code",
-        "br": "br",
-        "hr": "hr",
-        "quote": "quote",
-        "expand": "expand",
-        "table": "table",
-        "thead": "thead",
-        "tbody": "tbody",
-        "tr": "tr",
-        "td": "td",
-        "th": "th",
-        "col": "col",
-        "colgroup": "colgroup",
-    }
+HTML_TAG_MAP = {
+    "strong": "b",
+    "b": "b",
+    "em": "i",
+    "i": "i",
+    "u": "u",
+    "s": "s",
+    "spoiler": "spoilers",
+    "tn": "tn",
+    "nodtext": "nodtext",
+    "code": "code",
+    "br": "br",
+    "hr": "hr",
+    "quote": "quote",
+    "expand": "expand",
+    "table": "table",
+    "thead": "thead",
+    "tbody": "tbody",
+    "tr": "tr",
+    "td": "td",
+    "th": "th",
+    "col": "col",
+    "colgroup": "colgroup",
+}
+
+# One alternation for every <tag ...> and </tag> form. Closing tags take no attributes.
+_HTML_TAG_NAMES = "|".join(HTML_TAG_MAP)
+HTML_TAG_PATTERN = LazyPattern(
+    rf"<(?:/(?P<close>{_HTML_TAG_NAMES})|(?P<open>{_HTML_TAG_NAMES})(?:\s[^>]*)?)>",
+    re.IGNORECASE,
+)
+
+
+def html_tag_replacement(match):
+    closing = match.group("close") is not None
+    name = match.group("close") if closing else match.group("open")
+    dtext_equiv = HTML_TAG_MAP.get(name.lower())
+    if dtext_equiv is None:
+        # IGNORECASE also folds a few non-ASCII letters (e.g. "ſ" matches "s"), which lower() does not.
+        dtext_equiv = next(v for k, v in HTML_TAG_MAP.items() if re.fullmatch(k, name, re.IGNORECASE))
+    return f"[/{dtext_equiv}]" if closing else f"[{dtext_equiv}]"
+
+
+def normalize_html_tags(dtext, protected=(), offsets=None):
+    """
+    Rewrite HTML-style tags (<b>, <td align="center">, </tr>, ...) to their DText equivalents in one pass.
+    Attributes on HTML tags are dropped, same as before.
+    `protected` is a sorted list of (start, end) spans that are copied through unchanged.
+    If `offsets` is a list, (original_end, normalized_end) is appended for every rewritten tag
+    so offsets in the result can be mapped back to the input.
+    """
+    if "<" not in dtext:
+        return dtext
+
+    parts = []
+    pos = 0
+    shift = 0
+    for span_start, span_end in [*protected, (len(dtext), len(dtext))]:
+        # endpos keeps a tag from reaching into the protected span after it.
+        for match in HTML_TAG_PATTERN.finditer(dtext, pos, span_start):
+            replacement = html_tag_replacement(match)
+            parts.append(dtext[pos : match.start()])
+            parts.append(replacement)
+            pos = match.end()
+            if offsets is not None:
+                shift += len(replacement) - (pos - match.start())
+                offsets.append((pos, pos + shift))
+        parts.append(dtext[pos:span_end])
+        pos = span_end
+    return "".join(parts)
+
+
+PROTECTED_BLOCK_PATTERN = LazyPattern(r"\[(code|nodtext)(?:=[^\]]+)?\].*?\[/\1\]", re.DOTALL)
+
+
+def find_protected_spans(dtext):
+    """Offsets of the [code]...[/code] and [nodtext]...[/nodtext] blocks that normalization must skip."""
+    if "[code" not in dtext and "[nodtext" not in dtext:
+        return []
+    return [match.span() for match in PROTECTED_BLOCK_PATTERN.finditer(dtext)]
+
+
+# Every token starts with "[" except headers, which are anchored on the newline before them
+# (the first line is checked separately). Giving each branch a literal first character lets
+# the regex engine skip ahead to candidate offsets instead of trying the pattern everywhere.
+HEADER_PATTERN = LazyPattern(
+    r"(?P<header>(?P<level>h[123456])(?P<header_id>#[\w-]+)?\.\s*(?P<content>.*?)(?=\s*$|\n|$))", re.MULTILINE
+)
+TAG_TOKEN = (
+    r"(?P<tag>(?P<tag_close>/?)(?P<tag_name>b|i|u|s|tn|spoilers|code|nodtext|expand|quote)(?:=(?P<tag_attr>[^\]]+))?\])"
+)
+TABLE_TAG_TOKEN = (
+    r"(?P<table_tag>(?P<table_close>/?)(?P<table_name>table|thead|tbody|tr|td|th|col|colgroup)(?P<table_attr>\s+[^\]]+)?\])"
+)
+TOKEN_PATTERN = LazyPattern(
+    r"\[(?:" + TAG_TOKEN + "|" + TABLE_TAG_TOKEN + r"|(?P<br>br\])|(?P<hr>hr\]))|\n" + HEADER_PATTERN.pattern,
+    re.MULTILINE,
+)
+# Each branch of TOKEN_PATTERN on its own, in the same order, for the overlapped regions.
+TOKEN_KIND_PATTERNS = {
+    "tag": LazyPattern(r"\[" + TAG_TOKEN),
+    "table_tag": LazyPattern(r"\[" + TABLE_TAG_TOKEN),
+    "br": LazyPattern(r"\[(?P<br>br\])"),
+    "hr": LazyPattern(r"\[(?P<hr>hr\])"),
+    "header": LazyPattern(r"\n" + HEADER_PATTERN.pattern, re.MULTILINE),
+}
+# Tags whose body the tree builder takes as is, up to the close tag.
+CODE_TAG_NAMES = frozenset(("code", "nodtext"))
+TAG_GROUPS = {
+    "tag": ("tag_close", "tag_name", "tag_attr"),
+    "table_tag": ("table_close", "table_name", "table_attr"),
+}
+
+
+def code_block_end(dtext, match, end):
+    # The tree builder takes everything up to the first matching close tag as code.
+    close_tag = f"[/{match.group('tag_name')}]"
+    close_pos = dtext.find(close_tag, end)
+    return len(dtext) if close_pos == -1 else close_pos + len(close_tag)
+
+
+def tokenize_dtext(dtext, clean_headers=None):
+    """
+    Scan the document and yield, in document order, the (kind, start, end, match) tokens that
+    build_node_tree acts on.
+
+    Tokens are the same as running the header, tag, table tag, br and hr patterns separately and
+    merging their matches by offset, minus the ones the tree builder ignores: anything else on a
+    header's line and anything inside a [code] or [nodtext] block.
+
+    Up to the first header, or tag whose attribute could hide another token, one combined pattern
+    finds them (see iter_plain_tokens). The rest is scanned the separate way (see iter_merged_tokens).
+
+    If `clean_headers` is a list, the start of every yielded header that no earlier token runs
+    into is appended to it just before the header is yielded (see reparse.find_block_boundaries).
+    """
+    pos = yield from iter_plain_tokens(dtext)
+    if pos is not None:
+        yield from iter_merged_tokens(dtext, pos, clean_headers)
+
+
+def iter_plain_tokens(dtext):
+    """
+    Yield tokens with TOKEN_PATTERN, jumping over code blocks, for as long as no token can run into
+    another. Returns the offset of the first header or tag that might (an attribute with "[" or a
+    newline in it, e.g. "[b=[br]"), or None at the end of the document.
+    """
+    # A header on the first line has no newline in front of it.
+    if HEADER_PATTERN.match(dtext):
+        return 0
+    find = dtext.find
+    pos = 0
+    while True:
+        for match in TOKEN_PATTERN.finditer(dtext, pos):
+            kind = match.lastgroup
+            if kind == "header":
+                # Tags on a header's line are skipped, but can run past it.
+                return match.start(kind)
+            start, end = match.span()
+            # Short tokens like "[/b]" have no attribute that could hide another token.
+            if end - start > 4 and (find("[", start + 1, end) != -1 or find("\n", start, end) != -1):
+                return start
+            yield kind, start, end, match
+            if kind == "tag" and match.group("tag_name") in CODE_TAG_NAMES and not match.group("tag_close"):
+                pos = code_block_end(dtext, match, end)
+                break
+        else:
+            return None
 
-    # Normalize HTML-style tags to DText-style for the rest of the text.
-    for html, dtext_equiv in html_tag_map.items():
-        dtext = re.sub(rf"<{html}(\s[^>]*)?>", f"[{dtext_equiv}]", dtext, flags=re.IGNORECASE)
-        dtext = re.sub(rf"</{html}>", f"[/{dtext_equiv}]", dtext, flags=re.IGNORECASE)
 
-    # Restore the original code/nodtext blocks.
-    for key, original in placeholder_map.items():
-        dtext = dtext.replace(key, original)
+def iter_merged_tokens(dtext, pos, clean_headers=None):
+    """
+    The tokens of tokenize_dtext from `pos` on, for text where tokens of different kinds can overlap:
+    each kind is scanned with its own pattern, once, and the matches are merged by offset.
+    """
+    skip_until = pos  # tokens before it are on a header's line or in a code block
+    reach = pos  # furthest any token found so far runs
+    scans = [pattern.finditer(dtext, pos) for pattern in TOKEN_KIND_PATTERNS.values()]
+    if pos == 0:
+        # A header on the first line has no newline in front of it.
+        match = HEADER_PATTERN.match(dtext)
+        if match:
+            scans.append(iter((match,)))
+    else:
+        # The header pattern starts at the newline before the header.
+        scans[-1] = TOKEN_KIND_PATTERNS["header"].finditer(dtext, pos - 1)
+    # A header match starts on its newline, where no other token can, so it sorts in the right place.
+    for match in heapq.merge(*scans, key=re.Match.start):
+        kind = match.lastgroup
+        if kind == "header":
+            start, end = match.span(kind)
+            if start >= skip_until:
+                if clean_headers is not None and reach <= start:
+                    clean_headers.append(start)
+                yield kind, start, end, match
+                line_end = dtext.find("\n", end)
+                skip_until = len(dtext) if line_end == -1 else line_end + 1
+        else:
+            start, end = match.span()
+            if start >= skip_until:
+                yield kind, start, end, match
+                if kind == "tag" and match.group("tag_name") in CODE_TAG_NAMES and not match.group("tag_close"):
+                    skip_until = code_block_end(dtext, match, end)
+        if end > reach:
+            reach = end
 
-    header_pattern = re.compile(r"^(h[123456])(#[\w-]+)?\.\s*(.*?)(?=\s*$|\n|$)", re.MULTILINE)
-    tag_pattern = re.compile(r"\[(/?)(b|i|u|s|tn|spoilers|code|nodtext|expand|quote)(?:=([^\]]+))?\]")
-    br_pattern = re.compile(r"\[br\]")  # linebreak
-    hr_pattern = re.compile(r"\[hr\]")  # Horizon
-    table_tag_pattern = re.compile(r"\[(/?)(table|thead|tbody|tr|td|th|col|colgroup)(\s+[^\]]+)?\]")
 
+def normalize_dtext(dtext):
+    """Normalize HTML-style tags to DText, leaving [code] and [nodtext] blocks untouched."""
+    return normalize_html_tags(dtext, find_protected_spans(dtext))
+
+
+def build_node_tree(dtext):
+    return list(iter_node_tree(dtext))
+
+
+def iter_node_tree(dtext, spans=False):
+    """
+    Turn normalized DText into a tree of tag, header, code and text nodes.
+    List markers and link syntaxes are left in the text nodes for wrap_list_items and process_ast_links.
+    With spans=True the text between tags is made of TextSpan nodes pointing into `dtext`.
+
+    Top-level nodes are yielded once they are closed; an unclosed tag is yielded at the end.
+    """
     pos = 0
     stack = [[]]  # root node list
 
-    def tagged_matches():
-        for match in header_pattern.finditer(dtext):
-            yield ("header", match)
-        for match in tag_pattern.finditer(dtext):
-            yield ("tag", match)
-        for match in table_tag_pattern.finditer(dtext):
-            yield ("table_tag", match)
-        for match in br_pattern.finditer(dtext):
-            yield ("br", match)
-        for match in hr_pattern.finditer(dtext):
-            yield ("hr", match)
+    def text_node(start, end):
+        if spans:
+            return TextSpan(dtext, start, end)
+        return {"type": "text", "content": dtext[start:end]}
 
     def parse_attributes(attr_string):
         if not attr_string:
             return {}
         return dict(re.findall(r'(\w+)="([^"]+)"', attr_string.strip()))
 
-    tokens = list(tagged_matches())
-    tokens.sort(key=lambda x: x[1].start())
-
-    i = 0
-    while i < len(tokens):
-        kind, match = tokens[i]
-        start, end = match.span()
-
+    for kind, start, end, match in tokenize_dtext(dtext):
         # Add text between previous pos and current match start
         if start > pos:
-            stack[-1].append({"type": "text", "content": dtext[pos:start]})
+            stack[-1].append(text_node(pos, start))
             pos = start
 
         if kind == "header":
-            header_level = match.group(1)
-            header_id = match.group(2)[1:] if match.group(2) else None
-            header_content = match.group(3).strip()
+            header_level = match.group("level")
+            header_id = match.group("header_id")[1:] if match.group("header_id") else None
+            header_content = match.group("content").strip()
 
             # Recursively parse header content to handle nested DText
-            header_children = parse_dtext_to_ast(header_content)
+            header_children = parse_inline_dtext(header_content)
             header_node = {"type": header_level, "children": header_children}
             if header_id:
                 header_node["id"] = header_id
 
             stack[-1].append(header_node)
-            # Advance pos to end of the entire header line (including newline)
+            # Advance pos to end of the entire header line (including newline).
+            # tokenize_dtext doesn't yield the other tokens on this line.
             line_end = dtext.find("\n", end)
             pos = len(dtext) if line_end == -1 else line_end + 1
-            # Skip processing other tokens on this line
-            while i < len(tokens) and tokens[i][1].start() < pos:
-                i += 1
-            continue
 
         elif kind == "br":
             stack[-1].append({"type": "linebreak"})
@@ -488,10 +911,10 @@ def parse_dtext_to_ast(dtext):
             pos = end
 
         elif kind in ("tag", "table_tag"):
-            tag = match.group(2).lower()
-            closing = match.group(1) == "/"
-            attr = match.group(3)
-            attrs = parse_attributes(match.group(3))
+            closing, tag, attr = match.group(*TAG_GROUPS[kind])
+            tag = tag.lower()
+            closing = closing == "/"
+            attrs = parse_attributes(attr)
 
             if not closing:
                 if tag in ("code", "nodtext"):
@@ -509,12 +932,8 @@ def parse_dtext_to_ast(dtext):
                     elif tag == "nodtext":
                         stack[-1].append({"type": "text", "content": inner_content})
 
-                    # Update pos to the end of the closing tag
-                    new_pos = close_pos + len(close_tag)
-                    # Skip tokens within the processed range
-                    while i + 1 < len(tokens) and tokens[i + 1][1].start() < new_pos:
-                        i += 1
-                    pos = new_pos
+                    # Update pos to the end of the closing tag (tokenize_dtext skips the block too)
+                    pos = close_pos + len(close_tag)
                 else:
                     new_node = {"type": tag, "children": []}
                     if tag == "expand":
@@ -530,13 +949,140 @@ def parse_dtext_to_ast(dtext):
                     stack.pop()
                 pos = end
 
-        i += 1
+        # Back at the top level, so whatever was added there is finished.
+        if len(stack) == 1 and stack[0]:
+            yield from stack[0]
+            stack[0].clear()
 
     # Add any remaining text after the last token
     if pos < len(dtext):
-        stack[-1].append({"type": "text", "content": dtext[pos:]})
+        stack[-1].append(text_node(pos, len(dtext)))
+
+    yield from stack[0]
 
-    return process_ast_links(wrap_list_items(stack[0]))
+
+# Nodes that get a "hash" key with hashes=True: the block-level ones worth caching the HTML of
+# (see to_html.FragmentCache). Every node is still hashed, so the hash covers the whole subtree.
+FRAGMENT_TYPES = frozenset(("ul", "expand", "quote", "spoilers", "table", "thead", "tbody", "tr"))
+
+
+def node_hash(node, child_hashes):
+    if len(node) == 2:
+        # Just "type" and "children", as most nodes are.
+        return hash((node["type"], *child_hashes))
+    attrs = node.get("attrs")
+    fields = [node["type"], None if attrs is None else tuple(attrs.items())]
+    fields += node.get("id"), node.get("title"), node.get("missing")
+    fields += child_hashes
+    return hash(tuple(fields))
+
+
+def hash_subtree(node):
+    """
+    Structural hash of a node and everything under it, from every key the renderer reads, and the
+    length of the text in it. Stored on the FRAGMENT_TYPES nodes as "hash" and "text_length"; the
+    hash is Python's hash(), so only stable within one process.
+    """
+    child_hashes = []
+    length = 0
+    for child in node["children"]:
+        if "children" in child:
+            child_hash, child_length = hash_subtree(child)
+        else:
+            # text, code, linebreak, horizon
+            content = child.get("content")
+            child_hash = hash(content) if child["type"] == "text" else hash((child["type"], content))
+            child_length = len(content) if content else 0
+        child_hashes.append(child_hash)
+        length += child_length
+    subtree_hash = node_hash(node, child_hashes)
+    if node["type"] in FRAGMENT_TYPES:
+        node["hash"] = subtree_hash
+        node["text_length"] = length
+    return subtree_hash, length
+
+
+def process_ast_links_hashed(ast, hashes):
+    """
+    process_ast_links and hash_subtree in one walk: each node is hashed as soon as the link pass is
+    done with its children. Appends the hash of every node it returns to `hashes`, and returns the
+    new nodes and the length of their text.
+    """
+    new_ast = []
+    length = 0
+    for node in ast:
+        if "children" in node:
+            child_hashes = []
+            node["children"], child_length = process_ast_links_hashed(node["children"], child_hashes)
+            subtree_hash = node_hash(node, child_hashes)
+            if node["type"] in FRAGMENT_TYPES:
+                node["hash"] = subtree_hash
+                node["text_length"] = child_length
+            new_ast.append(node)
+            hashes.append(subtree_hash)
+            length += child_length
+        elif node["type"] == "text":
+            # Link nodes made here are not processed again, same as in process_ast_links.
+            if type(node) is TextSpan:
+                linked_nodes = process_ast_links([node])
+            else:
+                linked_nodes = transform_text_links(node["content"])
+            for linked in linked_nodes:
+                if linked["type"] == "text":
+                    content = linked["content"]
+                    hashes.append(hash(content))
+                    length += len(content)
+                else:
+                    linked_hash, linked_length = hash_subtree(linked)
+                    hashes.append(linked_hash)
+                    length += linked_length
+                new_ast.append(linked)
+        else:
+            content = node.get("content")
+            hashes.append(hash((node["type"], content)))
+            length += len(content) if content else 0
+            new_ast.append(node)
+    return new_ast, length
+
+
+def parse_dtext_to_ast(dtext, spans=False, hashes=False):
+    return list(iter_parse_dtext(dtext, spans, hashes))
+
+
+def iter_parse_dtext(dtext, spans=False, hashes=False):
+    """
+    Parse DText and yield the finished top-level nodes (headers, lists, tables, expands, text, ...)
+    one at a time, as each one closes. Joined together they are the same as parse_dtext_to_ast(dtext),
+    but only the block being built is held in memory and rendering can start on the first block.
+
+    With spans=True, text that comes through parsing unchanged (most of a page) is left as TextSpan
+    nodes pointing into the normalized document instead of being copied out at each stage. They read
+    like dict text nodes, render the same and save_json writes them as such.
+
+    With hashes=True, each block is hashed bottom-up by the link pass (see process_ast_links_hashed),
+    so ast_to_html can take the HTML of repeated lists, tables and expands from a FragmentCache.
+    """
+    for block in iter_wrap_list_items(iter_node_tree(normalize_dtext(dtext), spans)):
+        if hashes:
+            yield from process_ast_links_hashed([block], [])[0]
+        else:
+            yield from process_ast_links([block])
+
+
+def parse_inline_dtext(text):
+    """
+    Parse a single line of DText, such as a list item or header body.
+
+    Gives the same nodes as parse_dtext_to_ast(text) but skips the steps a line usually doesn't need:
+    the line comes out of already normalized text, so it only needs normalizing again if it
+    still has "<" in it (e.g. from [nodtext]), and list wrapping only matters if it has a "*".
+    """
+    if "<" in text:
+        text = normalize_dtext(text)
+    nodes = build_node_tree(text)
+    if "*" in text or "\n" in text:
+        nodes = wrap_list_items(nodes)
+    return process_ast_links(nodes)
 
 
 def read_file(filename):
@@ -552,7 +1098,22 @@ def save_json(data, filename):
     file_path = os.path.join(script_dir, filename)
 
     with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+        json.dump(data, f, indent=2, ensure_ascii=False, default=node_to_json)
+
+
+def save_ast(ast, ast_format="json"):
+    """Save the AST as ast_output.json, or in the compact binary_ast format as ast_output.bin."""
+    if ast_format == "binary":
+        from binary_ast import save_binary
+
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        save_binary(ast, os.path.join(script_dir, AST_FILES["binary"]))
+    else:
+        save_json(ast, AST_FILES["json"])
+
+
+# Set to True (or pass --dump-ast) to also save the AST, for debugging the parser.
+DUMP_AST = False
 
 
 def load_dtext_input(source="txt", txt_path="dtextH.txt", json_path="wiki_pages.json", target_id=43047):
@@ -560,28 +1121,51 @@ def load_dtext_input(source="txt", txt_path="dtextH.txt", json_path="wiki_pages.
         with open(txt_path, "r", encoding="utf-8") as f:
             return f.read()
     elif source == "json":
-        with open(json_path, "r", encoding="utf-8") as f:
-            pages = json.load(f)
-        for page in pages:
-            if page.get("id") == target_id:
-                return page.get("body", "")
-        raise ValueError(f"No entry found with id={target_id}")
+        # Imported here, so the parser doesn't load the dump and index code it only needs for this.
+        from dump_index import WikiDump
+        from wiki_dump import find_wiki_page
+
+        try:
+            # Decodes just this page's record, through the dump's sidecar index (built on first use)
+            dump = WikiDump(json_path)
+        except OSError:
+            # No index next to a read-only dump, or one that failed to write: read the dump up to the page
+            page = find_wiki_page(json_path, target_id)
+        else:
+            try:
+                page = dump.get(target_id)
+            finally:
+                dump.close()
+        if page is None:
+            raise ValueError(f"No entry found with id={target_id}")
+        return page.get("body", "")
     else:
         raise ValueError("Invalid source option. Use 'txt' or 'json'.")
 
 
-# "txt" or "json"
-#  project voltage 172159 # 11229 for ewiki
-dtext_input = load_dtext_input(source="json", target_id=43047)
-# id 43047 for help:dtext 5655 for hatsune_miku; 46211 kancolle
-# 5883 tag groups
-# 29067 tag_group:backgrounds
-ast = parse_dtext_to_ast(dtext_input)
-
-
-# Save as JSON
-save_json(ast, "ast_output.json")
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert a wiki page to output.html.")
+    parser.add_argument("--dump-ast", action="store_true", default=DUMP_AST, help="also save the parsed AST")
+    parser.add_argument(
+        "--format", choices=sorted(AST_FILES), default="json", help="format of the saved AST (default: %(default)s)"
+    )
+    args = parser.parse_args()
+
+    # "txt" or "json"
+    #  project voltage 172159 # 11229 for ewiki
+    dtext_input = load_dtext_input(source="json", target_id=43047)
+    # id 43047 for help:dtext 5655 for hatsune_miku; 46211 kancolle
+    # 5883 tag groups
+    # 29067 tag_group:backgrounds
+    if args.dump_ast:
+        ast = parse_dtext_to_ast(dtext_input)
+        save_ast(ast, args.format)
+    else:
+        # The blocks go straight to the renderer as they are parsed
+        ast = iter_parse_dtext(dtext_input)
 
-runa()
+    runa(ast)
 
 #'[See [[Tag Groups]].]\r\n\r\n[expand=Table of Contents]\r\n* 1. "About":#dtext-about\r\n* 2. "Colors":#dtext-colors\r\n* 3. "Multiple Colors":#dtext-multiple\r\n* 4. "Patterns":#dtext-patterns\r\n* 5. "Descriptive":#dtext-descriptive\r\n* 6. "Objects and Nouns":#dtext-objects\r\n* 7. "Mediums":#dtext-mediums\r\n* 8. "Background Related":#dtext-related\r\n[/expand]\r\n\r\nh4#about. About\r\n\r\nTags which describe the background of posts. Most, but not all, have "background" in their name.\r\n\r\nh4#colors. Colors\r\n\r\n* [[aqua background]]\r\n* [[beige background]] (deprecated)\r\n* [[black background]]\r\n* [[blue background]]\r\n* [[brown background]]\r\n* [[green background]]\r\n* [[grey background]]\r\n* [[orange background]]\r\n* [[pink background]]\r\n* [[purple background]]\r\n* [[red background]]\r\n* [[simple background]]\r\n** [[transparent background]]\r\n* [[white background]]\r\n* [[yellow background]]\r\n\r\nh4#multiple. Multiple Colors\r\n\r\n* [b][[colorful background]][/b]\r\n* [[gradient background]]\r\n* [[greyscale with colored background]]\r\n* [[halftone background]]\r\n* [[monochrome background]]\r\n* [[multicolored background]] (deprecated)\r\n* [[rainbow background]]\r\n** [[heaven condition]]\r\n* [[three-toned background]]\r\n* [[two-tone background]]\r\n\r\nh4#patterns. Patterns\r\n\r\n* [[argyle background]]\r\n* [[checkered background]]\r\n* [[cross background]]\r\n* [[dithered background]]\r\n* [[dotted background]]\r\n* [[grid background]]\r\n* [[honeycomb background]]\r\n* [[lace background]]\r\n* [[marble background]]\r\n* [[mosaic background]]\r\n* [b][[patterned background]][/b]\r\n* [[plaid background]]\r\n* [[polka dot background]]\r\n* [[spiral background]]\r\n* [[splatter background]]\r\n* [[striped background]]\r\n** [[diagonal-striped background]]\r\n* [[sunburst background]]\r\n* [[triangle background]]\r\n\r\nh4#descriptive. Descriptive\r\n* [[abstract background]]\r\n* [[blurry background]]\r\n* [[bright background]]\r\n* [[dark background]]\r\n* [[drama layer]]\r\n\r\nh4#objects. Objects and Nouns\r\n\r\n* [[animal background]] ([[animal]])\r\n* [[bubble background]] ([[bubble]])\r\n* [[butterfly background]] ([[butterfly]])\r\n* [[card background]] ([[playing_card]])\r\n* [[cloud background]] ([[cloud]])\r\n* [[fiery background]] ([[fire]])\r\n* [[flag background]] ([[flag]])\r\n* [[floral background]] ([[flower]])\r\n** [[rose background]] ([[rose]])\r\n* [[food-themed background]] ([[food]])\r\n* [[fruit background]] ([[fruit]])\r\n** [[strawberry background]] ([[strawberry]])\r\n* [[heart background]] ([[heart]])\r\n* [[leaf background]] ([[leaf]])\r\n* [[lightning background]] ([[lightning]])\r\n* [[paw print background]] ([[paw print]])\r\n* [[rabbit background]] ([[rabbit]])\r\n* [[snowflake background]] ([[snowflakes]])\r\n* [[sofmap background]] ([[sofmap]])\r\n* [[sparkle background]] ([[sparkle]])\r\n* [[spider web background]] ([[spider web]])\r\n* [[star symbol background]] ([[star_(symbol)]])\r\n* [[starry background]] (deprecated)\r\n* [[text background]] ([[text focus]])\r\n* [[weapon background]] ([[weapon]])\r\n\r\nh4#mediums. Mediums\r\n* [[3d_background]]\r\n* [[AI-generated background]]\r\n* [[collage background]]\r\n* [[paneled background]]\r\n* [[photo background]]\r\n* [[game screenshot background]]\r\n* [[paper background]]\r\n* [[screenshot background]]\r\n* [[sketch background]]\r\n* [[watercolor background]]\r\n\r\nh4#related. Background Related\r\n* [[backlighting]]\r\n* [[blending]]\r\n* [[chibi inset]]\r\n* [[imageboard colors]]\r\n* [[projected inset]]\r\n* [[zoom layer]]'
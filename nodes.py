@@ -0,0 +1,181 @@
+"""
+Typed AST nodes with __slots__, a lighter alternative to the dict nodes the parser builds.
+
+    from nodes import from_dict, parse_nodes, to_dict
+
+    tree = parse_nodes(dtext)  # or from_dict(parse_dtext_to_ast(dtext))
+    html = ast_to_html(tree)  # the renderer takes either form
+    to_dict(tree) == parse_dtext_to_ast(dtext)  # same keys in the same order, so ast_output.json is unchanged
+
+The nodes answer get() and [] with the dict keys ("type", "content", "children", "attrs", ...),
+so code written against dict nodes can read them as is. Fixed type tags ("text", "code", "a")
+live on the class; the others are interned so every node of a type shares one string.
+"""
+
+import sys
+
+
+class Node:
+    __slots__ = ()
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class Text(Node):
+    __slots__ = ("content",)
+    type = "text"
+
+    def __init__(self, content):
+        self.content = content
+
+    def to_dict(self):
+        return {"type": "text", "content": self.content}
+
+
+class TextSpan(Node):
+    """
+    A text node that points into the document it came from instead of holding its own copy.
+    The text is only sliced out when `content` is read (see parse_dtext_to_ast(..., spans=True)).
+    """
+
+    __slots__ = ("source", "start", "end")
+    type = "text"
+
+    def __init__(self, source, start, end):
+        self.source = source
+        self.start = start
+        self.end = end
+
+    @property
+    def content(self):
+        return self.source[self.start : self.end]
+
+    def to_dict(self):
+        return {"type": "text", "content": self.source[self.start : self.end]}
+
+
+class Code(Node):
+    __slots__ = ("content",)
+    type = "code"
+
+    def __init__(self, content):
+        self.content = content
+
+    def to_dict(self):
+        return {"type": "code", "content": self.content}
+
+
+class Void(Node):
+    """A node without content or children: linebreak, horizon."""
+
+    __slots__ = ("type",)
+
+    def __init__(self, node_type):
+        self.type = sys.intern(node_type)
+
+    def to_dict(self):
+        return {"type": self.type}
+
+
+class Element(Node):
+    """Headers (with `id`), inline and block tags, expands (with `title`), table tags (with `attrs`), lists, spans."""
+
+    __slots__ = ("type", "children", "attrs", "id", "title")
+
+    def __init__(self, node_type, children, attrs=None, id=None, title=None):
+        self.type = sys.intern(node_type)
+        self.children = children
+        self.attrs = attrs
+        self.id = id
+        self.title = title
+
+    def to_dict(self):
+        node = {"type": self.type}
+        # Spans are built with their attrs first, table tags get theirs added after the children.
+        if self.attrs is not None and self.type == "span":
+            node["attrs"] = self.attrs
+        node["children"] = to_dict(self.children)
+        if self.id is not None:
+            node["id"] = self.id
+        if self.title is not None:
+            node["title"] = self.title
+        if self.attrs is not None and self.type != "span":
+            node["attrs"] = self.attrs
+        return node
+
+
+class Link(Node):
+    __slots__ = ("attrs", "children", "missing")
+    type = "a"
+
+    def __init__(self, attrs, children, missing=False):
+        self.attrs = attrs
+        self.children = children
+        self.missing = missing
+
+    @property
+    def href(self):
+        return self.attrs.get("href")
+
+    def to_dict(self):
+        node = {"type": "a", "attrs": self.attrs, "children": to_dict(self.children)}
+        if self.missing:
+            node["missing"] = True
+        return node
+
+
+def node_from_dict(node):
+    node_type = node["type"]
+    if node_type == "text":
+        return Text(node["content"])
+    if node_type == "code":
+        return Code(node["content"])
+    if node_type == "a":
+        return Link(node.get("attrs", {}), from_dict(node.get("children", [])), node.get("missing", False))
+    if "children" in node:
+        return Element(
+            node_type,
+            from_dict(node["children"]),
+            attrs=node.get("attrs"),
+            id=node.get("id"),
+            title=node.get("title"),
+        )
+    return Void(node_type)
+
+
+def from_dict(ast):
+    """Turn a dict AST (a list of nodes, as in ast_output.json) into typed nodes."""
+    return [node_from_dict(node) for node in ast]
+
+
+def to_dict(nodes):
+    """Turn typed nodes back into the dict AST."""
+    return [node.to_dict() for node in nodes]
+
+
+def node_to_json(node):
+    """`default` hook for json.dump, so ASTs holding typed nodes (e.g. TextSpan) serialize like dict ASTs."""
+    if isinstance(node, Node):
+        return node.to_dict()
+    raise TypeError(f"Object of type {type(node).__name__} is not JSON serializable")
+
+
+def parse_nodes(dtext):
+    """Parse straight to typed nodes. Each top-level block is converted as soon as it is finished."""
+    from main import iter_parse_dtext  # main imports this module
+
+    return [node_from_dict(block) for block in iter_parse_dtext(dtext)]
@@ -0,0 +1,301 @@
+"""
+A local HTTP service that renders DText, for previews without starting a process per page.
+
+    python render_server.py --json wiki_pages.json   # http://127.0.0.1:8000
+
+    curl --data-binary @page.dtext http://127.0.0.1:8000/render          # HTML fragment
+    curl --data-binary @page.dtext "http://127.0.0.1:8000/render?full=1"  # complete document
+    curl http://127.0.0.1:8000/page/43047                                 # a page of the dump
+    curl http://127.0.0.1:8000/stats                                      # cache and latency numbers
+
+Parsing and rendering run in a pool of worker processes, so one long page doesn't hold up the
+rest. Results go into an LRU cache keyed by a hash of the DText, so a page that was rendered
+before, posted or from the dump, is answered from memory. The server listens on 127.0.0.1 by
+default; it has no authentication and is not meant to be reachable from other machines.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from dtext_convert import convert, use_wiki_index
+from dump_index import WikiDump
+from to_html import FragmentCache
+from wiki_dump import WIKI_PAGES_PATH
+from wiki_index import WikiIndex
+
+HOST = "127.0.0.1"
+PORT = 8000
+MAX_BODY_SIZE = 4 * 1024 * 1024  # bytes of DText in one request
+MAX_HEADER_SIZE = 64 * 1024
+RESULT_CACHE_CHARS = 64 * 1024 * 1024  # characters of HTML kept by the server
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+# Set in each worker by init_worker: fragments shared by successive versions of a page being edited.
+WORKER_CACHE = None
+
+
+def init_worker(wiki_index_path=None):
+    global WORKER_CACHE
+    WORKER_CACHE = FragmentCache()
+    if wiki_index_path:
+        use_wiki_index(WikiIndex(wiki_index_path))
+
+
+def render_dtext(dtext, full_page=False):
+    return convert(dtext, full_page=full_page, cache=WORKER_CACHE)
+
+
+def content_key(dtext, full_page):
+    digest = hashlib.blake2b(dtext.encode("utf-8", "surrogatepass"), digest_size=16)
+    return f"{'full' if full_page else 'fragment'}:{digest.hexdigest()}"
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class LatencyHistogram:
+    """Request latencies counted into LATENCY_BUCKETS_MS (upper bounds, in ms) and one overflow bucket."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        ms = seconds * 1000
+        index = 0
+        while index < len(self.buckets) and ms > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the `q` quantile, in ms (the maximum for the overflow bucket)."""
+        count = sum(self.counts)
+        if not count:
+            return 0.0
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= q * count:
+                return float(self.buckets[index]) if index < len(self.buckets) else self.max
+        return self.max
+
+    def info(self):
+        count = sum(self.counts)
+        labels = [f"<={bucket}" for bucket in self.buckets] + [f">{self.buckets[-1]}"]
+        return {
+            "count": count,
+            "mean_ms": self.total / count if count else 0.0,
+            "max_ms": self.max,
+            "p50_ms": self.quantile(0.5),
+            "p99_ms": self.quantile(0.99),
+            "buckets_ms": dict(zip(labels, self.counts)),
+        }
+
+
+class RenderServer:
+    """The service behind the HTTP handler: the worker pool, the result cache, the dump and the statistics."""
+
+    def __init__(self, dump_path=None, workers=None, wiki_index_path=None, cache_chars=RESULT_CACHE_CHARS):
+        workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(wiki_index_path,))
+        # Start the workers before any connection is open: forked later, they would inherit its
+        # socket and keep it from closing when the server or the client closes it.
+        self.pool.submit(int).result()
+        self.cache = FragmentCache(cache_chars)
+        self.dump = WikiDump(dump_path) if dump_path else None
+        self.pending = {}  # content key -> future of a render in progress, shared by identical requests
+        self.latency = {}  # route -> LatencyHistogram
+        self.started = time.time()
+
+    async def render(self, dtext, full_page=False):
+        key = content_key(dtext, full_page)
+        html = self.cache.get(key)
+        if html is not None:
+            return html
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self.pool, render_dtext, dtext, full_page)
+            self.pending[key] = future
+            future.add_done_callback(lambda done: self.finish(key, done))
+        # Shielded, so a client going away doesn't cancel the render for the others waiting on it.
+        return await asyncio.shield(future)
+
+    def finish(self, key, future):
+        del self.pending[key]
+        if not future.cancelled() and future.exception() is None:
+            self.cache.put(key, future.result())
+
+    async def handle(self, method, target, body):
+        """(route, status, content type, response text) for one request."""
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        full_page = query.get("full", ["0"])[-1] not in ("", "0", "false")
+
+        if url.path == "/render":
+            if method != "POST":
+                raise HttpError(405, "POST the DText to /render")
+            try:
+                dtext = body.decode("utf-8")
+            except UnicodeDecodeError:
+                raise HttpError(400, "the body must be UTF-8 DText")
+            return "render", 200, "text/html; charset=utf-8", await self.render(dtext, full_page)
+
+        if url.path.startswith("/page/"):
+            if method != "GET":
+                raise HttpError(405, "use GET for /page/<id>")
+            if self.dump is None:
+                raise HttpError(404, "no wiki dump loaded (start the server with --json)")
+            try:
+                page_id = int(url.path[len("/page/") :])
+            except ValueError:
+                raise HttpError(400, "page ids are integers")
+            page = self.dump.get(page_id)
+            if page is None:
+                raise HttpError(404, f"no page {page_id} in the dump")
+            return "page", 200, "text/html; charset=utf-8", await self.render(page.get("body") or "", full_page)
+
+        if url.path == "/stats":
+            return "stats", 200, "application/json", json.dumps(self.info(), indent=2)
+
+        raise HttpError(404, f"no route for {url.path}")
+
+    def info(self):
+        cache = self.cache.info()
+        return {
+            "uptime_s": time.time() - self.started,
+            "cache": {key: cache[key] for key in ("hits", "misses", "hit_rate", "fragments", "chars")},
+            "in_flight": len(self.pending),
+            "latency": {route: histogram.info() for route, histogram in sorted(self.latency.items())},
+        }
+
+    def observe(self, route, seconds):
+        histogram = self.latency.get(route)
+        if histogram is None:
+            histogram = self.latency[route] = LatencyHistogram()
+        histogram.observe(seconds)
+
+    async def serve_connection(self, reader, writer):
+        """Answer requests on one connection until the client closes it or asks to (HTTP/1.1 keep-alive)."""
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.IncompleteReadError:
+                    return  # closed between requests
+                except asyncio.LimitOverrunError:
+                    await self.respond(writer, 400, "text/plain; charset=utf-8", "request headers too large", False)
+                    return
+                start = time.perf_counter()
+                route = "error"
+                keep_alive = False
+                try:
+                    method, target, version, headers = parse_head(head)
+                    keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                    length = headers.get("content-length", "0")
+                    if not length.isdigit():
+                        keep_alive = False
+                        raise HttpError(400, "bad Content-Length")
+                    length = int(length)
+                    if length > MAX_BODY_SIZE:
+                        keep_alive = False  # the body is not read, so the connection can't be reused
+                        raise HttpError(413, f"bodies are limited to {MAX_BODY_SIZE} bytes")
+                    body = await reader.readexactly(length)
+                    route, status, content_type, text = await self.handle(method, target, body)
+                except HttpError as e:
+                    status, content_type, text = e.status, "text/plain; charset=utf-8", str(e)
+                except asyncio.IncompleteReadError:
+                    return
+                except Exception as e:  # a page that fails to render must not take the server down
+                    status, content_type, text = 500, "text/plain; charset=utf-8", f"{type(e).__name__}: {e}"
+                await self.respond(writer, status, content_type, text, keep_alive)
+                self.observe(route, time.perf_counter() - start)
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, content_type, text, keep_alive):
+        body = text.encode("utf-8")
+        head = (
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def start(self, host=HOST, port=PORT):
+        """Listen on `host`:`port` (0 for any free port); returns the asyncio server."""
+        return await asyncio.start_server(self.serve_connection, host, port, limit=MAX_HEADER_SIZE)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+        if self.dump is not None:
+            self.dump.close()
+
+
+def parse_head(head):
+    """(method, target, HTTP version, {lowercased header name: value}) of a request's head."""
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split(" ")
+    if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+        raise HttpError(400, "bad request line")
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+    return parts[0], parts[1], parts[2], headers
+
+
+async def serve(host=HOST, port=PORT, dump_path=None, workers=None, wiki_index_path=None):
+    server = RenderServer(dump_path, workers, wiki_index_path)
+    try:
+        listener = await server.start(host, port)
+        address = listener.sockets[0].getsockname()
+        print(f"Rendering DText on http://{address[0]}:{address[1]}/ (Ctrl+C to stop)")
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve DText rendering over HTTP on this machine.")
+    parser.add_argument("--host", default=HOST, help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=PORT, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--json", help=f"wiki page dump to serve /page/<id> from, e.g. {WIKI_PAGES_PATH}")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument("--wiki-index", help="wiki_index.bin to link wiki pages to the local <id>.html files")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.json, args.workers, args.wiki_index))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,232 @@
+"""
+Incremental re-parsing for edited pages.
+
+    ast = parse_dtext_to_ast(old_text)
+    ...
+    ast = reparse(old_text, ast, new_text)  # same result as parse_dtext_to_ast(new_text)
+
+A page is cut into blocks at header lines that sit at the top level of the document. Such a
+header resets everything the parser carries forward: no tag is open around it, it closes any
+list in progress, and no tag, code block or HTML tag runs across its line start. So parsing the
+blocks one by one and joining the results gives exactly the full parse. Headers nested in a tag,
+and headers something else runs into, are not used as cuts.
+
+reparse only looks at the text between what the two versions start and end with in common. It
+re-parses from the last cut before that window to the first cut after it, and keeps the old
+nodes for the rest. Finding every cut of a page takes a scan of the tokenizer and HTML tag
+pattern over it, so the cuts of the last few texts are kept: the first reparse of a page scans
+the old text once, and edits made one after the other only scan the blocks they change.
+"""
+
+import re
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from main import (
+    HTML_TAG_MAP,
+    TAG_GROUPS,
+    LazyPattern,
+    find_protected_spans,
+    normalize_html_tags,
+    parse_dtext_to_ast,
+    tokenize_dtext,
+)
+
+HEADER_TYPES = frozenset(("h1", "h2", "h3", "h4", "h5", "h6"))
+
+# A cut is a header line after a newline; text without one has no cuts to look for.
+HEADER_LINE_PATTERN = LazyPattern(r"\nh[123456]")
+# An HTML tag with attributes, which run to the next ">" (see main.HTML_TAG_PATTERN).
+HTML_ATTRS_START_PATTERN = LazyPattern(rf"<(?:{'|'.join(HTML_TAG_MAP)})\s", re.IGNORECASE)
+
+# text -> [(offset, index of the first node of the block in its AST)] for every cut, with (0, 0)
+# first and (len(text), len(ast)) last. Holds the texts reparse saw last, for a run of edits.
+BLOCK_CUTS = OrderedDict()
+BLOCK_CUTS_SIZE = 32
+
+
+def find_block_boundaries(dtext):
+    """
+    Return (offset, header_number) for every header line the document can be cut at.
+    `offset` is where the line starts in `dtext`; `header_number` counts the top-level headers
+    before it, so it is also the header's position among the top-level header nodes of the AST.
+    """
+    if not HEADER_LINE_PATTERN.search(dtext):
+        return []
+    protected = find_protected_spans(dtext)
+    offsets = []
+    normalized = normalize_html_tags(dtext, protected, offsets)
+    # Normalization only rewrites whole tags, so an offset maps back by the shift of the last tag before it.
+    normalized_ends = [normalized_end for _, normalized_end in offsets]
+    protected_starts = [start for start, _ in protected]
+
+    clean_headers = []
+    boundaries = []
+    depth = 1  # same as len(stack) in iter_node_tree
+    header_number = 0
+    for kind, start, end, match in tokenize_dtext(normalized, clean_headers):
+        if kind == "header":
+            if depth > 1:
+                continue
+            if start > 0 and clean_headers and clean_headers[-1] == start:
+                index = bisect_right(normalized_ends, start) - 1
+                offset = start if index < 0 else start - offsets[index][1] + offsets[index][0]
+                # A [code] the tree builder never saw (e.g. on a header line) still hides its body from normalization.
+                span = bisect_right(protected_starts, offset) - 1
+                if span < 0 or protected[span][1] <= offset:
+                    boundaries.append((offset, header_number))
+            header_number += 1
+        elif kind in ("tag", "table_tag"):
+            closing, tag, _ = match.group(*TAG_GROUPS[kind])
+            if closing:
+                if depth > 1:
+                    depth -= 1
+            elif tag not in ("code", "nodtext"):
+                depth += 1
+    return boundaries
+
+
+def block_cuts(dtext, ast):
+    """The cuts of `dtext` as stored in BLOCK_CUTS, with `ast` its parse."""
+    header_indexes = [index for index, node in enumerate(ast) if node["type"] in HEADER_TYPES]
+    cuts = [(0, 0)]
+    cuts += [(offset, header_indexes[header_number]) for offset, header_number in find_block_boundaries(dtext)]
+    cuts.append((len(dtext), len(ast)))
+    return cuts
+
+
+def remember_cuts(dtext, cuts):
+    BLOCK_CUTS[dtext] = cuts
+    BLOCK_CUTS.move_to_end(dtext)
+    while len(BLOCK_CUTS) > BLOCK_CUTS_SIZE:
+        BLOCK_CUTS.popitem(last=False)
+
+
+def is_sealed(dtext, offset):
+    """
+    Whether nothing that starts before `offset` can run past it, whatever text follows: every "["
+    has its "]", every HTML tag with attributes its ">" and every [code] or [nodtext] its close tag.
+    """
+    if dtext.rfind("[", 0, offset) > dtext.rfind("]", 0, offset):
+        return False
+    if HTML_ATTRS_START_PATTERN.search(dtext, dtext.rfind(">", 0, offset) + 1, offset):
+        return False
+    for tag in ("code", "nodtext"):
+        if dtext.rfind(f"[{tag}", 0, offset) > dtext.rfind(f"[/{tag}]", 0, offset):
+            return False
+    return True
+
+
+def line_end(dtext, offset):
+    """Offset just past the newline that ends the line at `offset`, or past the end if it is the last line."""
+    newline = dtext.find("\n", offset)
+    return len(dtext) + 1 if newline == -1 else newline + 1
+
+
+def common_prefix_length(a, b):
+    # Compared a block at a time, then the block that differs is halved down to the character.
+    low, high, step = 0, min(len(a), len(b)), 4096
+    while low + step <= high and a[low : low + step] == b[low : low + step]:
+        low += step
+    high = min(high, low + step)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def common_suffix_length(a, b, limit):
+    # Same as common_prefix_length, from the ends, and at most `limit` characters.
+    low, high, step = 0, limit, 4096
+    while low + step <= high and a[len(a) - low - step : len(a) - low] == b[len(b) - low - step : len(b) - low]:
+        low += step
+    high = min(high, low + step)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle : len(a) - low] == b[len(b) - middle : len(b) - low]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def reparse(old_text, old_ast, new_text, stats=None):
+    """
+    Parse `new_text`, reusing the nodes of `old_ast` (the parse of `old_text`) for every block
+    whose text did not change. The result equals parse_dtext_to_ast(new_text); reused nodes are
+    shared with `old_ast`, not copied.
+
+    If `stats` is a dict, the number of reused and re-parsed blocks is stored in it.
+    """
+    if old_text == new_text:
+        return list(old_ast)
+
+    old_cuts = BLOCK_CUTS.get(old_text)
+    if old_cuts is None or old_cuts[-1][1] != len(old_ast):
+        old_cuts = block_cuts(old_text, old_ast)
+        remember_cuts(old_text, old_cuts)
+    offsets = [offset for offset, _ in old_cuts]
+    prefix = common_prefix_length(old_text, new_text)
+    suffix = common_suffix_length(old_text, new_text, min(len(old_text), len(new_text)) - prefix)
+    shift = len(new_text) - len(old_text)
+
+    # Start at the last cut before the edit that is still one in new_text: its header line is in
+    # the common prefix, so is everything before it, and none of that can reach past it.
+    first = bisect_left(offsets, prefix, 1, len(offsets) - 1) - 1
+    while first and not (line_end(old_text, offsets[first]) <= prefix and is_sealed(old_text, offsets[first])):
+        first -= 1
+    start = offsets[first]
+
+    # End at the first cut after the edit that is still one in new_text. Its header line is in the
+    # common suffix; whether it is still at the top level is up to the tokenizer, which only has to
+    # see the new blocks in between (and that line) when nothing in them can reach past it.
+    last = None
+    for candidate in range(max(first + 1, bisect_left(offsets, len(old_text) - suffix)), len(offsets) - 1):
+        end = offsets[candidate] + shift
+        if is_sealed(new_text, end):
+            found = [start + offset for offset, _ in find_block_boundaries(new_text[start : line_end(new_text, end)])]
+            if found and found[-1] == end:
+                last, boundaries = candidate, found[:-1]
+            break
+    if last is None:
+        # Otherwise the rest of new_text has to be scanned, and the first of its cuts that is an old
+        # cut in the common suffix ends the blocks to parse.
+        found = [start + offset for offset, _ in find_block_boundaries(new_text[start:])]
+        last, boundaries = len(offsets) - 1, found
+        for position, offset in enumerate(found):
+            candidate = bisect_left(offsets, offset - shift)
+            if offset - shift >= len(old_text) - suffix and offsets[candidate] == offset - shift:
+                last, boundaries = candidate, found[:position]
+                break
+
+    # Blocks in between that come back unchanged (moved, say) still keep their nodes.
+    old_blocks = {
+        old_text[block_start:block_end]: old_ast[first_node:end_node]
+        for (block_start, first_node), (block_end, end_node) in zip(old_cuts[first:last], old_cuts[first + 1 :])
+    }
+    ast = old_ast[: old_cuts[first][1]]
+    cuts = old_cuts[:first]
+    reused = first + len(old_cuts) - 1 - last
+    parsed = 0
+    for block_start, block_end in zip([start, *boundaries], [*boundaries, offsets[last] + shift]):
+        cuts.append((block_start, len(ast)))
+        block = new_text[block_start:block_end]
+        nodes = old_blocks.get(block)
+        if nodes is None:
+            nodes = parse_dtext_to_ast(block)
+            parsed += 1
+        else:
+            reused += 1
+        ast.extend(nodes)
+    node_shift = len(ast) - old_cuts[last][1]
+    cuts += [(offset + shift, index + node_shift) for offset, index in old_cuts[last:]]
+    ast.extend(old_ast[old_cuts[last][1] :])
+    remember_cuts(new_text, cuts)
+
+    if stats is not None:
+        stats["reused"] = reused
+        stats["parsed"] = parsed
+    return ast
@@ -1,119 +1,276 @@
 import html
 import json
 import os
+import sys
+from collections import OrderedDict
 
-from html_template import CSS_CONTENT, generate_full_html
+from html_template import CSS_CONTENT, HTML_FOOTER, generate_html_head
+from nodes import TextSpan
 
 
-def render_with_attrs(tag, node):
+def render_text(node, append):
+    if type(node) is TextSpan:
+        render_text_span(node, append)
+        return
+    append(node["content"].replace("\n", "<br>"))
+
+
+def render_text_span(node, append):
+    # Writes the lines of the span straight from its source, without slicing out the whole text first.
+    source, start, end = node.source, node.start, node.end
+    newline = source.find("\n", start, end)
+    while newline != -1:
+        if newline > start:
+            append(source[start:newline])
+        append("<br>")
+        start = newline + 1
+        newline = source.find("\n", start, end)
+    if start < end:
+        append(source[start:end])
+
+
+def render_code(node, append):
+    inner = node.get("content") or ast_to_html(node.get("children", []))
+    cleaned = inner.strip()  # stripping leading/trailing whitespace/newlines, could be done in dtext2ast but eh
+
+    if "\n" in cleaned:  # Make codeblock if node_type code content has newlines
+        append(f"<pre>{html.escape(cleaned)}</pre>")
+    else:
+        append(f"<code>{html.escape(cleaned)}</code>")
+
+
+def render_nodtext(node, append):
+    inner = node.get("content") or ast_to_html(node.get("children", []))
+    append(f"<span>{html.escape(inner)}</span>")
+
+
+def render_header(node, append):
+    # Extract heading text to use as ID
+    text_content = "".join(child["content"] for child in node.get("children", []) if child["type"] == "text")
+    header_id = "dtext-" + text_content.strip().replace(" ", "-").lower()
+    tag = node["type"]
+    append(f'<{tag} id="{html.escape(header_id)}">')
+    return f"</{tag}>"
+
+
+def render_link(node, append):
+    # For a link node, we expect an "attrs" dictionary with a "href" attribute and text children.
+    href = node.get("attrs", {}).get("href", "#")
+    if node.get("missing"):
+        # Wiki link to a page the local mirror doesn't have (see main.use_wiki_index)
+        append(f'<a class="dtext-wiki-does-not-exist" href="{href}">')
+    else:
+        append(f'<a href="{href}">')
+    return "</a>"
+
+
+def render_expand(node, append):
+    title = html.escape(node.get("title", "Show"))
+    append(f'<details><summary>{title}</summary><div class="expander-content">')
+    return "</div></details>"
+
+
+def render_with_attrs(node, append):
+    tag = node["type"]
     attrs = node.get("attrs", {})
     attr_html = " ".join(f'{k}="{html.escape(v)}"' for k, v in attrs.items())
-    inner_html = ast_to_html(node.get("children", []))
     if attr_html:
-        return f"<{tag} {attr_html}>{inner_html}</{tag}>"
+        append(f"<{tag} {attr_html}>")
     else:
-        return f"<{tag}>{inner_html}</{tag}>"
+        append(f"<{tag}>")
+    return f"</{tag}>"
+
+
+def render_void(markup):
+    def render(node, append):
+        append(markup)
+
+    return render
+
+
+def render_tag(open_markup, close_markup):
+    def render(node, append):
+        append(open_markup)
+        return close_markup
+
+    return render
+
+
+def render_children(node, append):
+    # Unknown node type; fallback to rendering its children
+    return ""
+
+
+# Node type -> render(node, append). A renderer writes the node's opening markup and returns its
+# closing markup if the node's children go in between, or None if it wrote the whole node.
+RENDERERS = {
+    "text": render_text,
+    "code": render_code,
+    "linebreak": render_void("<br>"),
+    "horizon": render_void("<hr>"),
+    "b": render_tag("<strong>", "</strong>"),
+    "i": render_tag("<em>", "</em>"),
+    "u": render_tag("<u>", "</u>"),
+    "s": render_tag("<s>", "</s>"),
+    "tn": render_tag("<small>", "</small>"),
+    "spoilers": render_tag("<span class='spoiler'>", "</span>"),
+    "nodtext": render_nodtext,
+    "a": render_link,
+    "expand": render_expand,
+    "ul": render_tag("<ul>", "</ul>"),
+    "li": render_tag("<li>", "</li>"),
+    "quote": render_tag("<blockquote>", "</blockquote>"),
+}
+RENDERERS.update((f"h{level}", render_header) for level in range(1, 7))
+RENDERERS.update((tag, render_with_attrs) for tag in ("table", "thead", "tbody", "tr", "colgroup", "td", "th", "col"))
+
+
+# Default bound for a FragmentCache, in characters of cached HTML.
+FRAGMENT_CACHE_CHARS = 4 * 1024 * 1024
+
+
+class FragmentCache:
+    """
+    HTML of rendered subtrees, keyed by the "hash" that parse_dtext_to_ast(..., hashes=True) puts on
+    lists, tables, expands and the like, so a fragment repeated within a page or across a batch of
+    pages is rendered once. Least recently used fragments are dropped past `max_chars`.
+
+    render_fragment keys fragments on the node's type and "text_length" as well as the hash, so two
+    subtrees only share a fragment if all three are equal, not on a bare 64-bit hash.
+    """
+
+    def __init__(self, max_chars=FRAGMENT_CACHE_CHARS):
+        self.max_chars = max_chars
+        self.fragments = OrderedDict()
+        self.chars = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        fragment = self.fragments.get(key)
+        if fragment is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.fragments.move_to_end(key)
+        return fragment
+
+    def put(self, key, fragment):
+        if len(fragment) > self.max_chars:
+            return
+        if key in self.fragments:
+            self.chars -= len(self.fragments.pop(key))
+        self.fragments[key] = fragment
+        self.chars += len(fragment)
+        while self.chars > self.max_chars:
+            _, dropped = self.fragments.popitem(last=False)
+            self.chars -= len(dropped)
+
+    def info(self):
+        """Hit/miss counts, cached fragments and the memory their strings take, in bytes."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "fragments": len(self.fragments),
+            "chars": self.chars,
+            "bytes": sum(sys.getsizeof(fragment) for fragment in self.fragments.values()),
+        }
+
+    def clear(self):
+        self.fragments.clear()
+        self.chars = self.hits = self.misses = 0
+
+
+def render_fragment(node, cache):
+    key = (node["type"], node["hash"], node["text_length"])
+    fragment = cache.get(key)
+    if fragment is None:
+        parts = []
+        closer = RENDERERS.get(node["type"], render_children)(node, parts.append)
+        if closer is not None:
+            render_html(node.get("children", []), parts.append, cache)
+            parts.append(closer)
+        fragment = "".join(parts)
+        cache.put(key, fragment)
+    return fragment
+
+
+def render_html(ast, append, cache=None):
+    """
+    Render `ast` by passing its HTML to `append` piece by piece, in order.
+    The tree is walked with an explicit stack, so nesting depth costs no recursion and no
+    intermediate strings: every piece goes straight to `append`.
+
+    With a FragmentCache, nodes that carry a "hash" are rendered once and then taken from the cache.
+    """
+    renderers = RENDERERS
+    stack = [iter(ast)]
+    closers = []
+    while stack:
+        for node in stack[-1]:
+            if cache is not None and "hash" in node:
+                append(render_fragment(node, cache))
+                continue
+            closer = renderers.get(node.get("type"), render_children)(node, append)
+            if closer is not None:
+                stack.append(iter(node.get("children", [])))
+                closers.append(closer)
+                break
+        else:
+            stack.pop()
+            if closers:
+                append(closers.pop())
 
 
-def ast_to_html(ast):
+def ast_to_html(ast, cache=None):
     html_parts = []
+    render_html(ast, html_parts.append, cache)
+    return "".join(html_parts)
 
-    tag_map = {
-        "b": "strong",
-        "i": "em",
-        "u": "u",
-        "s": "s",
-        "tn": "small",
-        "spoilers": "span class='spoiler'",
-        "h1": "h1",
-        "h2": "h2",
-        "h3": "h3",
-        "h4": "h4",
-        "h5": "h5",
-        "h6": "h6",
-        # "code" and "nodtext" are handled separately below.
-    }
-
-    for node in ast:
-        node_type = node.get("type")
-        if node_type == "text":
-            # Split by newlines and insert <br>
-            # html_parts.append(node["content"])
-            # todo: not done
-            lines = node["content"].split("\n")
-            for i, line in enumerate(lines):
-                if i > 0:
-                    html_parts.append("<br>")
-                html_parts.append(line)
-
-        elif node_type == "code":
-            inner = node.get("content") or ast_to_html(node.get("children", []))
-            cleaned = inner.strip()  # stripping leading/trailing whitespace/newlines, could be done in dtext2ast but eh
-
-            if "\n" in cleaned:  # Make codeblock if node_type code content has newlines
-                html_parts.append(f"<pre>{html.escape(cleaned)}</pre>")
-            else:
-                html_parts.append(f"<code>{html.escape(cleaned)}</code>")
-
-        elif node_type == "linebreak":
-            html_parts.append("<br>")
-        elif node_type == "horizon":
-            html_parts.append("<hr>")
-
-        elif node_type in tag_map:
-            tag = tag_map[node_type]
-            inner_html = ast_to_html(node.get("children", []))
-
-            if node_type.startswith("h") and node_type[1:].isdigit():  # h1–h6
-                # Extract heading text to use as ID
-                text_content = "".join(
-                    child["content"] for child in node.get("children", []) if child["type"] == "text"
-                )
-                header_id = "dtext-" + text_content.strip().replace(" ", "-").lower()
-                html_parts.append(f'<{tag} id="{html.escape(header_id)}">{inner_html}</{tag}>')
-
-            elif " " in tag:
-                tag_name, attrs = tag.split(" ", 1)
-                html_parts.append(f"<{tag_name} {attrs}>{inner_html}</{tag_name}>")
-
-            else:
-                html_parts.append(f"<{tag}>{inner_html}</{tag}>")
-
-        elif node_type == "nodtext":
-            inner = node.get("content") or ast_to_html(node.get("children", []))
-            html_parts.append(f"<span>{html.escape(inner)}</span>")
-
-        elif node_type == "a":
-            # For a link node, we expect an "attrs" dictionary with a "href" attribute and text children.
-            attrs = node.get("attrs", {})
-            href = attrs.get("href", "#")
-            inner_html = ast_to_html(node.get("children", []))
-            html_parts.append(f'<a href="{href}">{inner_html}</a>')
-        elif node_type == "expand":
-            title = html.escape(node.get("title", "Show"))
-            inner_html = ast_to_html(node.get("children", []))
-            html_parts.append(
-                f'<details><summary>{title}</summary><div class="expander-content">{inner_html}</div></details>'
-            )
-        elif node_type == "ul":
-            inner_html = ast_to_html(node.get("children", []))
-            html_parts.append(f"<ul>{inner_html}</ul>")
-        elif node_type == "li":
-            inner_html = ast_to_html(node.get("children", []))
-            html_parts.append(f"<li>{inner_html}</li>")
-        elif node_type == "quote":
-            inner_html = ast_to_html(node.get("children", []))
-            html_parts.append(f"<blockquote>{inner_html}</blockquote>")
-
-        elif node_type in {"table", "thead", "tbody", "tr", "colgroup", "td", "th", "col"}:
-            html_parts.append(render_with_attrs(node_type, node))
-
-        else:
-            # Unknown node type; fallback to rendering its children
-            inner_html = ast_to_html(node.get("children", []))
-            html_parts.append(inner_html)
 
-    return "".join(html_parts)
+# render_to collects about this many characters of HTML before each write.
+RENDER_BUFFER_SIZE = 64 * 1024
+
+
+def render_to(
+    stream,
+    ast,
+    full_page=True,
+    embed_css=True,
+    css_filename="styles.css",
+    css_content=CSS_CONTENT,
+    buffer_size=RENDER_BUFFER_SIZE,
+    cache=None,
+):
+    """
+    Write the HTML for `ast` to `stream` (anything with a text write(), e.g. an open file or
+    socket.makefile("w")) as it is rendered, instead of building the page as one string first.
+    With full_page the template head goes out first and the footer last, as in generate_full_html.
+
+    `ast` can be any iterable of top-level nodes, such as iter_parse_dtext(dtext): each block is
+    rendered and written as the parser finishes it. At most about `buffer_size` characters are
+    held between writes. `cache` is passed on to render_html.
+    """
+    parts = []
+    size = 0
+
+    def append(part):
+        nonlocal size
+        parts.append(part)
+        size += len(part)
+        if size >= buffer_size:
+            stream.write("".join(parts))
+            parts.clear()
+            size = 0
+
+    if full_page:
+        stream.write(generate_html_head(embed_css, css_filename, css_content))
+    render_html(ast, append, cache)
+    if full_page:
+        parts.append(HTML_FOOTER)
+    stream.write("".join(parts))
 
 
 def save_html(content, filename):
@@ -148,18 +305,31 @@ def save_css(content, filename):
 embed_css = False
 css_filename = "styles.css"
 
+# Where main.py saves the AST in each --format.
+AST_FILES = {"json": "ast_output.json", "binary": "ast_output.bin"}
 
-def runa():
 
-    ast = load_json("ast_output.json")
+def load_ast(ast_format="json"):
+    if ast_format == "binary":
+        from binary_ast import load_binary
 
-    # Convert AST to HTML content (this is the inner HTML, e.g. content inside <body>)
-    inner_html = ast_to_html(ast)
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        return load_binary(os.path.join(script_dir, AST_FILES["binary"]))
+    return load_json(AST_FILES["json"])
 
-    # Build a full HTML document using our template
-    full_html = generate_full_html(inner_html, embed_css, css_filename, css_content=CSS_CONTENT)
 
-    save_html(full_html, "output.html")
+def runa(ast=None, ast_format="json"):
+    """
+    Write output.html (and styles.css) for `ast`, the parsed AST or any iterable of its top-level
+    nodes. Without one, the AST is read back from the file main.py saved in `ast_format`.
+    """
+    if ast is None:
+        ast = load_ast(ast_format)
+
+    # Write the full HTML document (our template around the rendered AST) as it is rendered
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(script_dir, "output.html"), "w", encoding="utf-8") as f:
+        render_to(f, ast, embed_css=embed_css, css_filename=css_filename)
 
     if not embed_css:
         save_css(CSS_CONTENT, css_filename)
@@ -170,4 +340,10 @@ def runa():
 
 
 if __name__ == "__main__":
-    runa()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Render the AST saved by main.py to output.html.")
+    parser.add_argument(
+        "--format", choices=sorted(AST_FILES), default="json", help="AST file format (default: %(default)s)"
+    )
+    runa(ast_format=parser.parse_args().format)
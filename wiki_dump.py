@@ -0,0 +1,135 @@
+"""
+Reading wiki page dumps one record at a time.
+
+    for page in iter_wiki_pages("wiki_pages.json"):  # a JSON array, or JSON Lines (one page per line)
+        ...
+    page = find_wiki_page("wiki_pages.json", 43047)  # stops reading once the page is found
+
+The file is read in chunks and each record is decoded as soon as it is complete, so memory
+stays around one chunk plus the largest page, whatever the size of the dump.
+"""
+
+import json
+
+WIKI_PAGES_PATH = "wiki_pages.json"
+READ_CHUNK_SIZE = 1024 * 1024  # characters
+
+JSON_DECODER = json.JSONDecoder()
+WHITESPACE = " \t\r\n"
+
+
+def iter_json_array(f, chunk_size=READ_CHUNK_SIZE, offset=None):
+    """
+    Yield the items of the JSON array in the text file `f`, which is positioned after the "[".
+    If `offset` is given (the byte offset `f` is at; `f` must be opened with newline=""),
+    yield (item, byte offset, byte length) with the item's place in the file instead.
+    """
+    buffer = ""
+    pos = 0
+    eof = False
+    expect_item = True
+    counted = 0  # buffer[:counted] is already included in `offset`
+
+    def fill(size):
+        nonlocal buffer, pos, eof, offset, counted
+        chunk = f.read(size)
+        if not chunk:
+            eof = True
+        if offset is not None:
+            offset += len(buffer[counted:pos].encode("utf-8"))
+            counted = 0
+        # Drop what has been decoded already, so the buffer never holds more than the current record.
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    while True:
+        while True:
+            while pos < len(buffer) and buffer[pos] in WHITESPACE:
+                pos += 1
+            if pos < len(buffer) or eof:
+                break
+            fill(chunk_size)
+        if pos == len(buffer):
+            raise ValueError("unexpected end of file in JSON array")
+
+        if buffer[pos] == "]":
+            return
+        if not expect_item:
+            if buffer[pos] != ",":
+                raise ValueError(f"expected ',' or ']' in JSON array, got {buffer[pos]!r}")
+            pos += 1
+            expect_item = True
+            continue
+
+        try:
+            item, end = JSON_DECODER.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # Most likely a record cut off at the end of the buffer: read more and try again.
+            # Reading at least as much as is buffered keeps retries on one huge record linear.
+            fill(max(chunk_size, len(buffer) - pos))
+            continue
+        if end == len(buffer) and not eof:
+            # A number at the end of the buffer may go on in the next chunk.
+            fill(chunk_size)
+            continue
+        expect_item = False
+        if offset is None:
+            pos = end
+            yield item
+        else:
+            offset += len(buffer[counted:pos].encode("utf-8"))
+            length = len(buffer[pos:end].encode("utf-8"))
+            pos = counted = end
+            offset += length
+            yield item, offset - length, length
+
+
+def iter_wiki_pages(path=WIKI_PAGES_PATH, chunk_size=READ_CHUNK_SIZE, offsets=False):
+    """
+    Yield the page records of a wiki dump one by one. The dump is either a JSON array of pages
+    (the API export) or JSON Lines; which one is told from the first character of the file.
+    With offsets=True, yield (page, byte offset, byte length) for where each record is in the file.
+    """
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        first = f.read(1)
+        skipped = 0
+        while first and first in WHITESPACE:
+            first = f.read(1)
+            skipped += 1
+        if first == "[":
+            # Everything read so far is ASCII, so characters and bytes line up.
+            yield from iter_json_array(f, chunk_size, skipped + 1 if offsets else None)
+            return
+        if not first:
+            return
+        # JSON Lines: put the first character back in front of the first line.
+        yield from iter_json_lines(first + f.readline(), f, skipped if offsets else None)
+
+
+def iter_json_lines(first_line, f, offset=None):
+    """
+    Yield the record on `first_line`, then one per non-blank line of the rest of `f`;
+    as (record, byte offset, byte length) if the byte offset of `first_line` is given.
+    """
+    line = first_line
+    while line:
+        record = line.strip()
+        if record and offset is None:
+            yield json.loads(record)
+        elif record:
+            leading = len(line) - len(line.lstrip())
+            start = offset + len(line[:leading].encode("utf-8"))
+            yield json.loads(record), start, len(record.encode("utf-8"))
+        if offset is not None:
+            offset += len(line.encode("utf-8"))
+        line = f.readline()
+
+
+def find_wiki_page(path, page_id, chunk_size=READ_CHUNK_SIZE):
+    """The record with id `page_id`, or None; the rest of the dump is not read once it is found."""
+    for page in iter_wiki_pages(path, chunk_size):
+        if page.get("id") == page_id:
+            return page
+    return None
@@ -0,0 +1,146 @@
+"""
+Title -> page id index for the local wiki mirror.
+
+    python wiki_index.py                      # wiki_pages.json -> wiki_index.bin
+
+The index is an open-addressing hash table written straight to disk: a header, a slot array
+and a pool of UTF-8 titles. WikiIndex maps the file instead of reading it, so opening it takes
+the same time for ten titles or a million, and a lookup touches one or two slots.
+
+Titles are stored the way Danbooru writes them in URLs (lowercase, spaces as underscores).
+"""
+
+import mmap
+import os
+import struct
+import zlib
+
+from wiki_dump import WIKI_PAGES_PATH, iter_wiki_pages
+
+WIKI_INDEX_PATH = "wiki_index.bin"
+
+INDEX_MAGIC = b"DTWIKI\x00\x01"
+HEADER = struct.Struct("<8sII")  # magic, slot count, title count
+SLOT = struct.Struct("<IIII")  # crc32 of the title, offset in the title pool, title length (0 = empty slot), page id
+MAX_PAGE_ID = 2**32 - 1  # page ids in the slots are unsigned 32-bit
+
+
+def normalize_wiki_title(title):
+    return title.strip().replace(" ", "_").lower()
+
+
+def wiki_title_entry(page):
+    """(normalized UTF-8 title, page id) of a wiki page dict, or None if it can't go in the index."""
+    page_id = page.get("id")
+    if not isinstance(page_id, int) or isinstance(page_id, bool) or not 0 <= page_id <= MAX_PAGE_ID:
+        return None
+    # A title that normalizes to "" would get length 0, which marks an empty slot.
+    title = normalize_wiki_title(page.get("title") or "").encode("utf-8")
+    return (title, page_id) if title else None
+
+
+def collect_wiki_titles(pages):
+    """{normalized UTF-8 title: page id} for an iterable of wiki page dicts (only "id" and "title" are used)."""
+    titles = {}
+    for page in pages:
+        entry = wiki_title_entry(page)
+        if entry is not None:
+            titles[entry[0]] = entry[1]
+    return titles
+
+
+def pack_wiki_index(titles):
+    """The index file's bytes for a {normalized UTF-8 title: page id} dict."""
+    # Keep the table at most half full so probe runs stay short; the size is a power of two for masking.
+    slot_count = 8
+    while slot_count < 2 * len(titles):
+        slot_count *= 2
+    mask = slot_count - 1
+
+    slots = [None] * slot_count
+    pool = bytearray()
+    for title, page_id in titles.items():
+        crc = zlib.crc32(title)
+        slot = crc & mask
+        while slots[slot] is not None:
+            slot = (slot + 1) & mask
+        slots[slot] = (crc, len(pool), len(title), page_id)
+        pool += title
+
+    empty = SLOT.pack(0, 0, 0, 0)
+    header = HEADER.pack(INDEX_MAGIC, slot_count, len(titles))
+    return header + b"".join(empty if entry is None else SLOT.pack(*entry) for entry in slots) + pool
+
+
+def write_wiki_index(pages, index_path=WIKI_INDEX_PATH):
+    """Write the index for an iterable of wiki page dicts (only "id" and "title" are used)."""
+    titles = collect_wiki_titles(pages)
+    temp_path = index_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(pack_wiki_index(titles))
+    # Readers never see a half-written index.
+    os.replace(temp_path, index_path)
+    return len(titles)
+
+
+def build_wiki_index(json_path=WIKI_PAGES_PATH, index_path=WIKI_INDEX_PATH):
+    return write_wiki_index(iter_wiki_pages(json_path), index_path)
+
+
+class WikiIndex:
+    """
+    Read-only view of an index file written by write_wiki_index.
+
+        index = WikiIndex("wiki_index.bin")
+        index.get("tag_group:backgrounds")  # -> page id, or None
+    """
+
+    def __init__(self, index_path=WIKI_INDEX_PATH, offset=0):
+        # `offset` is where the index starts in the file, for files that embed one (see wiki_dump.py).
+        with open(index_path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slot_count, self.title_count = HEADER.unpack_from(self.map, offset)
+        if magic != INDEX_MAGIC:
+            self.map.close()
+            raise ValueError(f"{index_path} is not a wiki title index")
+        self.mask = self.slot_count - 1
+        self.slots_start = offset + HEADER.size
+        self.pool_start = self.slots_start + self.slot_count * SLOT.size
+
+    def get(self, title, default=None):
+        """Page id for a title (already normalized, e.g. "hatsune_miku"), or `default`."""
+        key = title.encode("utf-8")
+        crc = zlib.crc32(key)
+        slot = crc & self.mask
+        while True:
+            slot_crc, offset, length, page_id = SLOT.unpack_from(self.map, self.slots_start + slot * SLOT.size)
+            if length == 0:
+                return default
+            if slot_crc == crc and length == len(key):
+                start = self.pool_start + offset
+                if self.map[start : start + length] == key:
+                    return page_id
+            slot = (slot + 1) & self.mask
+
+    def __contains__(self, title):
+        return self.get(title) is not None
+
+    def __len__(self):
+        return self.title_count
+
+    def close(self):
+        self.map.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the wiki title index used for local wiki links.")
+    parser.add_argument(
+        "--json", default=WIKI_PAGES_PATH, help="wiki page dump, JSON or JSON Lines (default: %(default)s)"
+    )
+    parser.add_argument("--out", default=WIKI_INDEX_PATH, help="index file to write (default: %(default)s)")
+    args = parser.parse_args()
+
+    count = build_wiki_index(args.json, args.out)
+    print(f"Indexed {count} wiki titles in '{args.out}'")